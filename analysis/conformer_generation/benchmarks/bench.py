@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+# offline benchmarks of the conformer pipeline:
+# embedding and UFF optimization of the bundled m1_h2o_in/out structures, and splitting, energy parsing,
+# RMSD matrix, distance features and duplicate detection on synthetic ensembles of a given size;
+# results are written as JSON and can be compared against a saved baseline
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+import numpy as np
+
+from optparse import OptionParser
+
+from rdkit import Chem
+import rdkit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.insert(0, os.path.join(here, "..", "scripts"))
+
+import parse
+import conformers_in_rdkit
+from scripts import utils
+from scripts.ensemble import ConformerEnsemble
+from scripts.contacts import contact_features
+
+
+coordinates = os.path.join(here, "..", "coordinates")
+
+
+def get_parser():
+    parser = OptionParser()
+
+    parser.add_option("--sizes",
+                      dest="sizes",
+                      default="100,1000",
+                      help="sizes of the synthetic ensembles, comma separated, e.g. 100,1000,10000 (default: %default)")
+
+    parser.add_option("--nconf",
+                      dest="nconf",
+                      type="int",
+                      default=50,
+                      help="number of conformers to embed and optimize per input structure (default: %default)")
+
+    parser.add_option("--maxiter",
+                      dest="maxiter",
+                      type="int",
+                      default=700,
+                      help="maximum number of UFF iterations (default: %default)")
+
+    parser.add_option("--repeat",
+                      dest="repeat",
+                      type="int",
+                      default=3,
+                      help="number of timed repetitions of every stage (default: %default)")
+
+    parser.add_option("--max_matrix",
+                      dest="max_matrix",
+                      type="int",
+                      default=2000,
+                      help="largest ensemble for the full RMSD matrix (default: %default)")
+
+    parser.add_option("--nthreads",
+                      dest="nthreads",
+                      type="int",
+                      default=0,
+                      help="threads for embedding and optimization (0 = all available cores; default: %default)")
+
+    parser.add_option("--nproc",
+                      dest="nproc",
+                      type="int",
+                      help="processes for RMSD calculations (default: all available cores)")
+
+    parser.add_option("--stages",
+                      dest="stages",
+                      help="run only these stages, comma separated (default: all)")
+
+    parser.add_option("--out",
+                      dest="out",
+                      default="bench_results.json",
+                      help="file to write the results to (default: %default)",
+                      metavar="FILE")
+
+    parser.add_option("--baseline",
+                      dest="baseline",
+                      help="compare the results with this baseline file",
+                      metavar="FILE")
+
+    parser.add_option("--save_baseline",
+                      dest="save_baseline",
+                      help="also save the results as a baseline file",
+                      metavar="FILE")
+
+    parser.add_option("--tolerance",
+                      dest="tolerance",
+                      type="float",
+                      default=0.2,
+                      help="relative change of the median time reported as slower/faster (default: %default)")
+
+    return parser
+
+
+stages = ["embed", "optimize", "split", "split_archive", "energy_parsing", "energy_parsing_split",
+          "rmsd_matrix", "distance_features", "duplicates"]
+
+
+def timed(func, repeat, setup=None):
+    """
+    wall and CPU times (seconds) of "repeat" calls of "func" (after "setup", which is not timed);
+    returns the timings and the result of the last call
+    """
+    wall, cpu = [], []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        w0, c0 = time.perf_counter(), time.process_time()
+        result = func()
+        wall.append(time.perf_counter() - w0)
+        cpu.append(time.process_time() - c0)
+    return {"wall": wall, "cpu": cpu,
+            "median": statistics.median(wall), "min": min(wall)}, result
+
+
+def bench_generation(options, results, selected):
+    """
+    embedding and optimization of the bundled structures, with a fixed seed
+    """
+    for name in ["m1_h2o_in", "m1_h2o_out"]:
+        mol = conformers_in_rdkit.get_mol(os.path.join(coordinates, name + ".sdf"), "sdf")
+
+        def embed():
+            m = Chem.Mol(mol)
+            m.RemoveAllConformers()
+            conformers_in_rdkit.embed_confs(m, options.nconf, 1.0, options.nthreads, seed=42)
+            return m
+
+        if "embed" in selected or "optimize" in selected:
+            t, m = timed(embed, options.repeat if "embed" in selected else 1)
+            if "embed" in selected:
+                results["embed/{}/nconf={}".format(name, options.nconf)] = dict(t, n=m.GetNumConformers())
+        if "optimize" in selected:
+            t, energies = timed(lambda: conformers_in_rdkit.optimize_confs(Chem.Mol(m), options.maxiter, options.nthreads),
+                                options.repeat)
+            results["optimize/{}/nconf={}".format(name, options.nconf)] = dict(t, n=len(energies))
+
+
+def seed_ensemble(nseed=20, maxiter=200):
+    """
+    a few optimized conformers of m1_h2o_in, the templates of the synthetic ensembles
+    """
+    mol = conformers_in_rdkit.get_mol(os.path.join(coordinates, "m1_h2o_in.sdf"), "sdf")
+    mol.RemoveAllConformers()
+    conformers_in_rdkit.embed_confs(mol, nseed, 0.5, 0, seed=42)
+    energies = conformers_in_rdkit.optimize_confs(mol, maxiter, 0)
+    ids = sorted(energies)
+    coords = np.stack([mol.GetConformer(i).GetPositions() for i in ids])
+    return mol, coords, np.array([energies[i] for i in ids])
+
+
+def synthetic_ensemble(template, n, sigma=0.05, rng_seed=0):
+    """
+    "n" conformers: random templates with gaussian noise on the coordinates (so many are near-duplicates)
+    and on the energies
+    """
+    mol, coords, energies = template
+    rng = np.random.default_rng(rng_seed)
+    idx = rng.integers(0, len(coords), n)
+    x = coords[idx] + rng.normal(0.0, sigma, (n,) + coords.shape[1:])
+    e = energies[idx] + rng.normal(0.0, 0.5, n)
+    return ConformerEnsemble(mol, x, e, ["bench_" + str(i) for i in range(n)])
+
+
+def write_sdf(ensemble, path):
+    """
+    the ensemble as conformers_in_rdkit.py writes it
+    """
+    mol = ensemble.to_mol()
+    mol.SetProp("_Name", "m1_h2o_in.xyz")
+    w = Chem.SDWriter(path)
+    for k in range(len(ensemble)):
+        mol.SetProp("ENERGY", "{0:.2f}".format(ensemble.energies[k]))
+        w.write(mol, confId=k)
+    w.close()
+
+
+def remove_index(sdf):
+    utils.energy_cache.clear()
+    if os.path.exists(sdf + ".idx"):
+        os.unlink(sdf + ".idx")
+
+
+def bench_ensemble(options, template, n, workdir, results, selected):
+    ens = synthetic_ensemble(template, n)
+    sdf = os.path.join(workdir, "bench_{}_allconf.sdf".format(n))
+    write_sdf(ens, sdf)
+    splitdir = os.path.join(workdir, "split_{}".format(n))
+    os.makedirs(splitdir)
+    cwd = os.getcwd()
+    os.chdir(splitdir)
+
+    def split(prefix, archive=False):
+        with open(sdf, "rb") as finp:
+            return parse.split(finp, prefix, archive=archive)
+
+    try:
+        if "split" in selected or "energy_parsing_split" in selected:
+            t, count = timed(lambda: split("bench"), options.repeat)
+            if "split" in selected:
+                results["split/n={}".format(n)] = dict(t, n=count)
+        if "split_archive" in selected:
+            t, count = timed(lambda: split("archive", archive=True), options.repeat)
+            results["split_archive/n={}".format(n)] = dict(t, n=count)
+    finally:
+        os.chdir(cwd)
+
+    if "energy_parsing" in selected:
+        t, (names, e) = timed(lambda: utils.read_energies([sdf]), options.repeat, setup=lambda: remove_index(sdf))
+        results["energy_parsing/n={}".format(n)] = dict(t, n=len(e))
+    if "energy_parsing_split" in selected:
+        files = glob.glob(os.path.join(splitdir, "bench_*.sdf"))
+        t, (names, e) = timed(lambda: utils.read_energies(files), options.repeat, setup=utils.energy_cache.clear)
+        results["energy_parsing_split/n={}".format(n)] = dict(t, n=len(e))
+
+    if "rmsd_matrix" in selected and n <= options.max_matrix:
+        t, (names, condensed) = timed(lambda: utils.pairwise_rmsd(ens, nproc=options.nproc), options.repeat)
+        results["rmsd_matrix/n={}".format(n)] = dict(t, n=len(condensed))
+
+    def features():
+        names, d = utils.get_contact_distances(ens)
+        return names, d, contact_features(d)
+
+    t, (names, d, f) = timed(features, options.repeat if "distance_features" in selected else 1)
+    if "distance_features" in selected:
+        results["distance_features/n={}".format(n)] = dict(t, n=len(f))
+
+    if "duplicates" in selected:
+        energy = ens.energy_dict()
+        dists = [{name: row for name, row in zip(names, d[c].tolist())}
+                 for c in ["Oh2o_Hamide", "Hh2o_Narom", "Hh2o_Namide", "Hh2o_Oamide"]]
+        t, (to_be_deleted, candidates) = timed(
+            lambda: utils.find_duplicates_noncovalent(ens, energy, *dists, nproc=options.nproc), options.repeat)
+        results["duplicates/n={}".format(n)] = dict(t, n=len(to_be_deleted), candidates=len(candidates))
+
+
+def metadata(options):
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "rdkit": rdkit.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "options": vars(options)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    table of median wall times against the baseline
+    """
+    print("{0:<40} {1:>12} {2:>12} {3:>8}".format("stage", "baseline [s]", "current [s]", "ratio"))
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            print("{0:<40} {1:>12} {2:>12.4f}".format(key, "-", r["median"]))
+            continue
+        b = baseline[key]["median"]
+        ratio = r["median"]/b if b > 0 else float("inf")
+        flag = ""
+        if ratio > 1.0 + tolerance:
+            flag = "slower"
+            regressions.append(key)
+        elif ratio < 1.0 - tolerance:
+            flag = "faster"
+        print("{0:<40} {1:>12.4f} {2:>12.4f} {3:>8.2f} {4}".format(key, b, r["median"], ratio, flag))
+    return regressions
+
+
+def main():
+    (options, args) = get_parser().parse_args()
+    selected = set(options.stages.split(",")) if options.stages else set(stages)
+    unknown = selected - set(stages)
+    if unknown:
+        sys.exit("unknown stages: {} (choose from {})".format(", ".join(sorted(unknown)), ", ".join(stages)))
+    sizes = [int(s) for s in options.sizes.split(",") if s]
+
+    results = {}
+    bench_generation(options, results, selected)
+
+    if selected - {"embed", "optimize"}:
+        template = seed_ensemble()
+        workdir = tempfile.mkdtemp(prefix="conformer_bench_")
+        try:
+            for n in sizes:
+                print("ensemble of {} conformers".format(n))
+                bench_ensemble(options, template, n, workdir, results, selected)
+        finally:
+            shutil.rmtree(workdir)
+
+    output = {"meta": metadata(options), "results": results}
+    with open(options.out, "w") as f:
+        json.dump(output, f, indent=1)
+    if options.save_baseline:
+        with open(options.save_baseline, "w") as f:
+            json.dump(output, f, indent=1)
+
+    if options.baseline:
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print("slower than the baseline: " + ", ".join(regressions))
+    else:
+        for key, r in results.items():
+            print("{0:<40} {1:>10.4f} s".format(key, r["median"]))
+
+
+if __name__ == "__main__":
+    main()
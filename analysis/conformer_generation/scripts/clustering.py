@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def condensed_to_pairs(k, n):
+    """
+    pairs (i, j), i < j, at positions "k" of a condensed array of "n" conformers (scipy pdist layout)
+    """
+    k = np.asarray(k, dtype=np.int64)
+    i = (n - 2 - np.floor(np.sqrt(-8.0*k + 4.0*n*(n - 1) - 7.0)/2.0 - 0.5)).astype(np.int64)
+    j = k + i + 1 - n*(n - 1)//2 + (n - i)*(n - i - 1)//2
+    return i, j
+
+
+def edges_from_condensed(condensed, n, similarity_thresh):
+    """
+    pairs (i, j) with RMSD below "similarity_thresh" in a condensed RMSD array
+    """
+    k = np.flatnonzero(np.asarray(condensed) < similarity_thresh)
+    return condensed_to_pairs(k, n)
+
+
+def energy_order(energies):
+    """
+    conformer indices from the lowest to the highest energy (NaN energies last)
+    """
+    e = np.asarray(energies, dtype=float)
+    return np.argsort(np.where(np.isnan(e), np.inf, e), kind="stable")
+
+
+def union_find(n, pairs_i, pairs_j):
+    """
+    connected components of the graph with "n" nodes and edges (pairs_i[k], pairs_j[k]);
+    returns the root of every node
+    """
+    parent = list(range(n))
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for a, b in zip(np.asarray(pairs_i).tolist(), np.asarray(pairs_j).tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.array([find(a) for a in range(n)], dtype=np.int64)
+
+
+def leader(n, pairs_i, pairs_j, order):
+    """
+    leader (Butina-like) clustering: conformers are visited in "order"; an unassigned conformer
+    becomes a leader and takes all its unassigned neighbours; returns the leader of every node
+    """
+    pairs_i = np.asarray(pairs_i, dtype=np.int64)
+    pairs_j = np.asarray(pairs_j, dtype=np.int64)
+    # neighbour lists in CSR form
+    a = np.concatenate((pairs_i, pairs_j))
+    b = np.concatenate((pairs_j, pairs_i))
+    s = np.argsort(a, kind="stable")
+    a, b = a[s], b[s]
+    start = np.searchsorted(a, np.arange(n + 1))
+
+    owner = np.full(n, -1)
+    for c in order:
+        if owner[c] >= 0:
+            continue
+        owner[c] = c
+        nb = b[start[c]:start[c+1]]
+        nb = nb[owner[nb] < 0]
+        owner[nb] = c
+    return owner
+
+
+def cluster_conformers(energies, pairs_i, pairs_j, method="union-find"):
+    """
+    cluster conformers connected by "duplicate" pairs (pairs_i[k], pairs_j[k]);
+    method:
+    * "union-find" - clusters are the connected components (chains A~B~C end up in one cluster),
+    * "leader"     - leader clustering in energy order (every member is a duplicate of its leader);
+    the representative of a cluster is its lowest-energy conformer;
+    returns cluster labels (numbered from the lowest-energy representative)
+    and the representatives (sorted by energy)
+    """
+    n = len(energies)
+    order = energy_order(energies)
+    if method == "union-find":
+        root = union_find(n, pairs_i, pairs_j)
+    elif method == "leader":
+        root = leader(n, pairs_i, pairs_j, order)
+    else:
+        raise ValueError("unknown clustering method: {}".format(method))
+
+    # the first member of each cluster in energy order is its representative
+    roots_in_order = root[order]
+    _, first = np.unique(roots_in_order, return_index=True)
+    representatives = order[np.sort(first)]
+
+    label_of_root = {r: l for l, r in enumerate(root[representatives].tolist())}
+    labels = np.array([label_of_root[r] for r in root.tolist()])
+    return labels, representatives
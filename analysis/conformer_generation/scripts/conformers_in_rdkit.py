@@ -1,87 +1,412 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python
 
+import os
 import sys
+import json
+import random
 import rdkit
 from rdkit import Chem
 from rdkit.Chem import AllChem
 
 from optparse import OptionParser
 
-parser = OptionParser()
-
-parser.add_option("--inp",
-                  dest="inp",
-                  help="input file (sdf or smi extensions)",
-                  metavar="FILE")
-
-parser.add_option("--out",
-                  dest="out",
-                  help="output file to write all conformers to",
-                  metavar="FILE")
-
-parser.add_option("--start",
-                  dest="start",
-                  type="string",
-                  help="can be: sdf or smi - either generate conformers from the 3D crystal structure or generate starting geometry from smiles)")
-
-parser.add_option("--nconf",
-                  dest="nconf",
-                  type="int",
-                  help="tentative number of conformers (the program will not generate precisely this number)")
-
-parser.add_option("--maxiter",
-                  dest="maxiter",
-                  type="int",
-                  help="maximum number of iterations for MM geometry optimization")
-
-parser.add_option("--rmsthr",
-                  dest="rmsthr",
-                  type="float",
-                  help="RMS limit treshold")
-
-(options, args) = parser.parse_args()
-
-
-def optimize_confs(confs):
-    
-    converged = 0
-    for conf in confs:
-        opt = AllChem.UFFOptimizeMolecule(mol, confId=conf, maxIters=options.maxiter)
-        converged+=opt
-        
-        if opt == -1:
+from instrument import Metrics, percentiles
+
+
+def get_parser():
+    parser = OptionParser()
+
+    parser.add_option("--inp",
+                      dest="inp",
+                      help="input file (sdf or smi extensions)",
+                      metavar="FILE")
+
+    parser.add_option("--out",
+                      dest="out",
+                      help="output file to write all conformers to",
+                      metavar="FILE")
+
+    parser.add_option("--start",
+                      dest="start",
+                      type="string",
+                      help="can be: sdf or smi - either generate conformers from the 3D crystal structure or generate starting geometry from smiles)")
+
+    parser.add_option("--nconf",
+                      dest="nconf",
+                      type="int",
+                      help="tentative number of conformers (the program will not generate precisely this number)")
+
+    parser.add_option("--maxiter",
+                      dest="maxiter",
+                      type="int",
+                      help="maximum number of iterations for MM geometry optimization")
+
+    parser.add_option("--rmsthr",
+                      dest="rmsthr",
+                      type="float",
+                      help="RMS limit treshold")
+
+    parser.add_option("--nthreads",
+                      dest="nthreads",
+                      type="int",
+                      default=0,
+                      help="number of threads for embedding and optimization (0 = all available cores; default: %default)")
+
+    parser.add_option("--batch",
+                      dest="batch",
+                      type="int",
+                      default=0,
+                      help="embed and optimize conformers in batches of this size, each appended to the output when done (0 = one batch; default: %default)")
+
+    parser.add_option("--seed",
+                      dest="seed",
+                      type="int",
+                      default=-1,
+                      help="random seed of the embedding, batch k uses seed+k (-1 = random, recorded in the checkpoint; default: %default)")
+
+    parser.add_option("--checkpoint",
+                      dest="checkpoint",
+                      help="checkpoint file (default: <out>.checkpoint.json)",
+                      metavar="FILE")
+
+    parser.add_option("--resume",
+                      dest="resume",
+                      action="store_true",
+                      default=False,
+                      help="continue an interrupted run from its checkpoint instead of starting anew")
+
+    parser.add_option("--ff",
+                      dest="ff",
+                      type="choice",
+                      choices=["uff", "mmff"],
+                      default="uff",
+                      help="force field for the optimization: uff or mmff (default: %default)")
+
+    parser.add_option("--preiter",
+                      dest="preiter",
+                      type="int",
+                      default=0,
+                      help="iterations of the pre-minimization before pruning by --ewindow (default: %default)")
+
+    parser.add_option("--ewindow",
+                      dest="ewindow",
+                      type="float",
+                      help="energy window (kcal/mol) over the running minimum; conformers above it are dropped after the pre-minimization and after the full minimization (default: keep all)")
+
+    parser.add_option("--metrics",
+                      dest="metrics",
+                      help="JSON-lines file with per-stage timings and per-conformer convergence (default: <out>.metrics.jsonl; 'none' to disable)",
+                      metavar="FILE")
+
+    parser.add_option("--iter_chunk",
+                      dest="iter_chunk",
+                      type="int",
+                      default=0,
+                      help="record per-conformer iteration counts in the metrics, to a resolution of this many iterations (extra minimizations of copies; 0 = not recorded; default: %default)")
+
+    return parser
+
+
+def embed_confs(mol, nconf, rmsthr, nthreads=0, seed=-1):
+    """
+    embed "nconf" conformers of "mol" (in place) using "nthreads" threads;
+    returns the list of conformer ids
+    """
+    confs = AllChem.EmbedMultipleConfs(mol, numConfs=nconf, enforceChirality=True,
+                                       pruneRmsThresh=rmsthr, numThreads=nthreads,
+                                       randomSeed=seed)
+    return list(confs)
+
+
+def force_field_optimize(mol, ff, maxiter, nthreads=0):
+    """
+    optimize all conformers of "mol" with "ff" ("uff" or "mmff") in one multithreaded batch
+    (the force field is set up once for the molecule and reused for its conformers);
+    returns [(status, energy)] in the order of mol.GetConformers()
+    """
+    if ff == "uff":
+        return AllChem.UFFOptimizeMoleculeConfs(mol, numThreads=nthreads, maxIters=maxiter)
+    elif ff == "mmff":
+        return AllChem.MMFFOptimizeMoleculeConfs(mol, numThreads=nthreads, maxIters=maxiter)
+    raise ValueError("unknown force field: {}".format(ff))
+
+
+def has_force_field(mol, ff):
+    """
+    check once per molecule that "ff" can be set up (MMFF needs atom types for all atoms)
+    """
+    if ff == "mmff":
+        return AllChem.MMFFHasAllMoleculeParams(mol)
+    return AllChem.UFFHasAllMoleculeParams(mol)
+
+
+def count_iterations(mol, maxiter, nthreads, chunk, ff="uff"):
+    """
+    iterations each conformer of "mol" needs to converge, to a resolution of "chunk" iterations
+    (None if not converged within "maxiter"); copies of the starting conformers are minimized with
+    an increasing iteration limit (a minimization of m iterations is the start of any longer one),
+    so the counts match a single "maxiter" pass; "mol" is not modified
+    """
+    iterations = {conf.GetId(): None for conf in mol.GetConformers()}
+    todo = set(iterations)
+    for m in range(chunk, maxiter + chunk, chunk):
+        m = min(m, maxiter)
+        probe = Chem.Mol(mol)
+        for conf in list(iterations):
+            if conf not in todo:
+                probe.RemoveConformer(conf)
+        conf_ids = [conf.GetId() for conf in probe.GetConformers()]
+        results = force_field_optimize(probe, ff, m, nthreads)
+        for conf, (status, energy) in zip(conf_ids, results):
+            if status != 1:
+                todo.discard(conf)
+            if status == 0:
+                iterations[conf] = m
+        if not todo or m == maxiter:
+            break
+    return iterations
+
+
+def prune_energy_window(mol, energies, ewindow, emin=None):
+    """
+    remove the conformers of "mol" more than "ewindow" above the lowest energy
+    (of "energies" and the running minimum "emin"); returns the removed conformer ids
+    """
+    ref = min(list(energies.values()) + ([] if emin is None else [emin]))
+    pruned = [conf for conf, energy in energies.items() if energy > ref + ewindow]
+    for conf in pruned:
+        mol.RemoveConformer(conf)
+    return pruned
+
+
+def optimize_confs(mol, maxiter, nthreads=0, chunk=0, details=None, ff="uff", preiter=0, ewindow=None, emin=None):
+    """
+    optimize all conformers of "mol" with "ff" ("uff" or "mmff") in one multithreaded batch;
+    returns a dictionary {confId: energy} for conformers with a force field
+    (the energies come from the optimization pass, so no second minimization is needed);
+    with an energy window "ewindow" (kcal/mol), conformers are first pre-minimized for "preiter" iterations,
+    those above the window (over the lowest energy so far, or the running minimum "emin" of earlier batches)
+    are dropped, and only the rest are fully minimized (and again kept only within the window);
+    if "details" is a dictionary, it is filled with {confId: {"converged": bool, "iterations": int or None, "pruned": bool}},
+    iterations are counted to a resolution of "chunk" iterations (0: not counted; see count_iterations)
+    """
+    pruned = []
+    if ewindow is not None and preiter > 0:
+        conf_ids = [conf.GetId() for conf in mol.GetConformers()]
+        results = force_field_optimize(mol, ff, preiter, nthreads)
+        pre = {conf: energy for conf, (status, energy) in zip(conf_ids, results) if status != -1}
+        if pre:
+            pruned = prune_energy_window(mol, pre, ewindow, emin)
+        print("%s conformers outside the energy window dropped after pre-minimization" % (len(pruned),))
+        if mol.GetNumConformers() == 0:
+            # the whole batch is above the window: nothing left to minimize
+            if details is not None:
+                for conf in pruned:
+                    details[conf] = {"converged": False, "iterations": None, "pruned": True}
+            return {}
+
+    conf_ids = [conf.GetId() for conf in mol.GetConformers()]
+    if chunk > 0 and details is not None:
+        iterations = count_iterations(mol, maxiter, nthreads, chunk, ff)
+    else:
+        iterations = dict.fromkeys(conf_ids)
+    results = force_field_optimize(mol, ff, maxiter, nthreads)
+
+    # results are in the order of mol.GetConformers()
+    energies = {}
+    converged = {}
+    not_converged = 0
+    for conf, (status, energy) in zip(conf_ids, results):
+        if status == -1:
             print("Forcefield could not be setup for conformer %s!!" % (conf,))
-        else:
-            converged +=opt
+            continue
+        not_converged += status
+        energies[conf] = energy
+        converged[conf] = status == 0
+
+    print("%s conformer minimisations failed to converge" % (not_converged,))
+
+    if ewindow is not None and energies:
+        dropped = prune_energy_window(mol, energies, ewindow, emin)
+        for conf in dropped:
+            del energies[conf]
+        pruned += dropped
+
+    if details is not None:
+        for conf in energies:
+            details[conf] = {"converged": converged[conf], "iterations": iterations[conf], "pruned": False}
+        for conf in pruned:
+            details[conf] = {"converged": converged.get(conf, False), "iterations": iterations.get(conf), "pruned": True}
+    return energies
+
+
+def write_confs(mol, energies, out):
+    w = Chem.SDWriter(out)
+    for confId, energy_value in energies.items():
+        mol.SetProp('ENERGY', '{0:.2f}'.format(energy_value))
+        w.write(mol, confId = confId)
+    w.close()
+
+
+def append_confs(mol, energies, f):
+    """
+    append conformers to the open sdf file "f" and force them to disk,
+    so they survive the job being killed
+    """
+    w = Chem.SDWriter(f)
+    for confId, energy_value in energies.items():
+        mol.SetProp('ENERGY', '{0:.2f}'.format(energy_value))
+        w.write(mol, confId = confId)
+    w.flush()
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def save_checkpoint(checkpoint, state):
+    """
+    write the checkpoint atomically (a killed job leaves either the old or the new file)
+    """
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, checkpoint)
+
+
+def batch_seed(seed, k):
+    """
+    embedding seed of batch k (seed+k, wrapped to the non-negative int range of RDKit)
+    """
+    return (seed + k) % 2**31
+
+
+def new_state(options):
+    batch = options.batch if options.batch > 0 else options.nconf
+    seed = options.seed if options.seed >= 0 else random.SystemRandom().randrange(2**31)
+    return {"inp": os.path.abspath(options.inp),
+            "nconf": options.nconf,
+            "rmsthr": options.rmsthr,
+            "maxiter": options.maxiter,
+            "ff": options.ff,
+            "preiter": options.preiter,
+            "ewindow": options.ewindow,
+            "emin": None,
+            "batch": batch,
+            "seed": seed,
+            "next_batch": 0,
+            "completed": [],
+            "out_size": 0,
+            "done": False}
+
+
+def load_state(options, checkpoint):
+    """
+    state of an interrupted run; the output is truncated to the size recorded in the checkpoint
+    (dropping a partially written batch)
+    """
+    with open(checkpoint, "r") as f:
+        state = json.load(f)
+    if state["inp"] != os.path.abspath(options.inp) or state["nconf"] != options.nconf:
+        sys.exit("checkpoint %s belongs to another run (%s, nconf=%s)" % (checkpoint, state["inp"], state["nconf"]))
+    with open(options.out, "ab") as f:
+        f.truncate(state["out_size"])
+    return state
+
+
+def run_batches(mol, state, out, checkpoint, nthreads=0, metrics=None, chunk=0):
+    """
+    embed, optimize and write conformers batch by batch (batch k embedded with seed "seed"+k),
+    checkpointing after every batch; completed conformers are numbered across batches;
+    stage timings and per-conformer results go to "metrics" (instrument.Metrics)
+    """
+    metrics = Metrics(None) if metrics is None else metrics
+    n_batches = (state["nconf"] + state["batch"] - 1)//state["batch"]
+    with open(out, "a") as f:
+        for k in range(state["next_batch"], n_batches):
+            nconf = min(state["batch"], state["nconf"] - k*state["batch"])
+            batch_mol = Chem.Mol(mol)
+            batch_mol.RemoveAllConformers()
+            with metrics.stage("embed", batch=k, requested=nconf) as s:
+                confs = embed_confs(batch_mol, nconf, state["rmsthr"], nthreads, batch_seed(state["seed"], k))
+                # conformers not embedded: embedding failures or pruned by "rmsthr"
+                s.update(embedded=len(confs), not_embedded=nconf - len(confs))
+            if confs:
+                details = {}
+                with metrics.stage("optimize", batch=k, conformers=len(confs)) as s:
+                    energies = optimize_confs(batch_mol, state["maxiter"], nthreads, chunk, details,
+                                              ff=state.get("ff", "uff"), preiter=state.get("preiter", 0),
+                                              ewindow=state.get("ewindow"), emin=state.get("emin"))
+                    converged = sum(d["converged"] for d in details.values() if not d["pruned"])
+                    s.update(converged=converged, not_converged=len(energies) - converged,
+                             pruned=len(details) - len(energies), no_forcefield=len(confs) - len(details))
+                if energies:
+                    # running minimum for the energy window of the next batches
+                    state["emin"] = min(list(energies.values()) + ([] if state.get("emin") is None else [state["emin"]]))
+                with metrics.stage("write", batch=k, conformers=len(energies)):
+                    append_confs(batch_mol, energies, f)
+                first = len(state["completed"])
+                for i, (conf, energy) in enumerate(energies.items()):
+                    metrics.write("conformer", conf=first + i, batch=k, energy=round(energy, 4), **details[conf])
+                state["completed"] += list(range(first, first + len(energies)))
+            state["next_batch"] = k + 1
+            state["out_size"] = f.tell()
+            save_checkpoint(checkpoint, state)
+    state["done"] = True
+    save_checkpoint(checkpoint, state)
+    return state
+
 
-    print("%s conformer minimisations failed to converge" % (converged,))
-    return confs
+def iterations_from_metrics(path):
+    """
+    per-conformer iteration counts recorded in a metrics file (of all runs appended to it)
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        records = (json.loads(line) for line in f if line.strip())
+        return [r["iterations"] for r in records if r["event"] == "conformer"]
 
 
-def get_mol():
-    if options.start == "sdf":
-        mols = Chem.SDMolSupplier(options.inp, removeHs = False)
+def get_mol(inp, start):
+    if start == "sdf":
+        mols = Chem.SDMolSupplier(inp, removeHs = False)
         mol = mols[0] # only one structure on a starting *sdf file
-    elif options.start == "smi":
-        with open(options.inp, "r") as f:
+    elif start == "smi":
+        with open(inp, "r") as f:
             smiles = f.readlines()[0].split()[0]
             mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
     return mol
 
 
-mol = get_mol()
-confs = AllChem.EmbedMultipleConfs(mol, numConfs=options.nconf, enforceChirality=True, pruneRmsThresh=options.rmsthr)
-allconfs = optimize_confs(confs)
+def main():
+    (options, args) = get_parser().parse_args()
 
+    checkpoint = options.checkpoint or options.out + ".checkpoint.json"
+    metrics_path = options.metrics or options.out + ".metrics.jsonl"
+    resume = options.resume and os.path.exists(checkpoint)
 
-w = Chem.SDWriter(options.out)
+    if resume:
+        state = load_state(options, checkpoint)
+        print("resuming from batch %s (%s conformers done)" % (state["next_batch"], len(state["completed"])))
+    else:
+        state = new_state(options)
+        open(options.out, "w").close()
+        save_checkpoint(checkpoint, state)
 
-for confId in allconfs:
-   ff  = AllChem.UFFGetMoleculeForceField(mol, confId = confId)
-   ff.Minimize()
-   energy_value = ff.CalcEnergy()
-   mol.SetProp('ENERGY', '{0:.2f}'.format(energy_value))
-   w.write(mol, confId = confId)
+    metrics = Metrics(None if metrics_path == "none" else metrics_path, append=resume,
+                      script="conformers_in_rdkit", resume=resume, options=vars(options), seed=state["seed"])
+    with metrics:
+        with metrics.stage("read_input"):
+            mol = get_mol(options.inp, options.start)
+        if not has_force_field(mol, state.get("ff", "uff")):
+            sys.exit("no %s parameters for some atoms of %s" % (state.get("ff", "uff").upper(), options.inp))
+        state = run_batches(mol, state, options.out, checkpoint, options.nthreads, metrics, options.iter_chunk)
+        metrics.close(conformers=len(state["completed"]),
+                      iterations=percentiles(iterations_from_metrics(metrics_path)) if options.iter_chunk > 0 else {})
+    if not state["completed"]:
+        sys.exit("no conformers could be embedded for %s" % (options.inp,))
 
-w.close()
 
+if __name__ == "__main__":
+    main()
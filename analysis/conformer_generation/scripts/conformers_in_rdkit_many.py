@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import time
+import csv
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from rdkit import Chem
+
+from optparse import OptionParser
+
+from conformers_in_rdkit import embed_confs, optimize_confs, write_confs
+
+# per-molecule settings that can be overridden for each input
+per_mol_keys = {"nconf": int, "rmsthr": float, "maxiter": int}
+
+
+def get_parser():
+    parser = OptionParser()
+
+    parser.add_option("--inp",
+                      dest="inp",
+                      help="input: a directory with sdf/smi files, a multi-record sdf file or a multi-line smi file",
+                      metavar="PATH")
+
+    parser.add_option("--outdir",
+                      dest="outdir",
+                      help="directory to write <name>_allconf.sdf files and summary.csv to",
+                      metavar="DIR")
+
+    parser.add_option("--nconf",
+                      dest="nconf",
+                      type="int",
+                      help="default tentative number of conformers per molecule")
+
+    parser.add_option("--maxiter",
+                      dest="maxiter",
+                      type="int",
+                      help="default maximum number of iterations for MM geometry optimization")
+
+    parser.add_option("--rmsthr",
+                      dest="rmsthr",
+                      type="float",
+                      help="default RMS limit treshold")
+
+    parser.add_option("--params",
+                      dest="params",
+                      help="optional file with per-molecule settings, one line per molecule: name nconf=... rmsthr=... maxiter=...",
+                      metavar="FILE")
+
+    parser.add_option("--nproc",
+                      dest="nproc",
+                      type="int",
+                      default=os.cpu_count(),
+                      help="number of molecules processed in parallel (default: %default)")
+
+    parser.add_option("--nthreads",
+                      dest="nthreads",
+                      type="int",
+                      default=1,
+                      help="number of threads used by each process (default: %default)")
+
+    return parser
+
+
+def parse_settings(tokens):
+    """
+    turn "key=value" tokens into a dictionary of per-molecule settings
+    """
+    settings = {}
+    for token in tokens:
+        if "=" not in token:
+            continue
+        k, v = token.split("=", 1)
+        k = k.strip().lower()
+        if k in per_mol_keys:
+            settings[k] = per_mol_keys[k](v)
+    return settings
+
+
+def read_sdf_records(inp):
+    """
+    every record of a (multi-record) sdf file is one molecule;
+    per-molecule settings are read from NCONF/RMSTHR/MAXITER properties
+    """
+    records = []
+    stem = Path(inp).stem
+    for i, mol in enumerate(Chem.SDMolSupplier(str(inp), removeHs = False)):
+        if mol is None:
+            print("could not read record %s of %s, skipping" % (i, inp))
+            continue
+        name = mol.GetProp("_Name").strip() if mol.HasProp("_Name") else ""
+        if not name:
+            name = stem + "_" + str(i)
+        settings = {}
+        for k, f in per_mol_keys.items():
+            for prop in (k, k.upper()):
+                if mol.HasProp(prop):
+                    settings[k] = f(mol.GetProp(prop))
+        records.append({"name": name, "source": str(inp), "start": "sdf",
+                        "data": Chem.MolToMolBlock(mol), "settings": settings})
+    if len(records) == 1:
+        # a single-structure file is named after the file, as in run_rdkit.sh
+        records[0]["name"] = stem
+    return records
+
+
+def read_smi_records(inp):
+    """
+    every non-empty line of a smi file is one molecule: SMILES [name] [key=value ...]
+    """
+    records = []
+    stem = Path(inp).stem
+    with open(inp, "r") as f:
+        for i, line in enumerate(f):
+            words = line.split()
+            if not words or words[0].startswith("#"):
+                continue
+            names = [w for w in words[1:] if "=" not in w]
+            name = names[0] if names else stem + "_" + str(i)
+            records.append({"name": name, "source": str(inp), "start": "smi",
+                            "data": words[0], "settings": parse_settings(words[1:])})
+    return records
+
+
+def collect_records(inp):
+    inp = Path(inp)
+    if inp.is_dir():
+        files = sorted(f for f in inp.iterdir() if f.suffix in (".sdf", ".smi"))
+    else:
+        files = [inp]
+
+    records = []
+    for f in files:
+        if f.suffix == ".sdf":
+            records += read_sdf_records(f)
+        elif f.suffix == ".smi":
+            records += read_smi_records(f)
+        else:
+            sys.exit("unknown input type: %s (expected sdf or smi)" % (f,))
+
+    # names are used for output files, so make them safe and unique
+    # (a suffixed name may itself be taken, e.g. by a record called "foo_1")
+    used = set()
+    count = {}
+    for r in records:
+        base = re.sub(r"[^\w.-]+", "_", r["name"])
+        name = base
+        while name in used:
+            count[base] = count.get(base, 0) + 1
+            name = base + "_" + str(count[base])
+        used.add(name)
+        r["name"] = name
+    return records
+
+
+def read_params(params_file):
+    params = {}
+    with open(params_file, "r") as f:
+        for line in f:
+            words = line.split()
+            if not words or words[0].startswith("#"):
+                continue
+            params[words[0]] = parse_settings(words[1:])
+    return params
+
+
+def run_one(record, outdir, nthreads):
+    """
+    generate and optimize conformers of one molecule; runs in a worker process
+    """
+    settings = record["settings"]
+    out = os.path.join(outdir, record["name"] + "_allconf.sdf")
+    summary = {"name": record["name"], "source": record["source"], "out": out,
+               "nconf": settings["nconf"], "rmsthr": settings["rmsthr"], "maxiter": settings["maxiter"],
+               "embedded": 0, "written": 0, "min_energy": "", "time_s": "", "status": "ok"}
+    t0 = time.perf_counter()
+    try:
+        if record["start"] == "sdf":
+            mol = Chem.MolFromMolBlock(record["data"], removeHs = False)
+        else:
+            mol = Chem.AddHs(Chem.MolFromSmiles(record["data"]))
+        confs = embed_confs(mol, settings["nconf"], settings["rmsthr"], nthreads)
+        summary["embedded"] = len(confs)
+        if confs:
+            energies = optimize_confs(mol, settings["maxiter"], nthreads)
+            write_confs(mol, energies, out)
+            summary["written"] = len(energies)
+            if energies:
+                summary["min_energy"] = "{0:.2f}".format(min(energies.values()))
+        else:
+            summary["status"] = "no conformers embedded"
+    except Exception as e:
+        summary["status"] = "failed: %s" % (e,)
+    summary["time_s"] = "{0:.1f}".format(time.perf_counter() - t0)
+    return summary
+
+
+def main():
+    (options, args) = get_parser().parse_args()
+
+    records = collect_records(options.inp)
+    params = read_params(options.params) if options.params else {}
+    defaults = {"nconf": options.nconf, "rmsthr": options.rmsthr, "maxiter": options.maxiter}
+    for r in records:
+        r["settings"] = {**defaults, **r["settings"], **params.get(r["name"], {})}
+        missing = [k for k, v in r["settings"].items() if v is None]
+        if missing:
+            sys.exit("no %s given for %s" % (", ".join(missing), r["name"]))
+
+    os.makedirs(options.outdir, exist_ok=True)
+    print("%s molecules to process on %s processes" % (len(records), options.nproc))
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=options.nproc) as pool:
+        futures = [pool.submit(run_one, r, options.outdir, options.nthreads) for r in records]
+        for future in as_completed(futures):
+            s = future.result()
+            print("{0}: {1} ({2} conformers, {3} s)".format(s["name"], s["status"], s["written"], s["time_s"]))
+            summaries.append(s)
+
+    # keep the summary in input order
+    order = {r["name"]: i for i, r in enumerate(records)}
+    summaries.sort(key=lambda s: order[s["name"]])
+    with open(os.path.join(options.outdir, "summary.csv"), "w", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=list(summaries[0].keys()) if summaries else ["name"])
+        w.writeheader()
+        w.writerows(summaries)
+
+
+if __name__ == "__main__":
+    main()
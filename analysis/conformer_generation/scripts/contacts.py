@@ -0,0 +1,70 @@
+import numpy as np
+
+from rdkit import Chem
+
+# contacts between H2O and the macrocycle: name -> (atom class 1, atom class 2)
+contact_pairs = {
+    "Oh2o_Hamide": ("O_h2o", "H_amide"),
+    "Hh2o_Narom":  ("H_h2o", "N_arom"),
+    "Hh2o_Namide": ("H_h2o", "N_amide"),
+    "Hh2o_Oamide": ("H_h2o", "O_amide"),
+}
+
+
+def classify_atoms(mol):
+    """
+    indices of the "key atoms" of "mol", from its topology only (so once for all conformers):
+    * O_h2o   - oxygen atoms bonded only to hydrogens
+    * O_amide - other oxygen atoms
+    * H_h2o   - hydrogen atoms bonded only to oxygens
+    * H_amide - hydrogen atoms bonded only to nitrogens
+    * N_arom  - nitrogen atoms bonded only to carbons
+    * N_amide - other nitrogen atoms
+    remember atom numbering from 0 if you compare with e.g. Avogadro
+    """
+    z = np.array([a.GetAtomicNum() for a in mol.GetAtoms()])
+    adj = Chem.GetAdjacencyMatrix(mol)
+    degree = adj.sum(axis=1)
+
+    def only_bonded_to(atnum):
+        return adj @ (z == atnum) == degree
+
+    return {
+        "O_h2o":   np.flatnonzero((z == 8) & only_bonded_to(1)),
+        "O_amide": np.flatnonzero((z == 8) & ~only_bonded_to(1)),
+        "H_h2o":   np.flatnonzero((z == 1) & only_bonded_to(8)),
+        "H_amide": np.flatnonzero((z == 1) & ~only_bonded_to(8) & only_bonded_to(7)),
+        "N_arom":  np.flatnonzero((z == 7) & only_bonded_to(6)),
+        "N_amide": np.flatnonzero((z == 7) & ~only_bonded_to(6)),
+    }
+
+
+def contact_distances(coords, atom_classes):
+    """
+    all H2O-macrocycle contact distances of an ensemble in one vectorized pass;
+    "coords" is an (n_conf, n_atoms, 3) array, "atom_classes" comes from classify_atoms;
+    returns {contact name: (n_conf, n_pairs) array}, each row sorted (as in get_distances)
+    """
+    coords = np.asarray(coords)
+    distances = {}
+    for name, (a, b) in contact_pairs.items():
+        xa = coords[:, atom_classes[a]]
+        xb = coords[:, atom_classes[b]]
+        d = np.linalg.norm(xa[:, :, None, :] - xb[:, None, :, :], axis=-1)
+        distances[name] = np.sort(d.reshape(len(coords), -1), axis=1)
+    return distances
+
+
+def contact_features(distances):
+    """
+    (n_conf, 2*n_contacts) array with the minimum and maximum of every contact distance
+    (input of similarity.prefilter_pairs); NaN if a contact has no atom pairs
+    """
+    features = []
+    for name in contact_pairs:
+        d = distances[name]
+        if d.shape[1]:
+            features += [d[:, 0], d[:, -1]]
+        else:
+            features += [np.full(len(d), np.nan)]*2
+    return np.stack(features, axis=1)
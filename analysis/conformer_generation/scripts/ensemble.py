@@ -0,0 +1,168 @@
+import numpy as np
+
+from rdkit import Chem
+from rdkit.Geometry import Point3D
+
+from .sdf_index import IndexedSDF
+
+
+class ConformerEnsemble():
+    """
+    conformers of one molecule: a single shared topology ("mol", without conformers),
+    one contiguous (n_conf, n_atoms, 3) coordinate block and per-conformer energies and names;
+    replaces a "moldict" with one Chem.Mol copy per conformer
+
+        ens = ConformerEnsemble.from_sdf("scratch/m1_h2o_in_allconf.sdf", prefix="m1_h2o_in_")
+        ens[k]              # coordinates of conformer k (a view, no copy)
+        ens.get_mol(k)      # a Chem.Mol with conformer k, as in a moldict
+        ens.to_mol()        # one Chem.Mol with all conformers
+
+    RDKit conformers cannot share the numpy block (their coordinates live in RDKit's own storage), so
+    everything going in or out of RDKit (get_mol, to_mol, to_moldict, update_from_mol) is a copy; the numeric
+    helpers (similarity, contacts, utils.find_atoms/get_distances/get_contact_distances) take "coords" directly
+    """
+
+    def __init__(self, mol, coords, energies=None, names=None, dtype=np.float64):
+        self.mol = Chem.Mol(mol)
+        self.mol.RemoveAllConformers()
+        self.coords = np.ascontiguousarray(coords, dtype=dtype)
+        if self.coords.ndim != 3 or self.coords.shape[1:] != (self.mol.GetNumAtoms(), 3):
+            raise ValueError("coordinates of shape {} do not fit a molecule with {} atoms"
+                             .format(self.coords.shape, self.mol.GetNumAtoms()))
+        n = len(self.coords)
+        self.energies = np.full(n, np.nan) if energies is None else np.asarray(energies, dtype=float)
+        self.names = ["conf_" + str(i) for i in range(n)] if names is None else list(names)
+        if len(self.energies) != n or len(self.names) != n:
+            raise ValueError("numbers of coordinates, energies and names differ")
+
+    # --- construction -----------------------------------------------------
+
+    @classmethod
+    def from_mols(cls, mols, names=None, energies=None, dtype=np.float64):
+        """
+        ensemble of molecules sharing one topology (the first conformer of each is used);
+        energies default to the ENERGY property
+        """
+        mols = list(mols)
+        n_atoms = mols[0].GetNumAtoms()
+        coords = np.empty((len(mols), n_atoms, 3), dtype=dtype)
+        for i, m in enumerate(mols):
+            if m.GetNumAtoms() != n_atoms:
+                raise ValueError("all conformers must share one topology")
+            coords[i] = m.GetConformer().GetPositions()
+        if energies is None:
+            energies = [float(m.GetProp("ENERGY")) if m.HasProp("ENERGY") else np.nan for m in mols]
+        return cls(mols[0], coords, energies, names, dtype=dtype)
+
+    @classmethod
+    def from_moldict(cls, moldict, energy_dict=None, dtype=np.float64):
+        names = list(moldict.keys())
+        energies = None if energy_dict is None else [energy_dict.get(k, np.nan) for k in names]
+        return cls.from_mols((moldict[k] for k in names), names, energies, dtype=dtype)
+
+    @classmethod
+    def from_molfiles(cls, inpfiles, prefix, dtype=np.float64):
+        """
+        ensemble from one-conformer files (e.g. written by parse.py), named as in from_molfiles_to_moldict;
+        hydrogens are read from the files (not added), so their coordinates are kept
+        """
+        mols = [Chem.MolFromMolFile(inp, removeHs=False) for inp in inpfiles]
+        names = [prefix + str(i) for i in range(len(mols))]
+        return cls.from_mols(mols, names, dtype=dtype)
+
+    @classmethod
+    def from_sdf(cls, sdf, prefix=None, ids=None, dtype=np.float64):
+        """
+        ensemble from a multi-conformer sdf file (e.g. "scratch/*_allconf.sdf"), using its byte-offset index;
+        "ids" selects a subset of conformers; conformer i is named "<prefix>i"
+        """
+        with IndexedSDF(sdf) as confs:
+            ids = np.arange(len(confs)) if ids is None else np.asarray(ids)
+            mol = confs.get_mol(int(ids[0]))
+            n_atoms = mol.GetNumAtoms()
+            coords = np.empty((len(ids), n_atoms, 3), dtype=dtype)
+            for i, k in enumerate(ids):
+                coords[i] = molblock_coordinates(confs.molblock(int(k)), n_atoms)
+            energies = confs.energies[ids]
+        prefix = "conf_" if prefix is None else prefix
+        return cls(mol, coords, energies, [prefix + str(k) for k in ids], dtype=dtype)
+
+    # --- access -----------------------------------------------------------
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, k):
+        return self.coords[k]
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def subset(self, ids):
+        """
+        ensemble of the selected conformers (a view of the coordinates for a slice)
+        """
+        if isinstance(ids, slice):
+            names = self.names[ids]
+        else:
+            ids = np.asarray(ids)
+            names = [self.names[i] for i in ids]
+        return ConformerEnsemble(self.mol, self.coords[ids], self.energies[ids], names, dtype=self.coords.dtype)
+
+    def energy_dict(self):
+        return dict(zip(self.names, self.energies.tolist()))
+
+    # --- RDKit conformers -------------------------------------------------
+
+    def make_conformer(self, k):
+        conf = Chem.Conformer(self.mol.GetNumAtoms())
+        for i, (x, y, z) in enumerate(self.coords[k].tolist()):
+            conf.SetAtomPosition(i, Point3D(x, y, z))
+        conf.Set3D(True)
+        return conf
+
+    def get_mol(self, k):
+        """
+        a Chem.Mol with conformer k (a new molecule, coordinates copied into RDKit), as an entry of a moldict
+        """
+        mol = Chem.Mol(self.mol)
+        mol.AddConformer(self.make_conformer(k), assignId=True)
+        mol.SetProp("_Name", self.names[k])
+        if not np.isnan(self.energies[k]):
+            mol.SetProp("ENERGY", "{0:.2f}".format(self.energies[k]))
+        return mol
+
+    def to_mol(self, ids=None):
+        """
+        one Chem.Mol holding the selected (default: all) conformers, with conformer ids = ensemble indices
+        """
+        mol = Chem.Mol(self.mol)
+        for k in range(len(self)) if ids is None else ids:
+            conf = self.make_conformer(k)
+            conf.SetId(int(k))
+            mol.AddConformer(conf, assignId=False)
+        return mol
+
+    def to_moldict(self):
+        """
+        a moldict of copies (see get_mol), for code that needs one Chem.Mol per conformer
+        """
+        return {name: self.get_mol(k) for k, name in enumerate(self.names)}
+
+    def update_from_mol(self, mol):
+        """
+        copy coordinates back from the conformers of "mol" (conformer id = ensemble index),
+        e.g. after an RDKit optimization of to_mol()
+        """
+        for conf in mol.GetConformers():
+            self.coords[conf.GetId()] = conf.GetPositions()
+
+
+def molblock_coordinates(molblock, n_atoms):
+    """
+    atom coordinates of a V2000 mol block, read from the fixed-width atom lines
+    """
+    lines = molblock.split("\n", 4 + n_atoms)[4:4 + n_atoms]
+    if "V3000" in molblock[:400]:
+        return Chem.MolFromMolBlock(molblock, removeHs=False).GetConformer().GetPositions()
+    return np.array([(l[0:10], l[10:20], l[20:30]) for l in lines], dtype=float)
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import socket
+import resource
+
+from contextlib import contextmanager
+
+# structured run metrics as JSON lines ("<out>.metrics.jsonl"), one record per line:
+#   {"event": "run", ...}                          - start of a run (host, pid, options)
+#   {"event": "stage", "stage": "embed", ...}      - wall/CPU time and peak memory of a stage, plus its counts
+#   {"event": "conformer", "conf": 3, ...}         - per-conformer results (energy, convergence, iterations)
+#   {"event": "end", ...}                          - totals of the run
+
+
+def peak_memory_mb():
+    """
+    peak resident memory of this process (MB)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak/(1024.0*1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+class Metrics():
+    """
+    JSON-lines metrics writer; with path=None nothing is written (all calls are no-ops)
+
+        with Metrics("out.sdf.metrics.jsonl", inp="mol.sdf") as metrics:
+            with metrics.stage("embed", batch=0) as s:
+                confs = embed_confs(...)
+                s["embedded"] = len(confs)
+    """
+
+    def __init__(self, path, append=False, **run_info):
+        self.path = path
+        self.f = open(path, "a" if append else "w") if path else None
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.write("run", host=socket.gethostname(), pid=os.getpid(),
+                   slurm_job_id=os.environ.get("SLURM_JOB_ID"), **run_info)
+
+    def write(self, event, **fields):
+        if self.f is None:
+            return
+        record = {"event": event, "time": round(time.time(), 3)}
+        record.update(fields)
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        time the enclosed block; the yielded dictionary can be filled with counts to record
+        """
+        info = dict(fields)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        yield info
+        self.write("stage", stage=name,
+                   wall=round(time.perf_counter() - wall0, 4),
+                   cpu=round(time.process_time() - cpu0, 4),
+                   peak_mb=peak_memory_mb(), **info)
+
+    def close(self, **fields):
+        if self.f is None:
+            return
+        self.write("end",
+                   wall=round(time.perf_counter() - self.wall0, 4),
+                   cpu=round(time.process_time() - self.cpu0, 4),
+                   peak_mb=peak_memory_mb(), **fields)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """
+    {"p50": ..., "p90": ..., "p99": ..., "max": ...} of a list of numbers (nearest rank), empty if no values
+    """
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {}
+    out = {"p" + str(p): values[min(len(values) - 1, max(0, -(-p*len(values)//100) - 1))] for p in ps}
+    out["max"] = values[-1]
+    return out
@@ -4,69 +4,142 @@ import os, sys
 import re
 from optparse import OptionParser
 
+from instrument import Metrics
+
+# sd property header of the conformer energy, e.g. ">  <ENERGY>  (1) "
+energy = re.compile(rb"^>.*energy", re.IGNORECASE)
+
 #-------------------------------------------------------------------------------
-def get_conformer(n, lineno, lines, ef):
-    energy = re.compile("energy", re.IGNORECASE)
-    print(energy)
-    ff = open(options.prefix+"_" + str(n) + ".sdf", "w")
-    #ff.write("\n")
-    i = 0
-    for line in lines[lineno:]:
-        if "$$$$" in line:
-            break
-        elif energy.search(line):
-            ef.write(str(n) + "\t" + lines[lineno+i+1])
+def read_records(finp):
+    """
+    stream records (lists of lines, as bytes) from an open sdf file;
+    records are separated by "$$$$" lines, which are not included
+    """
+    record = []
+    for line in finp:
+        if line.startswith(b"$$$$"):
+            yield record
+            record = []
+        else:
+            record.append(line)
+    if any(line.strip() for line in record):
+        yield record
+
+
+def get_conformer(record):
+    """
+    split a record into the lines of a per-conformer file and its energy line;
+    the energy property header is dropped, its value stays after "M  END"
+    (this is the layout expected by grep_energies_from_sdf_outputs)
+    """
+    lines = []
+    energy_line = None
+    for i, line in enumerate(record):
+        if energy.search(line):
+            if i + 1 < len(record):
+                energy_line = record[i+1]
+        else:
+            lines.append(line)
+    return lines, energy_line
+
+
+def split(finp, prefix, title=None, archive=False):
+    """
+    read all records of "finp" once and write, in the same pass,
+    energy.csv and either prefix_i.sdf files or a single prefix.sdf archive
+    with its prefix.sdf.idx index (conformer id, byte offset, size, energy)
+    """
+    btitle = title.encode() if title else None
+
+    ef = open("energy.csv", "w")
+    if archive:
+        af = open(prefix + ".sdf", "wb")
+        offsets, nbytes, energies = [], [], []
+
+    n = 0
+    for record in read_records(finp):
+        if btitle is not None and (not record or btitle not in record[0]):
+            continue
+        lines, energy_line = get_conformer(record)
+        e = energy_line.decode().strip() if energy_line is not None else "nan"
+        if energy_line is not None:
+            ef.write(str(n) + "\t" + energy_line.decode())
+
+        if archive:
+            # the archive keeps records in standard sdf format
+            data = b"".join(record) + b"$$$$\n"
+            offsets.append(af.tell())
+            nbytes.append(len(data))
+            energies.append(e)
+            af.write(data)
         else:
-            ff.write(line)
-            i = i + 1
-    ff.close()
+            with open(prefix + "_" + str(n) + ".sdf", "wb") as ff:
+                ff.writelines(lines)
+        n = n + 1
+
+    ef.close()
+    if archive:
+        af.close()
+        # (imported here: only the archive index needs rdkit and numpy)
+        from sdf_index import write_index
+        write_index(prefix + ".sdf", offsets, nbytes, energies)
+    return n
 
 #-------------------------------------------------------------------------------
 
-parser = OptionParser()
+if __name__ == "__main__":
 
-parser.add_option("--inp", 
-                  dest="longinp",
-                  help="input file with many geometries in sdf format to parse", 
-                  metavar="FILE")
+    parser = OptionParser()
 
-parser.add_option("--dir", 
-                  dest="resultdir",
-                  help="directory to write parsed data (path relative to here)", 
-                  metavar="STRING")
+    parser.add_option("--inp",
+                      dest="longinp",
+                      help="input file with many geometries in sdf format to parse",
+                      metavar="FILE")
 
-parser.add_option("--title",
-                  dest="title",
-                  help="title comment on top of every geometry on inp file",
-                  metavar="STRING")
+    parser.add_option("--dir",
+                      dest="resultdir",
+                      help="directory to write parsed data (path relative to here)",
+                      metavar="STRING")
 
-parser.add_option("--prefix",
-                  dest="prefix",
-                  help="prefix: the file names with separated conformers will be prefix_i.sdf where i is the  conformer id",
-                  metavar="STRING")
+    parser.add_option("--title",
+                      dest="title",
+                      help="title comment on top of every geometry on inp file (optional: if given, only records with this title are kept)",
+                      metavar="STRING")
 
-(options, args) = parser.parse_args()
+    parser.add_option("--prefix",
+                      dest="prefix",
+                      help="prefix: the file names with separated conformers will be prefix_i.sdf where i is the  conformer id",
+                      metavar="STRING")
 
-print(options)
+    parser.add_option("--archive",
+                      dest="archive",
+                      action="store_true",
+                      default=False,
+                      help="write all conformers to one prefix.sdf file indexed by prefix.sdf.idx instead of many prefix_i.sdf files")
 
-here = os.getcwd()
-rdir = here + "/" + options.resultdir
+    parser.add_option("--metrics",
+                      dest="metrics",
+                      help="JSON-lines file with timings of the run (default: <dir>/<prefix>.metrics.jsonl; 'none' to disable)",
+                      metavar="FILE")
 
-finp = open(options.longinp, "r")
-lines = finp.readlines()
-finp.close()
+    (options, args) = parser.parse_args()
 
-os.makedirs(rdir, exist_ok=True)
-os.chdir(rdir)
+    print(options)
 
-ef = open("energy.csv", "w")
+    here = os.getcwd()
+    rdir = here + "/" + options.resultdir
+    inp = os.path.abspath(options.longinp)
 
-n = 0
-for lineno, line in enumerate(lines):
-    if options.title in line:
-        get_conformer(n, lineno, lines, ef)
-        n = n + 1
+    metrics_path = os.path.abspath(options.metrics) if options.metrics else rdir + "/" + options.prefix + ".metrics.jsonl"
+
+    os.makedirs(rdir, exist_ok=True)
+    os.chdir(rdir)
 
-ef.close()
-os.chdir(here)
+    with Metrics(None if options.metrics == "none" else metrics_path, script="parse", options=vars(options)) as metrics:
+        with metrics.stage("split", input_bytes=os.path.getsize(inp), archive=options.archive) as s:
+            with open(inp, "rb") as finp:
+                n = split(finp, options.prefix, options.title, options.archive)
+            s["conformers"] = n
+    print("%s conformers written to %s" % (n, rdir))
 
+    os.chdir(here)
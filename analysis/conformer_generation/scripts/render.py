@@ -0,0 +1,131 @@
+import numpy as np
+
+from rdkit import Chem
+
+# rendering of large conformer ensembles: the ensemble is serialized once to a multi-model block,
+# and only a selected subset of frames (a "page") is sent to the browser at a time
+
+
+def ensemble_blocks(ensemble, heavy_only=False):
+    """
+    mol blocks of all conformers of a ConformerEnsemble, from one template block
+    (only the coordinate fields of the atom lines change between conformers)
+    """
+    mol = ensemble.get_mol(0)
+    mol.ClearProp("ENERGY")
+    for a in mol.GetAtoms():
+        a.SetIntProp("ensemble_idx", a.GetIdx())
+    if heavy_only:
+        # RemoveHs keeps the hydrogens it has to (isotopes, chiral or bridging ones), the atoms it kept
+        # are taken from their index property
+        mol = Chem.RemoveHs(mol)
+    keep = np.array([a.GetIntProp("ensemble_idx") for a in mol.GetAtoms()], dtype=np.int64)
+    lines = Chem.MolToMolBlock(mol).split("\n")
+    n_atoms = len(keep)
+    head, atoms, tail = lines[:4], lines[4:4 + n_atoms], lines[4 + n_atoms:]
+    rest = [l[30:] for l in atoms]
+
+    blocks = []
+    for k in range(len(ensemble)):
+        xyz = ensemble.coords[k][keep]
+        body = ["{0:10.4f}{1:10.4f}{2:10.4f}{3}".format(x, y, z, r) for (x, y, z), r in zip(xyz.tolist(), rest)]
+        blocks.append("\n".join([ensemble.names[k]] + head[1:] + body + tail))
+    return blocks
+
+
+def moldict_blocks(moldict, heavy_only=False):
+    return [Chem.MolToMolBlock(Chem.RemoveHs(m) if heavy_only else m) for m in moldict.values()]
+
+
+def multimodel_block(blocks, frames=None):
+    """
+    one multi-model sdf string of the selected frames (default: all)
+    """
+    frames = range(len(blocks)) if frames is None else frames
+    return "$$$$\n".join(blocks[k] for k in frames) + "$$$$\n"
+
+
+def select_frames(energies, mode="sample", representatives=None, window=None, max_frames=None):
+    """
+    indices of the conformers to show, sorted by energy:
+    * "representatives" - the given conformers (e.g. cluster representatives from clustering.cluster_conformers),
+    * "window"          - conformers within "window" (kcal/mol) of the lowest energy,
+    * "sample"          - conformers evenly sampled over the energy-sorted ensemble (needs "max_frames"),
+    * "all"             - all conformers;
+    "max_frames" limits the number of frames in every mode (the lowest-energy ones are kept,
+    except for "sample")
+    """
+    e = np.asarray(energies, dtype=float)
+    e = np.where(np.isnan(e), np.inf, e)
+    order = np.argsort(e, kind="stable")
+    if mode == "representatives":
+        frames = np.asarray(representatives)
+        frames = frames[np.argsort(e[frames], kind="stable")]
+    elif mode == "window":
+        frames = order[e[order] <= e[order[0]] + window]
+    elif mode == "sample":
+        n = len(order) if max_frames is None else min(max_frames, len(order))
+        frames = order[np.unique(np.linspace(0, len(order) - 1, n).round().astype(int))]
+    elif mode == "all":
+        frames = order
+    else:
+        raise ValueError("unknown frame selection: {}".format(mode))
+    if max_frames is not None:
+        frames = frames[:max_frames]
+    return frames
+
+
+class EnsembleViewer():
+    """
+    paginated overlay of a large ensemble (a ConformerEnsemble or a moldict):
+
+        viewer = EnsembleViewer(ensemble, frames=select_frames(ensemble.energies, "window", window=5.0))
+        viewer.page(0).show()       # the first "page_size" frames
+        viewer.next_page().show()   # the next ones
+        viewer.write("overlay.sdf", page=0)   # or save a page to look at it elsewhere
+
+    the structures are serialized once; "heavy_only" drops hydrogens to keep the output small;
+    "page_size=None" shows all selected frames on one page
+    """
+
+    def __init__(self, ensemble, frames=None, page_size=20, heavy_only=False, width=400, height=400):
+        if hasattr(ensemble, "coords"):
+            self.blocks = ensemble_blocks(ensemble, heavy_only)
+        else:
+            self.blocks = moldict_blocks(ensemble, heavy_only)
+        self.frames = np.arange(len(self.blocks)) if frames is None else np.asarray(frames)
+        self.page_size = page_size if page_size else max(len(self.frames), 1)
+        self.width = width
+        self.height = height
+        self.current = -1
+
+    def __len__(self):
+        """
+        number of pages
+        """
+        return (len(self.frames) + self.page_size - 1)//self.page_size
+
+    def page_frames(self, k):
+        return self.frames[k*self.page_size:(k + 1)*self.page_size]
+
+    def page(self, k):
+        self.current = k
+        # imported here: the blocks (and utils) do not need a notebook viewer
+        import py3Dmol
+        p = py3Dmol.view(width=self.width, height=self.height)
+        p.addModels(multimodel_block(self.blocks, self.page_frames(k)), 'sdf')
+        p.setStyle({'stick':{'radius':'0.15'}})
+        p.setBackgroundColor('0xeeeeee')
+        p.zoomTo()
+        return p
+
+    def next_page(self):
+        return self.page(min(self.current + 1, len(self) - 1))
+
+    def write(self, path, page=None):
+        """
+        write the frames of one page (default: all selected frames) as a multi-model sdf file
+        """
+        frames = self.frames if page is None else self.page_frames(page)
+        with open(path, "w") as f:
+            f.write(multimodel_block(self.blocks, frames))
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+export basedir=`pwd`
+mkdir -p $basedir/scratch
+
+# all sdf/smi files in "coordinates" are processed in parallel, one molecule per process;
+# per-molecule nconf/rmsthr/maxiter can be given in an optional --params file
+python $basedir/scripts/conformers_in_rdkit_many.py --inp="$basedir/coordinates"  --outdir="$basedir/scratch"  --nconf=100 --rmsthr=1.0 --maxiter=700 --nthreads=1
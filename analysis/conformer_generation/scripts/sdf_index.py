@@ -0,0 +1,208 @@
+import os
+import re
+import mmap
+import numpy as np
+
+from rdkit import Chem
+
+# end of a record and the value line of the ENERGY sd property
+record_end = re.compile(rb"^\$\$\$\$[^\n]*(?:\n|$)", re.MULTILINE)
+energy_value = re.compile(rb"^>[^\n]*<energy>[^\n]*\n([^\n]*)", re.MULTILINE | re.IGNORECASE)
+# value line right after "M  END" in files written by parse.py (the ENERGY header is dropped there)
+energy_after_mend = re.compile(rb"^M  END[^\n]*\n[ \t]*([-+0-9.eE]+)[ \t]*\r?$", re.MULTILINE)
+
+
+def index_path(sdf):
+    return str(sdf) + ".idx"
+
+
+def source_stamp(sdf):
+    st = os.stat(sdf)
+    return st.st_size, st.st_mtime_ns
+
+
+def write_index(sdf, offsets, nbytes, energies):
+    """
+    write the sidecar index of "sdf": one line per record (conformer id, byte offset, size, energy);
+    the header records the size and mtime of "sdf" to detect stale indices
+    """
+    size, mtime_ns = source_stamp(sdf)
+    with open(index_path(sdf), "w") as f:
+        f.write("# sdf_index source_size={0} source_mtime_ns={1}\n".format(size, mtime_ns))
+        f.write("# conf_id offset nbytes energy\n")
+        for i, (o, n, e) in enumerate(zip(offsets, nbytes, energies)):
+            f.write("{0} {1} {2} {3}\n".format(i, o, n, e))
+
+
+def read_index(sdf):
+    """
+    read the sidecar index of "sdf"; returns None if it is missing or stale
+    """
+    idx = index_path(sdf)
+    if not os.path.exists(idx):
+        return None
+    with open(idx, "r") as f:
+        header = f.readline()
+    stamp = dict(w.split("=") for w in header.split()[2:] if "=" in w)
+    if (int(stamp.get("source_size", -1)), int(stamp.get("source_mtime_ns", -1))) != source_stamp(sdf):
+        return None
+    data = np.loadtxt(idx, comments="#", ndmin=2)
+    if data.size == 0:
+        data = np.zeros((0, 4))
+    return data[:, 1].astype(np.int64), data[:, 2].astype(np.int64), data[:, 3].astype(np.float64)
+
+
+def scan(buf):
+    """
+    find byte offsets, sizes and energies of all records in an sdf buffer
+    """
+    ends = np.array([m.end() for m in record_end.finditer(buf)], dtype=np.int64)
+    last = ends[-1] if len(ends) else 0
+    if buf[last:].strip():
+        # last record is not terminated by "$$$$"
+        ends = np.append(ends, len(buf))
+    offsets = np.concatenate(([0], ends[:-1])).astype(np.int64)
+    nbytes = ends - offsets
+
+    energies = np.full(len(offsets), np.nan)
+    for m in energy_value.finditer(buf):
+        k = np.searchsorted(ends, m.start(), side="right")
+        try:
+            energies[k] = float(m.group(1))
+        except ValueError:
+            pass
+    return offsets, nbytes, energies
+
+
+def build_index(sdf, save=True):
+    """
+    scan "sdf" once and (optionally) save the sidecar index next to it
+    """
+    with open(sdf, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            offsets, nbytes, energies = np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offsets, nbytes, energies = scan(mm)
+    if save:
+        write_index(sdf, offsets, nbytes, energies)
+    return offsets, nbytes, energies
+
+
+def load_index(sdf):
+    """
+    read the sidecar index of "sdf", (re)building it if it is missing or stale
+    """
+    index = read_index(sdf)
+    if index is None:
+        index = build_index(sdf)
+    return index
+
+
+class IndexedSDF():
+    """
+    random access to the records of a (multi-conformer) sdf file:
+    the file is memory-mapped and records are located with the sidecar index,
+    so loading conformer k does not read any other record
+
+        confs = IndexedSDF("scratch/m1_h2o_in_allconf.sdf")
+        mol = confs[k]
+        low = confs[np.flatnonzero(confs.energies < confs.energies.min() + 5.0)]
+    """
+
+    def __init__(self, sdf, removeHs=False):
+        self.sdf = str(sdf)
+        self.removeHs = removeHs
+        self.offsets, self.nbytes, self.energies = load_index(self.sdf)
+        self._f = open(self.sdf, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if len(self.offsets) else b""
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def molblock(self, k):
+        o = self.offsets[k]
+        return self._mm[o:o+self.nbytes[k]].decode()
+
+    def get_mol(self, k):
+        mol = Chem.MolFromMolBlock(self.molblock(k), removeHs=self.removeHs)
+        if mol is not None and not np.isnan(self.energies[k]):
+            mol.SetProp("ENERGY", "{0:.2f}".format(self.energies[k]))
+        return mol
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.get_mol(i) for i in range(len(self))[k]]
+        if isinstance(k, (list, tuple, np.ndarray)):
+            return [self.get_mol(i) for i in k]
+        return self.get_mol(k)
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# {path: (size, mtime_ns, conformer ids, energies)}
+energy_cache = {}
+
+
+def read_energies_from_file(inp):
+    """
+    conformer ids and energies of one sdf file (cached, invalidated by file size and mtime);
+    a split file (parse.py output) gives one energy, a multi-conformer file (*_allconf.sdf) one per record
+    """
+    inp = os.path.abspath(inp)
+    size, mtime_ns = source_stamp(inp)
+    cached = energy_cache.get(inp)
+    if cached is not None and cached[:2] == (size, mtime_ns):
+        return cached[2], cached[3]
+
+    index = read_index(inp)
+    if index is None:
+        with open(inp, 'rb') as f:
+            buf = f.read()
+        if buf.count(b"$$$$") > 1 or energy_value.search(buf):
+            # multi-conformer file: index it (the index is kept next to the file)
+            offsets, nbytes, energies = scan(buf)
+            if len(offsets) > 1:
+                write_index(inp, offsets, nbytes, energies)
+            ids = np.arange(len(energies))
+        else:
+            values = energy_after_mend.findall(buf)
+            energies = np.array([float(values[0])] if values else [np.nan])
+            ids = None
+    else:
+        energies = index[2]
+        ids = np.arange(len(energies))
+
+    energy_cache[inp] = (size, mtime_ns, ids, energies)
+    return ids, energies
+
+
+def read_energies(files, prefix=None):
+    """
+    read conformer energies from sdf files;
+    returns an array of conformer names and an array of energies (in the same order);
+    a split file is named after the file (as in grep_energies_from_sdf_outputs),
+    conformer i of a multi-conformer file is named "<prefix>i" (default prefix: "<file name>_")
+    """
+    names = []
+    energies = []
+    for inp in files:
+        ids, e = read_energies_from_file(inp)
+        stem = os.path.splitext(os.path.basename(inp))[0]
+        if ids is None:
+            names.append(stem)
+        else:
+            p = stem + "_" if prefix is None else prefix
+            names += [p + str(i) for i in ids]
+        energies.append(e)
+    energies = np.concatenate(energies) if energies else np.zeros(0)
+    return np.array(names), energies
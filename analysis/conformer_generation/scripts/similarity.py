@@ -0,0 +1,263 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from .ensemble import ConformerEnsemble
+
+# state of worker processes (set once per process by init_worker)
+worker = {}
+
+
+def topology_key(mol):
+    """
+    atoms and bonds of "mol" in atom order; equal keys mean the same topology and atom numbering
+    """
+    atoms = tuple(a.GetAtomicNum() for a in mol.GetAtoms())
+    bonds = tuple(sorted((b.GetBeginAtomIdx(), b.GetEndAtomIdx(), int(b.GetBondType())) for b in mol.GetBonds()))
+    return atoms, bonds
+
+
+def symmetry_permutations(mol, maxMatches=1000000):
+    """
+    all orderings of the atoms of "mol" that map it onto itself (symmetry-equivalent atom orderings);
+    these are the atom maps GetBestRMS would search for every pair of conformers
+    """
+    return mol.GetSubstructMatches(mol, uniquify=False, maxMatches=maxMatches)
+
+
+def stack_coordinates(mols):
+    """
+    coordinates of the (first) conformer of every molecule in "mols" as an (n_conf, n_atoms, 3) array
+    """
+    return np.stack([mol.GetConformer().GetPositions() for mol in mols])
+
+
+def condensed_index(n, i, j):
+    """
+    position of pair (i, j), i < j, in a condensed distance array (scipy pdist layout)
+    """
+    return n*i - i*(i+1)//2 + (j - i - 1)
+
+
+def best_rms_to_many(x, ys, perms, max_block=2000000):
+    """
+    best RMSD of the centered conformer "x" (n_atoms, 3) to each centered conformer in "ys" (r, n_atoms, 3),
+    minimized over the symmetry-equivalent atom orderings "perms" (m, n_atoms);
+    the optimal superposition is the Kabsch one, so this equals AllChem.GetBestRMS with the same maps
+    """
+    n_atoms = x.shape[0]
+    xp = x[perms]                                           # (m, n_atoms, 3)
+    sq = (x*x).sum() + (ys*ys).sum(axis=(1, 2))             # (r,)
+    best = np.empty(len(ys))
+    step = max(1, max_block // max(1, len(perms)))
+    for a in range(0, len(ys), step):
+        y = ys[a:a+step]
+        h = np.einsum('mak,ral->rmkl', xp, y, optimize=True)   # (r, m, 3, 3) covariance matrices
+        s = np.linalg.svd(h, compute_uv=False)
+        s[..., -1] *= np.sign(np.linalg.det(h))             # no reflections
+        msd = (sq[a:a+step, None] - 2.0*s.sum(axis=-1))/n_atoms
+        best[a:a+step] = np.sqrt(np.clip(msd.min(axis=1), 0.0, None))
+    return best
+
+
+def names_and_worker_args(moldict):
+    """
+    names and worker state (see shared_topology_args) of a moldict or a ConformerEnsemble
+    """
+    if isinstance(moldict, ConformerEnsemble):
+        coords = moldict.coords - moldict.coords.mean(axis=1, keepdims=True)
+        perms = np.array(symmetry_permutations(moldict.mol))
+        return list(moldict.names), (None, coords, perms)
+    names = list(moldict.keys())
+    return names, shared_topology_args([moldict[k] for k in names])
+
+
+def shared_topology_args(mols):
+    """
+    worker state for "mols": centered stacked coordinates and symmetry permutations
+    if all molecules share the topology, otherwise the molecules themselves
+    """
+    if len(mols) > 1 and all(topology_key(m) == topology_key(mols[0]) for m in mols[1:]):
+        coords = stack_coordinates(mols)
+        coords -= coords.mean(axis=1, keepdims=True)
+        perms = np.array(symmetry_permutations(mols[0]))
+        return None, coords, perms
+    return mols, None, None
+
+
+def init_worker(mols, coords, perms):
+    worker["mols"] = mols
+    worker["coords"] = coords
+    worker["perms"] = perms
+
+
+def rmsd_of_row(task):
+    """
+    best RMSD of conformer i to conformers js; uses the stacked coordinates and the
+    symmetry permutations of the shared topology if available, otherwise
+    AllChem.GetBestRMS (with a substructure search) for every pair
+    """
+    i, js = task
+    if worker["coords"] is not None:
+        coords = worker["coords"]
+        return best_rms_to_many(coords[i], coords[js], worker["perms"])
+    mols = worker["mols"]
+    return np.array([AllChem.GetBestRMS(Chem.Mol(mols[i]), mols[j]) for j in js])
+
+
+def run_tasks(func, tasks, nproc, initargs):
+    """
+    results of "func" for all tasks, in order; in this process if nproc <= 1, otherwise on a process pool
+    """
+    if nproc <= 1 or len(tasks) <= 1:
+        init_worker(*initargs)
+        return [func(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=nproc, initializer=init_worker, initargs=initargs) as pool:
+        return list(pool.map(func, tasks, chunksize=max(1, len(tasks)//(8*nproc))))
+
+
+def rmsd_of_pairs(moldict, pairs_i, pairs_j, nproc=None):
+    """
+    best RMSD (as in pairwise_rmsd) for the selected pairs (pairs_i[k], pairs_j[k]) of molecules
+    in "moldict" (indices in moldict order) or of a ConformerEnsemble, e.g. the candidates left by prefilter_pairs
+    """
+    names, initargs = names_and_worker_args(moldict)
+    nproc = os.cpu_count() if nproc is None else nproc
+
+    pairs_i = np.asarray(pairs_i, dtype=np.int64)
+    pairs_j = np.asarray(pairs_j, dtype=np.int64)
+    rms = np.empty(len(pairs_i))
+    if len(pairs_i) == 0:
+        return rms
+    # one task per distinct first conformer
+    order = np.argsort(pairs_i, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(pairs_i[order]) != 0])
+    groups = np.split(order, starts[1:])
+    tasks = [(int(pairs_i[g[0]]), pairs_j[g]) for g in groups]
+    for g, values in zip(groups, run_tasks(rmsd_of_row, tasks, nproc, initargs)):
+        rms[g] = values
+    return rms
+
+
+def radius_of_gyration(coords):
+    """
+    radius of gyration (unweighted) of every conformer in "coords" (n_conf, n_atoms, 3)
+    """
+    centered = coords - coords.mean(axis=1, keepdims=True)
+    return np.sqrt((centered*centered).sum(axis=2).mean(axis=1))
+
+
+def radial_profiles(coords):
+    """
+    sorted distances of the atoms to the centroid for every conformer in "coords" (n_conf, n_atoms, 3)
+    """
+    centered = coords - coords.mean(axis=1, keepdims=True)
+    return np.sort(np.sqrt((centered*centered).sum(axis=2)), axis=1)
+
+
+def distance_features(names, *distances):
+    """
+    (n_conf, 2*len(distances)) array with the minimum and maximum of each sorted distance list
+    (dictionaries {name: sorted distances}, as returned by get_distances); NaN for empty lists
+    """
+    features = np.full((len(names), 2*len(distances)), np.nan)
+    for c, dist in enumerate(distances):
+        for k, name in enumerate(names):
+            d = dist[name]
+            if len(d):
+                features[k, 2*c] = d[0]
+                features[k, 2*c+1] = d[-1]
+    return features
+
+
+def prefilter_pairs(energies, features=None, coords=None,
+                    energy_thresh=5.0, distance_thresh=1.0, similarity_thresh=1.0):
+    """
+    pairs (i, j), i < j, of conformers that can still be duplicates, found without any RMSD calculation:
+    * energies differ by less than "energy_thresh",
+    * all "features" (e.g. from distance_features) differ by less than "distance_thresh"
+      (NaN features do not exclude a pair),
+    * the RMSD lower bounds from "coords" (radius of gyration, sorted atom-centroid distances)
+      are below "similarity_thresh" (the best RMSD cannot be smaller than these for any superposition
+      and any atom ordering);
+    conformers with a NaN energy are never paired; returns two index arrays
+    """
+    energies = np.asarray(energies, dtype=float)
+    valid = np.flatnonzero(~np.isnan(energies))
+    order = valid[np.argsort(energies[valid], kind="stable")]
+    e = energies[order]
+    hi = np.searchsorted(e, e + energy_thresh, side="left")
+
+    if features is not None:
+        features = np.asarray(features, dtype=float)[order]
+    if coords is not None:
+        rg = radius_of_gyration(coords)[order]
+        profiles = radial_profiles(coords)[order]
+
+    pairs_i, pairs_j = [], []
+    for p in range(len(order)):
+        q = np.arange(p + 1, hi[p])
+        if len(q) == 0:
+            continue
+        if features is not None:
+            d = np.abs(features[q] - features[p])
+            q = q[np.all((d < distance_thresh) | np.isnan(d), axis=1)]
+        if coords is not None and len(q):
+            q = q[np.abs(rg[q] - rg[p]) < similarity_thresh]
+            if len(q):
+                d = profiles[q] - profiles[p]
+                q = q[np.sqrt((d*d).mean(axis=1)) < similarity_thresh]
+        pairs_i.append(np.full(len(q), p))
+        pairs_j.append(q)
+
+    if not pairs_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    a = order[np.concatenate(pairs_i)]
+    b = order[np.concatenate(pairs_j)]
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+def upper_triangle_rows(n):
+    """
+    all pairs (i, j), i < j, as one task (i, js) per row i
+    """
+    for i in range(n - 1):
+        yield i, np.arange(i + 1, n)
+
+
+def pairwise_rmsd(moldict, nproc=None, sort_pairs=False):
+    """
+    best RMSD (symmetry-aware, as AllChem.GetBestRMS) between all pairs of molecules in "moldict"
+    (or conformers of a ConformerEnsemble);
+    only the upper triangle is computed, in parallel over "nproc" processes (default: all cores);
+    if all molecules share the topology, symmetry-equivalent atom orderings are found once
+    and the RMSDs of a whole row are computed in one vectorized pass;
+    returns the names (in moldict order) and the condensed RMSD array (scipy pdist layout,
+    use scipy.spatial.distance.squareform for the full matrix), or, with "sort_pairs",
+    the list [((name_1, name_2), rms), ...] sorted from the most to the least similar pair
+    """
+    names, initargs = names_and_worker_args(moldict)
+    n = len(names)
+    nproc = os.cpu_count() if nproc is None else nproc
+
+    condensed = np.empty(n*(n - 1)//2)
+    tasks = list(upper_triangle_rows(n))
+    for (i, js), rms in zip(tasks, run_tasks(rmsd_of_row, tasks, nproc, initargs)):
+        condensed[condensed_index(n, i, js[0]):condensed_index(n, i, js[-1]) + 1] = rms
+
+    if sort_pairs:
+        return sorted_pairs(names, condensed)
+    return names, condensed
+
+
+def sorted_pairs(names, condensed):
+    """
+    [((name_1, name_2), rms), ...] from a condensed array, sorted by increasing rms
+    """
+    n = len(names)
+    i, j = np.triu_indices(n, k=1)
+    order = np.argsort(condensed, kind="stable")
+    return [((names[i[k]], names[j[k]]), float(condensed[k])) for k in order]
@@ -1,60 +1,66 @@
 import os
 import glob
-import py3Dmol
 import numpy as np
 
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit import rdBase
+from collections.abc import Mapping
+
+from .sdf_index import IndexedSDF, energy_cache, read_energies
+from .similarity import pairwise_rmsd, sorted_pairs, rmsd_of_pairs, prefilter_pairs, distance_features, stack_coordinates, topology_key
+from .contacts import classify_atoms, contact_distances, contact_features
+from .clustering import cluster_conformers
+from .ensemble import ConformerEnsemble
+
+from .align import align_moldict, align_moldict_to_lowest_energy
+from .render import EnsembleViewer, select_frames
 
 #print(rdBase.rdkitVersion)
 
+def show_molecules(moldict, width=400, height=400, frames=None):
+    """
+    py3Dmol view of the structures in "moldict" (all, or the positions "frames"), added as one
+    multi-model block (rendering only, see align.py for the alignment and render.py for large ensembles)
+    """
+    return EnsembleViewer(moldict, frames=frames, page_size=None, width=width, height=height).page(0)
+
+
 def align_structures_to_lowest_energy_and_show(moldict, energy_dict, core_smiles):
     """
-    align all structures in "moldict" to the one of the lowest energy
-    todo (work on the code):
-    * separate the alignment step from the visualization
-    * modularize/turn into a library of utils
-    """
-    energy_sorted = sorted(energy_dict.items(), key=lambda x: x[1])
-    lowest = energy_sorted[0][0]
-    core_lowest = moldict[lowest].GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-    
-    for key, mol in moldict.items():
-        match_mol_to_core = mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-        AllChem.AlignMol(mol,moldict[lowest],atomMap=list(zip(match_mol_to_core,core_lowest)))
-        
-    p = py3Dmol.view(width=400,height=400)
-    for key, mol in moldict.items(): 
-        mb = Chem.MolToMolBlock(mol)
-        p.addModel(mb,'sdf')
-    p.setStyle({'stick':{'radius':'0.15'}})
-    p.setBackgroundColor('0xeeeeee')
-    p.zoomTo()
-    return p
+    align all structures in "moldict" to the one of the lowest energy and show them;
+    the alignment itself is align.align_moldict_to_lowest_energy (usable without Jupyter)
+    """
+    align_moldict_to_lowest_energy(moldict, energy_dict, core_smiles)
+    return show_molecules(moldict)
 
 
 def align_and_show(moldict, core_smiles, ref_mol):
     """
     align all structures in "moldict" to a reference structure ("ref_mol"), 
-    "core_smiles" provides a molecular pattern to prioritize in this alignment ("core_smiles")
-    todo (work on the code):
-    * separate the alignment step from the visualization
-    * modularize/turn into a library of utils
+    "core_smiles" provides a molecular pattern to prioritize in this alignment ("core_smiles");
+    the alignment itself is align.align_moldict (usable without Jupyter)
     """ 
-    match_ref_to_core = ref_mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-    for key, mol in moldict.items():    
-        match_mol_to_core = mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-        AllChem.AlignMol(mol,ref_mol,atomMap=list(zip(match_mol_to_core,match_ref_to_core)))
-    
-    p = py3Dmol.view(width=400,height=400)
-    for key, mol in moldict.items(): 
-        mb = Chem.MolToMolBlock(mol)
-        p.addModel(mb,'sdf')
-    p.setStyle({'stick':{'radius':'0.15'}})
-    p.setBackgroundColor('0xeeeeee')
-    p.zoomTo()
-    return p 
+    align_moldict(moldict, core_smiles, ref_mol)
+    return show_molecules(moldict)
+
+
+def show_ensemble(ensemble, energy_dict=None, mode="sample", representatives=None, window=None,
+                  max_frames=50, page_size=20, heavy_only=False, width=400, height=400):
+    """
+    paginated viewer of a large ensemble (a ConformerEnsemble or a moldict with "energy_dict"),
+    showing a subset of frames selected by render.select_frames ("sample", "window", "representatives"):
+
+        viewer = show_ensemble(ens, mode="window", window=3.0)
+        viewer.page(0)
+        viewer.next_page()
+    """
+    if isinstance(ensemble, ConformerEnsemble):
+        energies = ensemble.energies
+    else:
+        energies = [energy_dict.get(k, np.nan) for k in ensemble] if energy_dict else np.zeros(len(ensemble))
+    frames = select_frames(energies, mode, representatives, window, max_frames)
+    return EnsembleViewer(ensemble, frames, page_size, heavy_only, width, height)
 
 
 def from_molfiles_to_moldict(inpfiles, prefix):
@@ -67,151 +73,289 @@ def from_molfiles_to_moldict(inpfiles, prefix):
     return moldict
 
 
-def grep_energies_from_sdf_outputs(files):
-    energies = {}
-    for inp in files:
-        with open(inp,'r') as f:
-            lines = f.readlines()
-            for i, line in enumerate(lines):
-                if "M  END" in line:
-                    energies[os.path.splitext(os.path.basename(inp))[0]] = float(lines[i+1])
-    return energies
-
-
-def make_similarity_matrix(moldict):
-    # similarity_matrix only between macrocycles (h2o not taken into account)
-    similarity_matrix = {}
-    
-    for k_1, m_1 in moldict.items():
-        for k_2, m_2 in moldict.items():
-            if (k_1, k_2) in similarity_matrix.keys() or (k_2, k_1) in similarity_matrix.keys():
-                # do not work on the same conformers
-                pass
-            else:
-                if k_1 != k_2:
-                    rms = AllChem.GetBestRMS(m_1,m_2)
-                    similarity_matrix[(k_1, k_2)] = rms 
-                    
-    return similarity_matrix
+class LazyMolDict(Mapping):
+    """
+    a read-only "moldict" backed by an indexed multi-conformer sdf file;
+    molecules are parsed only when accessed (and then kept)
+    """
+
+    def __init__(self, confs, names):
+        self.confs = confs
+        self.ids = dict(names)
+        self.mols = {}
+
+    def __getitem__(self, key):
+        if key not in self.mols:
+            self.mols[key] = self.confs[self.ids[key]]
+        return self.mols[key]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def from_molfiles_to_ensemble(inpfiles, prefix):
+    """
+    as from_molfiles_to_moldict, but as one ConformerEnsemble (shared topology, one coordinate block)
+    """
+    return ConformerEnsemble.from_molfiles(inpfiles, prefix)
+
+
+def from_indexed_sdf_to_moldict(sdf, prefix, ids=None):
+    """
+    build a moldict from a multi-conformer sdf file (e.g. "scratch/*_allconf.sdf") without splitting it;
+    the byte-offset index is saved next to the file ("<sdf>.idx") and reused;
+    "ids" selects a subset of conformers, e.g. the low-energy ones:
+
+        confs = IndexedSDF(sdf)
+        ids = np.flatnonzero(confs.energies < confs.energies.min() + 5.0)
+    """
+    confs = IndexedSDF(sdf)
+    if ids is None:
+        ids = range(len(confs))
+    return LazyMolDict(confs, ((prefix + str(i), int(i)) for i in ids))
+
+
+def grep_energies_from_sdf_outputs(files, prefix=None):
+    """
+    energies as a dictionary {conformer name: energy}; see read_energies
+    """
+    names, energies = read_energies(files, prefix)
+    return dict(zip(names.tolist(), energies.tolist()))
+
+
+def make_similarity_matrix(moldict, nproc=None):
+    """
+    best RMSD between all pairs of conformers as a dictionary {(name_1, name_2): rms};
+    computed in parallel (see similarity.pairwise_rmsd, which also gives the condensed array
+    or the sorted list of pairs directly)
+    """
+    names, condensed = pairwise_rmsd(moldict, nproc=nproc)
+    n = len(names)
+    i, j = np.triu_indices(n, k=1)
+    return {(names[a], names[b]): float(rms) for a, b, rms in zip(i, j, condensed)}
 
 
 def find_atoms(moldict):
+    """
+    "key atoms" of every conformer as dictionaries {name: indices} (see contacts.classify_atoms)
+    of a moldict or a ConformerEnsemble; atoms are classified once per topology, not once per conformer
+    """
     O_h2o     = {}
-    H_h2o     = {}        
+    H_h2o     = {}
     O_amide   = {}
     H_amide   = {}
     N_amide   = {}
     N_arom    = {}
-        
-    for k, m in moldict.items():
-        Oa  = []
-        Hh  = []
-        Ha  = []
-        Nar = []
-        Na  = []
-        for atom in m.GetAtoms():
-#           remember atom numbering from 0 if you compare with e.g. Avogadro
-            # oxygen atoms:
-            if atom.GetAtomicNum() == 8:
-                if all(x.GetAtomicNum() == 1 for x in atom.GetNeighbors()):
-                    O_h2o[k] = atom.GetIdx()
-                else:
-                    Oa.append(atom.GetIdx())
-                    
-            # hydrogen atoms:
-            if atom.GetAtomicNum() == 1:
-                if all(x.GetAtomicNum() == 8 for x in atom.GetNeighbors()):
-                    Hh.append(atom.GetIdx())
-                elif all(x.GetAtomicNum() == 7 for x in atom.GetNeighbors()):
-                    Ha.append(atom.GetIdx())
-                    
-            # nitrogen atoms:
-            if atom.GetAtomicNum() == 7:
-                if all(x.GetAtomicNum() == 6 for x in atom.GetNeighbors()):
-                    Nar.append(atom.GetIdx())
-                else:
-                    Na.append(atom.GetIdx())                    
-            
-            O_amide[k] = Oa
-            H_h2o[k]   = Hh
-            H_amide[k] = Ha
-            N_amide[k] = Na
-            N_arom[k]  = Nar
-                    
-    return O_h2o, O_amide, H_h2o, H_amide, N_amide, N_arom    
+
+    if isinstance(moldict, ConformerEnsemble):
+        # one shared topology, no Chem.Mol per conformer
+        items = [(k, moldict.mol) for k in moldict.names]
+    else:
+        items = moldict.items()
+    classes = {}
+    previous = None
+    for k, m in items:
+        if m is not previous:
+            key = topology_key(m)
+            previous = m
+        if key not in classes:
+            classes[key] = classify_atoms(m)
+        c = classes[key]
+        if len(c["O_h2o"]):
+            O_h2o[k] = int(c["O_h2o"][-1])
+        O_amide[k] = c["O_amide"].tolist()
+        H_h2o[k]   = c["H_h2o"].tolist()
+        H_amide[k] = c["H_amide"].tolist()
+        N_amide[k] = c["N_amide"].tolist()
+        N_arom[k]  = c["N_arom"].tolist()
+
+    return O_h2o, O_amide, H_h2o, H_amide, N_amide, N_arom
+
+
+def get_contact_distances(moldict):
+    """
+    H2O-macrocycle contact distances of all conformers in "moldict" (sharing one topology)
+    or in a ConformerEnsemble as arrays:
+    returns the names and {contact name: (n_conf, n_pairs) array with sorted rows}
+    (see contacts.contact_distances)
+    """
+    if isinstance(moldict, ConformerEnsemble):
+        return list(moldict.names), contact_distances(moldict.coords, classify_atoms(moldict.mol))
+    names = list(moldict.keys())
+    mols = [moldict[k] for k in names]
+    coords = stack_coordinates(mols)
+    return names, contact_distances(coords, classify_atoms(mols[0]))
 
 
 def get_distances(moldict, O_h2o, O_amide, H_h2o, H_amide, N_amide, N_arom):
+    """
+    sorted H2O-macrocycle distances of every conformer (of a moldict or a ConformerEnsemble)
+    as dictionaries {name: list}; conformers with the same key atoms are stacked and computed
+    in one vectorized pass (for an ensemble, straight from its coordinate block)
+    """
     dist_Oh2o_Hamide = {}
     dist_Hh2o_Narom = {}
     dist_Hh2o_Oamide = {}
     dist_Hh2o_Namide = {}
-    
-    for k, m in moldict.items():
-        dm = Chem.Get3DDistanceMatrix(m)
-        
-        dist1 = []
-        for h_idx in H_amide[k]:
-            dist1.append(dm[O_h2o[k],h_idx])
-        dist_Oh2o_Hamide[k] = sorted(dist1)
-        
-        dist2 = []
-        dist3 = []
-        dist4 = []        
-        for h_idx in H_h2o[k]:
-            for n1_idx in N_arom[k]:
-                dist2.append(dm[n1_idx,h_idx])
-            for n2_idx in N_amide[k]:
-                dist3.append(dm[n2_idx,h_idx])
-            for o_idx in O_amide[k]:
-                dist4.append(dm[o_idx,h_idx])                
-
-        dist_Hh2o_Narom[k]  = sorted(dist2)
-        dist_Hh2o_Namide[k] = sorted(dist3)
-        dist_Hh2o_Oamide[k] = sorted(dist4)            
-        
+
+    if isinstance(moldict, ConformerEnsemble):
+        index = {name: i for i, name in enumerate(moldict.names)}
+        n_atoms = dict.fromkeys(moldict.names, moldict.mol.GetNumAtoms())
+
+        def stack(names):
+            return moldict.coords[[index[name] for name in names]]
+    else:
+        n_atoms = {k: m.GetNumAtoms() for k, m in moldict.items()}
+
+        def stack(names):
+            return stack_coordinates([moldict[name] for name in names])
+
+    groups = {}
+    for k in n_atoms:
+        key = (n_atoms[k], O_h2o[k], tuple(O_amide[k]), tuple(H_h2o[k]), tuple(H_amide[k]),
+               tuple(N_amide[k]), tuple(N_arom[k]))
+        groups.setdefault(key, []).append(k)
+
+    for key, names in groups.items():
+        k = names[0]
+        atom_classes = {"O_h2o": [O_h2o[k]], "O_amide": O_amide[k], "H_h2o": H_h2o[k],
+                        "H_amide": H_amide[k], "N_amide": N_amide[k], "N_arom": N_arom[k]}
+        d = contact_distances(stack(names), atom_classes)
+        for i, name in enumerate(names):
+            dist_Oh2o_Hamide[name] = d["Oh2o_Hamide"][i].tolist()
+            dist_Hh2o_Narom[name]  = d["Hh2o_Narom"][i].tolist()
+            dist_Hh2o_Namide[name] = d["Hh2o_Namide"][i].tolist()
+            dist_Hh2o_Oamide[name] = d["Hh2o_Oamide"][i].tolist()
+
     return dist_Oh2o_Hamide, dist_Hh2o_Narom, dist_Hh2o_Namide, dist_Hh2o_Oamide
 
 
+def duplicate_pairs_noncovalent(similarity_matrix_sorted,
+                                energy,
+                                dist_Oh2o_Hamide,
+                                dist_Hh2o_Narom,
+                                dist_Hh2o_Namide,
+                                dist_Hh2o_Oamide,
+                                similarity_thresh=1.0,  # Angstrom
+                                energy_thresh=5,        # kcal/mol
+                                distance_thresh=1.0):   # Angstrom
+    """
+    all pairs of conformers that are duplicates: RMSD below "similarity_thresh",
+    minimum and maximum H2O-macrocycle distances within "distance_thresh"
+    and energies within "energy_thresh"; every pair of the list is checked
+    """
+    distances = (dist_Oh2o_Hamide, dist_Hh2o_Narom, dist_Hh2o_Namide, dist_Hh2o_Oamide)
+    pairs = []
+    for (conf1, conf2), rms in similarity_matrix_sorted:
+        if rms >= similarity_thresh:
+            continue
+        # now check minimum and maximum distances:
+        if not all(abs(d[conf1][0]  - d[conf2][0])  < distance_thresh and
+                   abs(d[conf1][-1] - d[conf2][-1]) < distance_thresh for d in distances):
+            continue
+        # finally check energies:
+        if abs(energy[conf1] - energy[conf2]) < energy_thresh:
+            pairs.append((conf1, conf2))
+    return pairs
+
+
+def cluster_duplicates_noncovalent(similarity_matrix_sorted,
+                                   energy,
+                                   dist_Oh2o_Hamide,
+                                   dist_Hh2o_Narom,
+                                   dist_Hh2o_Namide,
+                                   dist_Hh2o_Oamide,
+                                   similarity_thresh=1.0,  # Angstrom
+                                   energy_thresh=5,        # kcal/mol
+                                   distance_thresh=1.0,    # Angstrom
+                                   method="union-find"):
+    """
+    cluster the conformers of "energy" connected by duplicate pairs (see duplicate_pairs_noncovalent
+    and clustering.cluster_conformers); returns the conformer names, their cluster labels
+    and the names of the cluster representatives (the lowest-energy conformer of every cluster)
+    """
+    pairs = duplicate_pairs_noncovalent(similarity_matrix_sorted, energy,
+                                        dist_Oh2o_Hamide, dist_Hh2o_Narom, dist_Hh2o_Namide, dist_Hh2o_Oamide,
+                                        similarity_thresh=similarity_thresh,
+                                        energy_thresh=energy_thresh,
+                                        distance_thresh=distance_thresh)
+    names = list(energy.keys())
+    index = {k: i for i, k in enumerate(names)}
+    pairs_i = [index[a] for a, b in pairs]
+    pairs_j = [index[b] for a, b in pairs]
+    energies = np.array([energy[k] for k in names], dtype=float)
+    labels, representatives = cluster_conformers(energies, pairs_i, pairs_j, method=method)
+    return names, labels, [names[r] for r in representatives]
+
+
 def find_duplicates_in_sorted_similarity_matrix_noncovalent(similarity_matrix_sorted,
                                                             energy,
                                                             dist_Oh2o_Hamide,
                                                             dist_Hh2o_Narom,
                                                             dist_Hh2o_Namide,
-                                                            dist_Hh2o_Oamide):
-    
-    similarity_thresh = 1.0 # Angstrom
-    energy_thresh     = 5   # kcal/mol
-    distance_thresh   = 1.0 # Angstrom
-    
-    to_be_deleted     = []
-    
-    for pair in similarity_matrix_sorted:
-        if pair[1] < similarity_thresh:
-            conf1 = pair[0][0]
-            conf2 = pair[0][1]
-            # now check minimum and maximum distances:
-            if (abs(dist_Oh2o_Hamide[conf1][0]  - dist_Oh2o_Hamide[conf2][0]) < distance_thresh and 
-                abs(dist_Oh2o_Hamide[conf1][-1] - dist_Oh2o_Hamide[conf2][-1]) < distance_thresh and
-                abs(dist_Hh2o_Narom[conf1][0]   - dist_Hh2o_Narom[conf2][0]) < distance_thresh and 
-                abs(dist_Hh2o_Narom[conf1][-1]  - dist_Hh2o_Narom[conf2][-1]) < distance_thresh and
-                abs(dist_Hh2o_Namide[conf1][0]  - dist_Hh2o_Namide[conf2][0]) < distance_thresh and 
-                abs(dist_Hh2o_Namide[conf1][-1] - dist_Hh2o_Namide[conf2][-1]) < distance_thresh and
-                abs(dist_Hh2o_Oamide[conf1][0]  - dist_Hh2o_Oamide[conf2][0]) < distance_thresh and 
-                abs(dist_Hh2o_Oamide[conf1][-1] - dist_Hh2o_Oamide[conf2][-1]) < distance_thresh):
-                
-                
-                # finally check energies and remove the one with the higher:
-                if abs(energy[conf1] - energy[conf2]) < energy_thresh:
-                    if energy[conf1] < energy[conf2]:
-                        to_be_deleted.append(conf2)
-                    else:
-                        to_be_deleted.append(conf1)
-            else:
-                # similarity_matrix_b_sorted is sorted, so here we would already start looping over 
-                # pairs for which rmsd is > threshold 
-                # and we do not need to do this, so break
-                break
-
-    return to_be_deleted
+                                                            dist_Hh2o_Oamide,
+                                                            similarity_thresh=1.0,  # Angstrom
+                                                            energy_thresh=5,        # kcal/mol
+                                                            distance_thresh=1.0,    # Angstrom
+                                                            method="union-find"):
+    """
+    conformers to delete as duplicates: all members of a duplicate cluster except its lowest-energy
+    representative (see cluster_duplicates_noncovalent); each conformer is listed once, by energy
+    """
+    names, labels, representatives = cluster_duplicates_noncovalent(
+        similarity_matrix_sorted, energy,
+        dist_Oh2o_Hamide, dist_Hh2o_Narom, dist_Hh2o_Namide, dist_Hh2o_Oamide,
+        similarity_thresh=similarity_thresh, energy_thresh=energy_thresh,
+        distance_thresh=distance_thresh, method=method)
+    keep = set(representatives)
+    return sorted((k for k in names if k not in keep), key=lambda k: energy[k])
+
+
+def find_duplicates_noncovalent(moldict,
+                                energy,
+                                dist_Oh2o_Hamide,
+                                dist_Hh2o_Narom,
+                                dist_Hh2o_Namide,
+                                dist_Hh2o_Oamide,
+                                similarity_thresh=1.0,  # Angstrom
+                                energy_thresh=5,        # kcal/mol
+                                distance_thresh=1.0,    # Angstrom
+                                nproc=None,
+                                method="union-find"):
+    """
+    as find_duplicates_in_sorted_similarity_matrix_noncovalent, but without the full similarity matrix
+    ("moldict" can also be a ConformerEnsemble, e.g. with energy=ensemble.energy_dict()):
+    pairs that cannot be duplicates (energy window, H2O-macrocycle distances, RMSD lower bounds
+    from shape descriptors) are dropped first, and RMSD is calculated only for the remaining candidates;
+    returns the conformers to delete and the sorted similarity list of the candidate pairs
+    """
+    distances = (dist_Oh2o_Hamide, dist_Hh2o_Narom, dist_Hh2o_Namide, dist_Hh2o_Oamide)
+    if isinstance(moldict, ConformerEnsemble):
+        names = list(moldict.names)
+        coords = moldict.coords
+    else:
+        names = list(moldict.keys())
+        mols = [moldict[k] for k in names]
+        shared = all(topology_key(m) == topology_key(mols[0]) for m in mols[1:])
+        coords = stack_coordinates(mols) if shared and mols else None
+    features = distance_features(names, *distances)
+    energies = np.array([energy.get(k, np.nan) for k in names], dtype=float)
+
+    pairs_i, pairs_j = prefilter_pairs(energies, features, coords,
+                                       energy_thresh=energy_thresh,
+                                       distance_thresh=distance_thresh,
+                                       similarity_thresh=similarity_thresh)
+    n = len(names)
+    print("RMSD needed for {} of {} pairs".format(len(pairs_i), n*(n - 1)//2))
+    rms = rmsd_of_pairs(moldict, pairs_i, pairs_j, nproc=nproc)
 
+    order = np.argsort(rms, kind="stable")
+    similarity_sorted = [((names[pairs_i[k]], names[pairs_j[k]]), float(rms[k])) for k in order]
+    to_be_deleted = find_duplicates_in_sorted_similarity_matrix_noncovalent(
+        similarity_sorted, energy, *distances,
+        similarity_thresh=similarity_thresh, energy_thresh=energy_thresh, distance_thresh=distance_thresh,
+        method=method)
+    return to_be_deleted, similarity_sorted
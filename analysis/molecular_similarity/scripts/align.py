@@ -0,0 +1,109 @@
+import numpy as np
+
+from rdkit import Chem
+from rdkit.Geometry import Point3D
+
+# headless alignment of many structures on a common core (no py3Dmol/Jupyter needed)
+
+
+def topology_key(mol):
+    """
+    atoms and bonds of "mol" in atom order; equal keys mean the same topology and atom numbering
+    """
+    atoms = tuple(a.GetAtomicNum() for a in mol.GetAtoms())
+    bonds = tuple(sorted((b.GetBeginAtomIdx(), b.GetEndAtomIdx(), int(b.GetBondType())) for b in mol.GetBonds()))
+    return atoms, bonds
+
+
+class CoreMatcher():
+    """
+    the core pattern compiled once, and its atom match cached per topology,
+    so conformers of the same molecule are matched only once
+    """
+
+    def __init__(self, core_smiles):
+        self.core_smiles = core_smiles
+        self.core = Chem.MolFromSmiles(core_smiles)
+        self.matches = {}
+
+    def match(self, mol):
+        """
+        atom indices of the core in "mol"; ValueError if "mol" does not contain the core
+        """
+        key = topology_key(mol)
+        if key not in self.matches:
+            self.matches[key] = np.array(mol.GetSubstructMatch(self.core), dtype=np.int64)
+        if len(self.matches[key]) == 0:
+            name = mol.GetProp('_Name') if mol.HasProp('_Name') else Chem.MolToSmiles(mol)
+            raise ValueError("core {} not found in {}".format(self.core_smiles, name))
+        return self.matches[key]
+
+
+def get_coordinates(mol, confId=-1):
+    return mol.GetConformer(confId).GetPositions()
+
+
+def set_coordinates(mol, coords, confId=-1):
+    conf = mol.GetConformer(confId)
+    for i, (x, y, z) in enumerate(coords.tolist()):
+        conf.SetAtomPosition(i, Point3D(x, y, z))
+
+
+def align_coordinates(coords, core_idx, ref_core):
+    """
+    rigidly superimpose every structure of "coords" (n_conf, n_atoms, 3) onto the reference core
+    coordinates "ref_core" (n_core, 3), fitting only the atoms "core_idx" (as AllChem.AlignMol
+    with an atom map); all structures are fitted in one batch; returns the aligned coordinates
+    """
+    coords = np.asarray(coords, dtype=float)
+    p = coords[:, core_idx]                                   # (n_conf, n_core, 3)
+    p_center = p.mean(axis=1, keepdims=True)
+    q_center = ref_core.mean(axis=0)
+    h = np.einsum('cak,al->ckl', p - p_center, ref_core - q_center)
+    u, s, vt = np.linalg.svd(h)
+    d = np.sign(np.linalg.det(np.einsum('ckl,clm->ckm', u, vt)))
+    u[:, :, -1] *= d[:, None]                                 # no reflections
+    rot = np.einsum('ckl,clm->ckm', u, vt)                    # row-vector convention: x @ rot
+    aligned = np.einsum('cak,ckl->cal', coords - p_center, rot) + q_center
+    if not np.isfinite(aligned).all():
+        raise ValueError("alignment on {} core atoms gave non-finite coordinates".format(len(core_idx)))
+    return aligned
+
+
+def align_moldict(moldict, core_smiles, ref_mol, inplace=True):
+    """
+    align all structures in "moldict" to a reference structure ("ref_mol"),
+    fitting the atoms of the "core_smiles" pattern; structures sharing a topology are aligned together;
+    returns {name: aligned (n_atoms, 3) coordinates}, and updates the molecules if "inplace"
+    """
+    matcher = CoreMatcher(core_smiles)
+    ref_core = get_coordinates(ref_mol)[matcher.match(ref_mol)]
+
+    groups = {}
+    for key, mol in moldict.items():
+        groups.setdefault(topology_key(mol), []).append(key)
+
+    aligned = {}
+    for names in groups.values():
+        mols = [moldict[k] for k in names]
+        core_idx = matcher.match(mols[0])
+        coords = np.stack([get_coordinates(m) for m in mols])
+        new = align_coordinates(coords, core_idx, ref_core)
+        for k, x in zip(names, new):
+            aligned[k] = x
+
+    # the molecules are changed only once every group was aligned
+    if inplace:
+        for k, x in aligned.items():
+            set_coordinates(moldict[k], x)
+    return aligned
+
+
+def align_moldict_to_lowest_energy(moldict, energy_dict, core_smiles, inplace=True):
+    """
+    as align_moldict, with the lowest-energy structure of "moldict" as the reference
+    """
+    lowest = min((k for k in moldict if k in energy_dict), key=lambda k: energy_dict[k])
+    ref_mol = Chem.Mol(moldict[lowest])
+    return align_moldict(moldict, core_smiles, ref_mol, inplace=inplace)
+
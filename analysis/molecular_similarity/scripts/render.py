@@ -0,0 +1,104 @@
+import py3Dmol
+import numpy as np
+
+from rdkit import Chem
+
+# rendering of many structures (a moldict): they are serialized once to mol blocks,
+# and only a selected subset of frames (a "page") is sent to the browser at a time
+
+
+def moldict_blocks(moldict, heavy_only=False):
+    """
+    mol blocks of all structures of "moldict", in its order
+    """
+    return [Chem.MolToMolBlock(Chem.RemoveHs(m) if heavy_only else m) for m in moldict.values()]
+
+
+def multimodel_block(blocks, frames=None):
+    """
+    one multi-model sdf string of the selected frames (default: all)
+    """
+    frames = range(len(blocks)) if frames is None else frames
+    return "$$$$\n".join(blocks[k] for k in frames) + "$$$$\n"
+
+
+def select_frames(energies, mode="sample", representatives=None, window=None, max_frames=None):
+    """
+    indices of the structures to show (positions in the moldict), sorted by energy:
+    * "representatives" - the given structures (e.g. one per group of similar molecules),
+    * "window"          - structures within "window" (kcal/mol) of the lowest energy,
+    * "sample"          - structures evenly sampled over the energy-sorted list (needs "max_frames"),
+    * "all"             - all structures;
+    "max_frames" limits the number of frames in every mode (the lowest-energy ones are kept,
+    except for "sample")
+    """
+    e = np.asarray(energies, dtype=float)
+    e = np.where(np.isnan(e), np.inf, e)
+    order = np.argsort(e, kind="stable")
+    if mode == "representatives":
+        frames = np.asarray(representatives)
+        frames = frames[np.argsort(e[frames], kind="stable")]
+    elif mode == "window":
+        frames = order[e[order] <= e[order[0]] + window]
+    elif mode == "sample":
+        n = len(order) if max_frames is None else min(max_frames, len(order))
+        frames = order[np.unique(np.linspace(0, len(order) - 1, n).round().astype(int))]
+    elif mode == "all":
+        frames = order
+    else:
+        raise ValueError("unknown frame selection: {}".format(mode))
+    if max_frames is not None:
+        frames = frames[:max_frames]
+    return frames
+
+
+class EnsembleViewer():
+    """
+    paginated overlay of many structures (a moldict {name: mol}):
+
+        energies = [energy_dict[k] for k in moldict]
+        viewer = EnsembleViewer(moldict, frames=select_frames(energies, "window", window=5.0))
+        viewer.page(0).show()       # the first "page_size" frames
+        viewer.next_page().show()   # the next ones
+        viewer.write("overlay.sdf", page=0)   # or save a page to look at it elsewhere
+
+    the structures are serialized once; "heavy_only" drops hydrogens to keep the output small;
+    "page_size=None" shows all selected frames on one page
+    """
+
+    def __init__(self, moldict, frames=None, page_size=20, heavy_only=False, width=400, height=400):
+        self.blocks = moldict_blocks(moldict, heavy_only)
+        self.frames = np.arange(len(self.blocks)) if frames is None else np.asarray(frames)
+        self.page_size = page_size if page_size else max(len(self.frames), 1)
+        self.width = width
+        self.height = height
+        self.current = -1
+
+    def __len__(self):
+        """
+        number of pages
+        """
+        return (len(self.frames) + self.page_size - 1)//self.page_size
+
+    def page_frames(self, k):
+        return self.frames[k*self.page_size:(k + 1)*self.page_size]
+
+    def page(self, k):
+        self.current = k
+        p = py3Dmol.view(width=self.width, height=self.height)
+        p.addModels(multimodel_block(self.blocks, self.page_frames(k)), 'sdf')
+        p.setStyle({'stick':{'radius':'0.15'}})
+        p.setBackgroundColor('0xeeeeee')
+        p.zoomTo()
+        return p
+
+    def next_page(self):
+        return self.page(min(self.current + 1, len(self) - 1))
+
+    def write(self, path, page=None):
+        """
+        write the frames of one page (default: all selected frames) as a multi-model sdf file
+        """
+        frames = self.frames if page is None else self.page_frames(page)
+        with open(path, "w") as f:
+            f.write(multimodel_block(self.blocks, frames))
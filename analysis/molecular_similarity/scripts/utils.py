@@ -7,54 +7,33 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit import rdBase
 
+from .align import align_moldict, align_moldict_to_lowest_energy
+from .render import EnsembleViewer, select_frames
+
 #print(rdBase.rdkitVersion)
 
+def show_molecules(moldict, width=400, height=400, frames=None):
+    """
+    py3Dmol view of the structures in "moldict" (all, or the positions "frames"), added as one
+    multi-model block (rendering only, see align.py for the alignment and render.py for large ensembles)
+    """
+    return EnsembleViewer(moldict, frames=frames, page_size=None, width=width, height=height).page(0)
+
+
 def align_structures_to_lowest_energy_and_show(moldict, energy_dict, core_smiles):
     """
-    align all structures in "moldict" to the one of the lowest energy
-    todo (work on the code):
-    * separate the alignment step from the visualization
-    * modularize/turn into a library of utils
+    align all structures in "moldict" to the one of the lowest energy and show them;
+    the alignment itself is align.align_moldict_to_lowest_energy (usable without Jupyter)
     """
-    energy_sorted = sorted(energy_dict.items(), key=lambda x: x[1])
-    lowest = energy_sorted[0][0]
-    core_lowest = moldict[lowest].GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-    
-    for key, mol in moldict.items():
-        match_mol_to_core = mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-        AllChem.AlignMol(mol,moldict[lowest],atomMap=list(zip(match_mol_to_core,core_lowest)))
-        
-    p = py3Dmol.view(width=400,height=400)
-    for key, mol in moldict.items(): 
-        mb = Chem.MolToMolBlock(mol)
-        p.addModel(mb,'sdf')
-    p.setStyle({'stick':{'radius':'0.15'}})
-    p.setBackgroundColor('0xeeeeee')
-    p.zoomTo()
-    return p
+    align_moldict_to_lowest_energy(moldict, energy_dict, core_smiles)
+    return show_molecules(moldict)
 
 
 def align_and_show(moldict, core_smiles, ref_mol):
     """
     align all structures in "moldict" to a reference structure ("ref_mol"), 
-    "core_smiles" provides a molecular pattern to prioritize in this alignment ("core_smiles")
-    todo (work on the code):
-    * separate the alignment step from the visualization
-    * modularize/turn into a library of utils
+    "core_smiles" provides a molecular pattern to prioritize in this alignment ("core_smiles");
+    the alignment itself is align.align_moldict (usable without Jupyter)
     """ 
-    match_ref_to_core = ref_mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-    for key, mol in moldict.items():    
-        match_mol_to_core = mol.GetSubstructMatch(Chem.MolFromSmiles(core_smiles))
-        AllChem.AlignMol(mol,ref_mol,atomMap=list(zip(match_mol_to_core,match_ref_to_core)))
-    
-    p = py3Dmol.view(width=400,height=400)
-    for key, mol in moldict.items(): 
-        mb = Chem.MolToMolBlock(mol)
-        p.addModel(mb,'sdf')
-    p.setStyle({'stick':{'radius':'0.15'}})
-    p.setBackgroundColor('0xeeeeee')
-    p.zoomTo()
-    return p 
-
-
-
+    align_moldict(moldict, core_smiles, ref_mol)
+    return show_molecules(moldict)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# the steps of run_dc/run_ll as a dependency graph instead of one serial job:
+#   scf --outcmo  ->  shielding --incmo
+#                 ->  spinspin  --incmo
+# every step gets a directory of its own (<workdir>/<step>) with a run script sized for this step alone;
+# the response steps only need the SCF coefficients, so they depend on scf (afterok) but not on each other
+# and run at the same time; their DFCOEF is a symlink to the one written by scf (not a copy)
+#
+# backends:
+#   slurm - "sbatch --parsable [--dependency=afterok:<id>]" for every step (--sbatch for another command,
+#           e.g. the local stand-in workflows/test_scripts/scripts/local/fake_sbatch.py);
+#   local - the steps run on this machine, as soon as the steps they depend on succeeded and their
+#           cores (--cores in total) are free; the run scripts run as they are (--errexit: bash -e),
+#           --fake_cluster replaces only srun and module (srun runs its command, module does nothing) and
+#           --fake also pam-dirac, with the stand-ins of workflows/test_scripts/scripts/local/fake_sbatch.py
+#
+# usage: python pipeline.py --hamiltonian dc [--backend local --cores 8 [--fake_cluster] [--errexit]] [--dry_run]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+here = Path(__file__).parent.absolute()
+fake_sbatch_dir = here.parent.joinpath('workflows', 'test_scripts', 'scripts', 'local')
+
+coefficients = 'DFCOEF'
+
+
+class Step():
+
+    def __init__(self, name, inp, depends=(), ntasks=8, time='72:00:00', mem_per_cpu='5GB', cmo=None):
+        self.name = name
+        self.inp = inp
+        self.depends = list(depends)
+        self.ntasks = ntasks
+        self.time = time
+        self.mem_per_cpu = mem_per_cpu
+        # "--outcmo" (writes the coefficients), "--incmo" (reads them) or None
+        self.cmo = cmo
+
+
+def dirac_steps(hamiltonian, scf_ntasks=8, scf_time='24:00:00', response_ntasks=4, response_time='48:00:00'):
+    """
+    steps of run_dc (hamiltonian "dc") or run_ll ("ll")
+    """
+    return [Step('scf', '{}.inp'.format(hamiltonian), ntasks=scf_ntasks, time=scf_time, cmo='--outcmo'),
+            Step('shielding', 'shielding_{}.inp'.format(hamiltonian), ['scf'], response_ntasks, response_time, cmo='--incmo'),
+            Step('spinspin', 'spinspin_{}.inp'.format(hamiltonian), ['scf'], response_ntasks, response_time, cmo='--incmo')]
+
+
+def topological_order(steps):
+    """
+    steps sorted so that every step comes after the steps it depends on
+    """
+    by_name = {s.name: s for s in steps}
+    order, state = [], {}
+
+    def visit(step):
+        if state.get(step.name) == 'done':
+            return
+        if state.get(step.name) == 'visiting':
+            sys.exit("dependency cycle at step {}".format(step.name))
+        state[step.name] = 'visiting'
+        for dep in step.depends:
+            if dep not in by_name:
+                sys.exit("step {} depends on an unknown step {}".format(step.name, dep))
+            visit(by_name[dep])
+        state[step.name] = 'done'
+        order.append(step)
+
+    for step in steps:
+        visit(step)
+    return order
+
+
+def step_script(step, mol, scratch, account, partition, job_name):
+    return ''.join([
+        '#!/bin/bash -l\n',
+        '#SBATCH -J {}_{}\n'.format(job_name, step.name),
+        '#SBATCH -N 1\n',
+        '#SBATCH --ntasks-per-node={}\n'.format(step.ntasks),
+        '#SBATCH --mem-per-cpu={}\n'.format(step.mem_per_cpu),
+        '#SBATCH --time={}\n'.format(step.time),
+        '#SBATCH -A {}\n'.format(account),
+        '#SBATCH -p {}\n'.format(partition),
+        '#SBATCH --output="output.out"\n',
+        '#SBATCH --error="error.err"\n',
+        '\n',
+        'inp={}\n'.format(step.inp),
+        'mol={}\n'.format(mol),
+        '\n',
+        'scratch={}/{}\n'.format(scratch, step.name),
+        'mkdir -p $scratch\n',
+        '\n',
+        'cd $SLURM_SUBMIT_DIR\n',
+        '\n',
+        'srun /bin/hostname\n',
+        '\n',
+        'module purge\n',
+        'module load dirac/23.0-intel-2023a-int64\n',
+        '\n',
+        'pam-dirac --scratch=$scratch --noarch --mw=2900 --aw=1900 --mpi=$SLURM_NPROCS --inp=$inp --mol=$mol{}\n'.format(
+            ' ' + step.cmo if step.cmo else ''),
+    ])
+
+
+def symlink(target, link):
+    link = Path(link)
+    if link.is_symlink() or link.exists():
+        link.unlink()
+    os.symlink(target, link)
+
+
+def prepare(steps, workdir, inpdir, mol, **script_options):
+    """
+    step directories with their run script and links to the input, the geometry and
+    (for "--incmo" steps) the coefficients of the "--outcmo" step they depend on
+    """
+    workdir = Path(workdir).absolute()
+    by_name = {s.name: s for s in steps}
+    for step in steps:
+        step_dir = workdir.joinpath(step.name)
+        step_dir.mkdir(parents=True, exist_ok=True)
+        symlink(Path(inpdir).absolute().joinpath(step.inp), step_dir.joinpath(step.inp))
+        symlink(Path(mol).absolute(), step_dir.joinpath(Path(mol).name))
+        if step.cmo == '--incmo':
+            source = [d for d in step.depends if by_name[d].cmo == '--outcmo']
+            if not source:
+                sys.exit("step {} reads coefficients but depends on no step writing them".format(step.name))
+            # relative link, valid before the coefficients exist and after moving the work directory
+            symlink(Path('..', source[0], coefficients), step_dir.joinpath(coefficients))
+        with open(step_dir.joinpath('run.sh'), "w") as f:
+            f.write(step_script(step, Path(mol).name, **script_options))
+        os.chmod(step_dir.joinpath('run.sh'), 0o755)
+    return workdir
+
+
+def submit_slurm(steps, workdir, sbatch='sbatch', verbose=True):
+    """
+    submit every step with afterok dependencies on the job ids of the steps it depends on;
+    returns {step name: job id}
+    """
+    ids = {}
+    # one job registry of the local stand-in for all step directories (ignored by sbatch)
+    env = dict(os.environ)
+    env.setdefault('FAKE_SBATCH_DIR', str(workdir.joinpath('.fake_sbatch')))
+    for step in topological_order(steps):
+        cmd = sbatch.split() + ['--parsable']
+        if step.depends:
+            cmd.append('--dependency=afterok:' + ':'.join(ids[d] for d in step.depends))
+        cmd.append('run.sh')
+        p = subprocess.run(cmd, cwd=workdir.joinpath(step.name), env=env, stdout=subprocess.PIPE, universal_newlines=True)
+        if p.returncode != 0:
+            sys.exit("submitting step {} failed".format(step.name))
+        # "--parsable" prints "<job id>[;<cluster>]"
+        ids[step.name] = p.stdout.strip().splitlines()[-1].split(';')[0]
+        if verbose:
+            print("{:<10} job {} {}".format(step.name, ids[step.name], cmd[len(sbatch.split()) + 1:-1]))
+    return ids
+
+
+def local_stubs(mode):
+    """
+    directory with the stand-ins of fake_sbatch.make_stubs ("all" or "cluster"), to put first in PATH
+    """
+    sys.path.insert(0, str(fake_sbatch_dir))
+    from fake_sbatch import make_stubs
+    return make_stubs(tempfile.mkdtemp(prefix='pipeline_stubs_'), mode)
+
+
+def run_local(steps, workdir, cores, env=None, errexit=False, verbose=True):
+    """
+    run the steps on this machine: a step starts once all the steps it depends on succeeded and its cores are
+    free (a step asking for more than "cores" gets all of them); steps after a failed one are skipped;
+    with "errexit" a failing command of a run script fails its step (bash -e);
+    returns {step name: "done" | "failed" | "skipped"}
+    """
+    env = dict(os.environ if env is None else env)
+    env.setdefault('SCRATCH', str(workdir.joinpath('.scratch')))
+    status = {}
+    pending = topological_order(steps)
+    running = {}
+    free = cores
+
+    def run(step, ntasks):
+        step_dir = workdir.joinpath(step.name)
+        step_env = dict(env, SLURM_SUBMIT_DIR=str(step_dir), SLURM_NPROCS=str(ntasks))
+        with open(step_dir.joinpath('output.out'), "w") as fout, open(step_dir.joinpath('error.err'), "w") as ferr:
+            cmd = ['bash'] + (['-e'] if errexit else []) + ['run.sh']
+            return subprocess.run(cmd, cwd=step_dir, env=step_env, stdout=fout, stderr=ferr).returncode
+
+    with ThreadPoolExecutor(max_workers=max(1, len(steps))) as pool:
+        while pending or running:
+            for step in list(pending):
+                if any(status.get(d) in ('failed', 'skipped') for d in step.depends):
+                    pending.remove(step)
+                    status[step.name] = 'skipped'
+                    continue
+                ntasks = min(step.ntasks, cores)
+                if all(status.get(d) == 'done' for d in step.depends) and ntasks <= free:
+                    pending.remove(step)
+                    free -= ntasks
+                    running[pool.submit(run, step, ntasks)] = (step, ntasks, time.time())
+                    if verbose:
+                        print("started  {} ({} cores)".format(step.name, ntasks))
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, ntasks, start = running.pop(future)
+                free += ntasks
+                status[step.name] = 'done' if future.result() == 0 else 'failed'
+                if verbose:
+                    print("finished {} ({}, {:.1f} s)".format(step.name, status[step.name], time.time() - start))
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the DIRAC SCF and response steps as a dependency graph of jobs")
+    parser.add_argument("--hamiltonian", default="dc", choices=["dc", "ll"])
+    parser.add_argument("--mol", default=str(here.joinpath('coordinates', 'h2o.xyz')))
+    parser.add_argument("--inpdir", default=str(here), help="directory with the input files")
+    parser.add_argument("--workdir", help="directory of the step directories (default: pipeline_<hamiltonian>)")
+    parser.add_argument("--scf_ntasks", type=int, default=8)
+    parser.add_argument("--scf_time", default="24:00:00")
+    parser.add_argument("--response_ntasks", type=int, default=4)
+    parser.add_argument("--response_time", default="48:00:00")
+    parser.add_argument("--account", default="plgqcembed-cpu")
+    parser.add_argument("--partition", default="plgrid")
+    parser.add_argument("--backend", default="slurm", choices=["slurm", "local"])
+    parser.add_argument("--sbatch", default="sbatch", help="submission command of the slurm backend")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="cores of the local backend")
+    fake = parser.add_mutually_exclusive_group()
+    fake.add_argument("--fake", action="store_true", help="local backend: stand-ins for srun, module and pam-dirac")
+    fake.add_argument("--fake_cluster", action="store_true",
+                      help="local backend: stand-ins only for srun (runs its command) and module (no-op)")
+    parser.add_argument("--errexit", action="store_true", help="local backend: a failing command fails the step (bash -e)")
+    parser.add_argument("--dry_run", action="store_true", help="only prepare the step directories")
+    args = parser.parse_args()
+
+    steps = dirac_steps(args.hamiltonian, args.scf_ntasks, args.scf_time, args.response_ntasks, args.response_time)
+    workdir = prepare(steps, args.workdir or 'pipeline_{}'.format(args.hamiltonian), args.inpdir, args.mol,
+                      scratch='$SCRATCH/dirac_tests/simple-{}'.format(args.hamiltonian),
+                      account=args.account, partition=args.partition, job_name='dirac_test')
+
+    if args.dry_run:
+        for step in topological_order(steps):
+            print("{:<10} {:>3} cores {:>9}  after {}".format(step.name, step.ntasks, step.time, ', '.join(step.depends) or '-'))
+    elif args.backend == 'slurm':
+        submit_slurm(steps, workdir, args.sbatch)
+    else:
+        env = dict(os.environ)
+        if args.fake or args.fake_cluster:
+            env['PATH'] = str(local_stubs('all' if args.fake else 'cluster')) + os.pathsep + env['PATH']
+        status = run_local(steps, workdir, args.cores, env, args.errexit)
+        for name, s in status.items():
+            print("{:<10} {}".format(name, s))
+        sys.exit(0 if all(s == 'done' for s in status.values()) else 1)
@@ -2,14 +2,21 @@
 
 import os
 import sys
+import json
 import shutil
 import argparse
 import subprocess
 from pathlib import PurePath, Path
-from mendeleev.fetch import fetch_table
 
 assert sys.version_info >= (3, 8)
 
+# shared workflow helpers (scripts/common)
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from common.manifest import load_manifest, find_geometry, find_geometries
+from common.templates import TemplateDir, output, write_outputs, state_filename
+from common.jobarray import read_jobs, merge_jobs, array_outputs, stale_array_scripts
+from common import result_cache
+
 # -------------------------------------------------------------------
 # THIS PART CAN BE MODIFIED
 # -------------------------------------------------------------------
@@ -62,13 +69,27 @@ def parse_input_options():
     parser.add_argument("--subdirs",      nargs='*', choices=subdirs)
     parser.add_argument("--functions",    nargs='*', choices=scalar_field_dep_on_dfcoef)
     parser.add_argument("--visgrid_cube")
+    parser.add_argument("--nthreads", type=int, default=8, help="number of files written in parallel")
+    parser.add_argument("--dry_run", action="store_true", help="only list the files that would be written")
+    parser.add_argument("--array_max_concurrent", type=int, default=0, help="maximum number of array tasks running at once (0: no limit)")
+    parser.add_argument("--result_cache", default=os.environ.get('QC_RESULT_CACHE'),
+                        help="cache of finished calculations (default: basedir/" + result_cache.cache_filename + "; none: no cache)")
+    parser.add_argument("--cache_hits", default="skip", choices=["skip", "link", "rerun"],
+                        help="run directories whose calculation finished elsewhere: not prepared, prepared with links to the results, or run again")
     args   = parser.parse_args()
     for k in args.__dict__:
         print(k, args.__dict__[k])
     return args
 
 
-def modify_lines(g, lines, molname, data_dir_in_scratch, ndim, vis_scfield, plotfilename, \
+# names of all patterns in the templates
+pattern_keys = ["cluster_ntasks", "cluster_timeh", "cluster_part",
+                "molname", "ndim", "scalar_field_dep_on_dfcoef", "data_dir_in_scratch", "plotfilename",
+                "dfcoef_model", "c_val", "choice_of_basis", "choice_of_hamiltonian", "choice_of_dftfun",
+                "charge_mol", "nr_of_closed_shell"]
+
+
+def get_patterns(molname, data_dir_in_scratch, ndim, vis_scfield, plotfilename, \
                  cluster_ntasks=None,cluster_timeh=None,cluster_part=None, \
                  basis=None, hamiltonian=None, dftfun=None, nr_cs=None, charge=None, dfcoef_model=None,cvalue=None):
 
@@ -85,7 +106,7 @@ def modify_lines(g, lines, molname, data_dir_in_scratch, ndim, vis_scfield, plot
     patterns["plotfilename"] = plotfilename
 
     patterns["dfcoef_model"] = dfcoef_model
-    patterns["c_val"] = str(cvalue)
+    patterns["c_val"] = str(cvalue) if cvalue is not None else None
     patterns["choice_of_basis"] = basis
     if hamiltonian == 'dc':
         patterns["choice_of_hamiltonian"] = 'remove'
@@ -94,32 +115,32 @@ def modify_lines(g, lines, molname, data_dir_in_scratch, ndim, vis_scfield, plot
     patterns["choice_of_dftfun"] = dftfun
     patterns["charge_mol"] = str(charge)
     patterns["nr_of_closed_shell"] = str(nr_cs)
-
-    for l in lines:
-        for k, v in patterns.items():
-            if v:
-                l = l.replace(k, v)
-        if 'remove' not in l:
-            g.write(l)
-
-
-def modify_run_templates(path, tpl_file, final_file, mol, scratch, ndim, vis_scfield, plotfilename, cluster_ntasks, cluster_timeh, cluster_part, dfcoef_model):
-    res_file = final_file
-    with open(os.path.join(path, tpl_file), "r") as f:
-        lines = f.readlines()
-        with open(os.path.join(path, res_file), "w") as g:
-            modify_lines(g, lines, mol, scratch, ndim, vis_scfield, plotfilename, \
-                        cluster_ntasks, cluster_timeh, cluster_part, dfcoef_model=dfcoef_model)
-
-
-def modify_inp_templates(path, tpl_file, final_file, mol, ndim, vis_scfield, basis, hamiltonian, dftfun, nr_cs, charge):
-    res_file = final_file
-    with open(os.path.join(path, tpl_file), "r") as f:
-        lines = f.readlines()
-        with open(os.path.join(path, res_file), "w") as g:
-            modify_lines(g, lines, mol, None, ndim, vis_scfield, None, \
-                         None, None, None, \
-                         basis, hamiltonian, dftfun, nr_cs, charge)
+    return patterns
+
+
+def run_dir_outputs(tpl, run_dir, cluster, functions, run_patterns, inp_patterns, ndim):
+    """
+    rendered files of one run directory: the run script of "cluster", scf input, visualization inputs
+    (one per function), the outputs declared for the result cache and all non-template files of the template directory
+    """
+    outs = []
+    for rel, (data, mode) in tpl.static.items():
+        outs.append(output(PurePath.joinpath(run_dir, rel), data, mode))
+    for rel in tpl.find('template_run_scf_'+cluster):
+        t = tpl.templates[rel]
+        outs.append(output(PurePath.joinpath(run_dir, rel.parent, 'run_scf.sh'), t.render(run_patterns), t.mode))
+    for rel in tpl.find('template_scf.inp'):
+        t = tpl.templates[rel]
+        outs.append(output(PurePath.joinpath(run_dir, rel.parent, 'scf.inp'), t.render(inp_patterns), t.mode))
+    for rel in tpl.find('template_scalar_field_dep_on_dfcoef.inp'):
+        t = tpl.templates[rel]
+        for f in functions:
+            name = f+'_visgrid_cube_'+ndim+'.inp'
+            outs.append(output(PurePath.joinpath(run_dir, rel.parent, name), t.render(dict(inp_patterns, scalar_field_dep_on_dfcoef=f)), t.mode))
+    for rel in tpl.find('template_qc_outputs'):
+        t = tpl.templates[rel]
+        outs.append(output(PurePath.joinpath(run_dir, rel.parent, result_cache.outputs_filename), t.render(run_patterns), t.mode))
+    return outs
 
 
 def prepare_grid_for_fde(tpl_file, res_file, ndim):
@@ -134,64 +155,32 @@ def prepare_grid_for_fde(tpl_file, res_file, ndim):
                 grid=line.split()
                 g.write('{}   {}   {}   0.0 \n'.format(grid[0], grid[1], grid[2]))
 
-def get_closed_shell_el(coor_dir):
-    # we are using mendeleev code here
-    ptable = fetch_table('elements')
-    cols= ['atomic_number', 'symbol'] 
-
-    closed_shell_el = {}
-    fmols = []
-    for f in Path(coor_dir).rglob('*.xyz'):
-        fmols.append(f)
-    fmols = list(dict.fromkeys(fmols))
-    for fmol in fmols:
-        name = os.path.splitext(os.path.basename(fmol))[0]
-        nr_electrons = 0
-        with open(fmol, "r") as f:
-            lines  = f.readlines()
-            for line in lines[2:]:
-                info = line.strip().split(" ")
-                el_this=info[0].strip()
-                if el_this.isdigit():
-                    atnum = int(el_this)
-                else:
-                    atnum = ptable.loc[ptable['symbol'].str.contains(el_this,case=False), 'atomic_number'].values[0]
-                nr_electrons = nr_electrons+int(atnum)
-        closed_shell_el[name] = nr_electrons
-    return closed_shell_el
-
-def get_charges(coor_dir):
-    charge = {}
-    fmols = []
-    for f in Path(coor_dir).rglob('*.xyz'):
-        fmols.append(f)
-    fmols = list(dict.fromkeys(fmols))
-    for fmol in fmols:
-        name = os.path.splitext(os.path.basename(fmol))[0]
-        with open(fmol, "r") as f:
-            lines  = f.readlines()
-            info   = lines[1].strip().split(";")
-            charge[name] = info[0].split("=")[1]
-    return charge
+def get_molecule(manifest, basedir, mol, mol_dir):
+    # geometry of "mol" from the coordinate manifest: preferably from this molecule directory, else anywhere in basedir
+    found = find_geometries(manifest, [mol], under=mol_dir, root=basedir)
+    return found[0] if found else find_geometry(manifest, mol, root=basedir)
 
 
 
 
 # parse options
 args=parse_input_options()
-explorations_dir=Path(args.basedir)
+explorations_dir=Path(args.basedir).absolute()
 
 # make mol directory
 mol_dir = Path().resolve()
 scratch_specific=mol_dir.name
 
-coor_dir = PurePath.joinpath(mol_dir, mol_dirname)
+# all geometries are parsed once into a manifest kept in basedir (see common/manifest.py)
+manifest = load_manifest(explorations_dir, mol_dirname)
+molecule = get_molecule(manifest, explorations_dir, args.mol, mol_dir)
 charge={}
-if args.charge:
-    charge[args.mol]=args.charge
-else:
-    charge = get_charges(PurePath.joinpath(up, mol_dirname))
-closed_shell_el = get_closed_shell_el(Path(mol_dirname).resolve())
+closed_shell_el={}
+charge[args.mol] = args.charge if args.charge is not None else molecule['charge']
+if charge[args.mol] is None:
+    sys.exit("no charge of {}: give --charge or put it in the comment line of {}".format(args.mol, molecule['path']))
+closed_shell_el[args.mol] = molecule['electrons']
+geometries = find_geometries(manifest, [args.mol, 'geom'], under=PurePath.joinpath(mol_dir, mol_dirname), root=explorations_dir)
 
 methods = []
 if args.runtype == 'dft':
@@ -200,7 +189,33 @@ else:
     methods.append(args.runtype)
 
 
-# make mol subdirectories
+# finished calculations of this tree (and of other projects sharing the cache file); only the jobs of the
+# manifest can have finished since the last call ("result_cache.py scan" walks the whole tree)
+cache = None
+if args.result_cache != 'none':
+    cache_file = result_cache.cache_path(explorations_dir, args.result_cache)
+    cache = result_cache.load_cache(cache_file)
+    if result_cache.update(cache, [j['run_dir'] for j in read_jobs(explorations_dir)]) and not args.dry_run:
+        result_cache.save_cache(cache_file, cache)
+
+# every template file is read and compiled once for the whole model matrix
+tpl = TemplateDir(tmpl_dir_dirac[args.runtype], pattern_keys)
+# the one geometry of the run directories (written as <mol>.xyz and keyed): <mol>.xyz or geom.xyz below coordinates/,
+# copies of it are fine, different geometries are ambiguous
+if len({g['sha256'] for g in geometries}) > 1:
+    sys.exit("different geometries of {}: {}".format(args.mol, ', '.join(sorted(g['path'] for g in geometries))))
+geometries = sorted(geometries, key=lambda g: (g['name'] != args.mol, g['path']))
+geometry_data = Path(geometries[0]['path']).read_bytes() if geometries else None
+
+print('args.mol ', args.mol)
+print('charge[args.mol] ', charge[args.mol])
+print('closed_shell_el[args.mol] ', closed_shell_el[args.mol])
+
+# render all run directories (model matrix)
+outputs = []
+jobs = []
+links = []
+cached = {}
 for h in args.hamiltonians:
     for d in methods:
         for b in args.basis_sets:
@@ -211,53 +226,64 @@ for h in args.hamiltonians:
                 else:
                     scratch_name = scratch_base+'/'+str(scratch_specific)+'/'+args.software+'/'+model+'/'+t
 
-                # copy and prepare runscripts
                 run_dir = PurePath.joinpath(mol_dir, args.software, model, t)
-                shutil.copytree(tmpl_dir_dirac[args.runtype], run_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns("inprep"))
-
                 dfcoef_model=h+'_hf_'+b.replace('.','')
 
-                r0 = 'template_run_scf_'+args.cluster
-                r1 = 'run_scf.sh'
-                modify_run_templates(run_dir, r0, r1, args.mol, scratch_name, args.visgrid_cube, None, None, \
-                                     args.cluster_ntasks, args.cluster_timeh, args.cluster_part, \
-                                     dfcoef_model=dfcoef_model)
-                Path(PurePath.joinpath(run_dir, r0)).unlink()
-
-                #Path(PurePath.joinpath(run_dir, r0)).unlink()
-                for fl in os.listdir(run_dir):
-                    if 'template' in fl:
-                        Path(PurePath.joinpath(run_dir, fl)).unlink()
-
-                # copy and prepare inputs
-                run_dir = PurePath.joinpath(mol_dir, args.software, model, t)
-                inp_dir = PurePath.joinpath(run_dir, inp_dirname)
-                if d == 'dft':
-                    r0 = 'template_scf.inp'
-                    r1 = 'scf.inp'
-                print('args.mol ', args.mol)
-                print('charge[args.mol] ', charge[args.mol])
-                print('closed_shell_el[args.mol] ', closed_shell_el[args.mol])
-                modify_inp_templates(inp_dir, r0, r1, args.mol, args.visgrid_cube, None, b, h, d, closed_shell_el[args.mol], charge[args.mol])
-                #Path(PurePath.joinpath(inp_dir, r0)).unlink()
-                for fl in os.listdir(inp_dir):
-                    if 'template' in fl:
-                        Path(PurePath.joinpath(inp_dir, fl)).unlink()
-
-
-                run_dir = PurePath.joinpath(mol_dir, args.software, model, t)
-                inp_dir = PurePath.joinpath(run_dir, inp_dirname, vis_dirname)
-                r0 = 'template_scalar_field_dep_on_dfcoef.inp'
-                for f in args.functions:
-                    r1 = f+'_visgrid_cube_'+args.visgrid_cube+'.inp'
-                    modify_inp_templates(inp_dir, r0, r1, args.mol, args.visgrid_cube, f, b, h, d, closed_shell_el[args.mol], charge[args.mol])
-                #Path(PurePath.joinpath(inp_dir, r0)).unlink()
-                for fl in os.listdir(inp_dir):
-                    if 'template' in fl:
-                        Path(PurePath.joinpath(inp_dir, fl)).unlink()
-
-                # copy geom
-                for f in Path( PurePath.joinpath(mol_dir, mol_dirname) ).rglob('*.xyz'):
-                    if (os.path.splitext(os.path.basename(f))[0] == args.mol) or (os.path.splitext(os.path.basename(f))[0] == 'geom'):
-                        shutil.copy(f, PurePath.joinpath(run_dir, args.mol+'.xyz'))
-
+                run_patterns = get_patterns(args.mol, scratch_name, args.visgrid_cube, None, None, \
+                                            args.cluster_ntasks, args.cluster_timeh, args.cluster_part, \
+                                            dfcoef_model=dfcoef_model)
+                inp_patterns = get_patterns(args.mol, None, args.visgrid_cube, None, None, \
+                                            None, None, None, \
+                                            b, h, d, closed_shell_el[args.mol], charge[args.mol], cvalue=args.cvalue)
+                run_outputs = run_dir_outputs(tpl, run_dir, args.cluster, args.functions or [], run_patterns, inp_patterns, args.visgrid_cube)
+
+                # geometry
+                if geometry_data is not None:
+                    run_outputs.append(output(PurePath.joinpath(run_dir, args.mol+'.xyz'), geometry_data))
+
+                # key of the calculation: model, charge, scf input and geometry
+                params = {'software': args.software, 'hamiltonian': h, 'method': d, 'basis': b, 'charge': charge[args.mol]}
+                inputs = {path.name: data for path, data, mode in run_outputs if path.name == 'scf.inp'}
+                key = result_cache.result_key(params, inputs, geometry_data or b'')
+                run_outputs.append(output(PurePath.joinpath(run_dir, result_cache.key_filename), key + '\n'))
+                run_outputs.append(output(PurePath.joinpath(run_dir, result_cache.params_filename), json.dumps(params, sort_keys=True) + '\n'))
+
+                hit = result_cache.lookup(cache, key) if cache is not None and args.cache_hits != 'rerun' else None
+                if hit is not None and hit['run_dir'] != str(run_dir):
+                    cached[str(run_dir)] = hit['run_dir']
+                    if args.cache_hits == 'skip':
+                        continue
+                    links.append((hit, run_dir))
+                outputs += run_outputs
+
+                if hit is None:
+                    jobs.append({'run_dir': str(run_dir), 'script': 'run_scf.sh', 'mol': args.mol,
+                                 'software': args.software, 'model': model, 'subdir': t})
+
+# write new and changed files only
+statuses = write_outputs(outputs, PurePath.joinpath(mol_dir, state_filename), args.nthreads, args.dry_run)
+for run_dir, source in sorted(cached.items()):
+    print('{} {}: {}'.format('linked' if args.cache_hits == 'link' else 'skipped', run_dir, source))
+if not args.dry_run:
+    for hit, run_dir in links:
+        result_cache.link_result(hit, run_dir)
+
+# job arrays (jobs_manifest.json, jobs.txt, run_array.sh & co. in basedir) for the run directories of all molecules,
+# without the finished ones and the cache hits of this call (a skipped run directory is never finished itself);
+# array scripts of an earlier call that are no longer needed are removed
+all_jobs = [j for j in merge_jobs(read_jobs(explorations_dir), jobs)
+            if j['run_dir'] not in cached and result_cache.finished_key(j['run_dir']) is None]
+array_outs = array_outputs(explorations_dir, all_jobs, args.array_max_concurrent)
+statuses += write_outputs(array_outs, None, args.nthreads, args.dry_run)
+for stale in stale_array_scripts(explorations_dir, array_outs):
+    if not args.dry_run:
+        stale.unlink()
+    statuses.append((stale, 'removed'))
+if not args.dry_run:
+    Path(explorations_dir).joinpath('array_logs').mkdir(exist_ok=True)
+counts = {}
+for path, status in statuses:
+    counts[status] = counts.get(status, 0) + 1
+    if args.dry_run and status != 'unchanged':
+        print(status, path)
+print(', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items())) + (' (dry run)' if args.dry_run else ''))
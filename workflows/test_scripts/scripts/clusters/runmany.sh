@@ -4,7 +4,16 @@ here=`pwd`
 base_dir=$here/jobs/project_name
 local_dir=$base_dir/explorations
 
+# sbatch command; for a local test run use the stand-in scheduler:
+#   SBATCH="python scripts/local/fake_sbatch.py" ./runmany.sh
+sbatch=${SBATCH:-sbatch}
+
 # ---- adapt -------
+# "array": submit the job arrays prepared by prepare_hpc.py ($local_dir/run_array.sh, and run_array_2.sh & co.
+#          for run scripts with other resources)
+# "loop":  submit the run script of every directory below
+mode=array
+run_script=run_scf.sh
 mol_names=()
 softwares=()
 models=()
@@ -12,6 +21,25 @@ groups=()
 # ------------------
 
 
+if [ "$mode" == "array" ]
+then
+  cd $local_dir
+  # an empty jobs.txt: every run directory is finished
+  if [ ! -s jobs.txt ]
+  then
+    echo "nothing to submit: $local_dir/jobs.txt is empty"
+    cd $here
+    exit
+  fi
+  mkdir -p array_logs
+  for array_script in run_array*.sh
+  do
+    $sbatch $array_script
+  done
+  cd $here
+  exit
+fi
+
 for m in ${mol_names[*]}
   do
   for s in ${softwares[*]}
@@ -23,7 +51,13 @@ for m in ${mol_names[*]}
           calcdir=$local_dir/$m/$s/$t/$g
           cd $calcdir
           chmod u+x run_*
-          sbatch run_prep
+          # finished for the current input (see scripts/common/result_cache.py)
+          if [ -f .qc_done ] && cmp -s .qc_done .qc_key
+          then
+            echo "finished: $calcdir"
+          else
+            $sbatch $run_script
+          fi
           cd $local_dir
         done
       done
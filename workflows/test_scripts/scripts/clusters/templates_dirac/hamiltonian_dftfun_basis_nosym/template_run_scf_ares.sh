@@ -33,10 +33,22 @@ module load dirac-master-public
 mol=molname.xyz
 inp_dir=inputs
 inp_scf=$inp_dir/scf.inp
+# output of pam: <input>_<molecule>.out
+out_scf=scf_molname.out
 
 echo "#--- Job started at `date`"
 pam --scratchfull=$scratch --mw=900 --nw=900 --ag=20 --mpi=$SLURM_NPROCS \
     --inp=$inp_scf --mol=$mol \
     --get="CHECKPOINT.h5=$bin_dir/CHECKPOINT.h5"
+pam_status=$?
 
 echo "#--- Job ended at `date`"
+
+# mark the calculation as finished for the result cache (see scripts/common/result_cache.py;
+# the checkpoint in $bin_dir is declared in .qc_outputs): only after a normal end of DIRAC that wrote
+# the checkpoint, never with the stand-ins of scripts/local/fake_sbatch.py (FAKE_STUB=1)
+if [ $pam_status -eq 0 ] && [ -z "$FAKE_STUB" ] && [ -s $bin_dir/CHECKPOINT.h5 ] \
+   && grep -qsE "exit +: +normal" $out_scf
+then
+    cp .qc_key .qc_done
+fi
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# static table of chemical elements (no database or pandas needed at run time)
+
+import re
+import numpy as np
+
+
+symbols = [
+    'H',                                                                                  'He',
+    'Li', 'Be',                                                  'B',  'C',  'N',  'O',  'F',  'Ne',
+    'Na', 'Mg',                                                  'Al', 'Si', 'P',  'S',  'Cl', 'Ar',
+    'K',  'Ca', 'Sc', 'Ti', 'V',  'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn',
+                                                                 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr',
+    'Rb', 'Sr', 'Y',  'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd',
+                                                                 'In', 'Sn', 'Sb', 'Te', 'I',  'Xe',
+    'Cs', 'Ba',
+    'La', 'Ce', 'Pr', 'Nd', 'Pm', 'Sm', 'Eu', 'Gd', 'Tb', 'Dy', 'Ho', 'Er', 'Tm', 'Yb', 'Lu',
+                'Hf', 'Ta', 'W',  'Re', 'Os', 'Ir', 'Pt', 'Au', 'Hg',
+                                                                 'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn',
+    'Fr', 'Ra',
+    'Ac', 'Th', 'Pa', 'U',  'Np', 'Pu', 'Am', 'Cm', 'Bk', 'Cf', 'Es', 'Fm', 'Md', 'No', 'Lr',
+                'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt', 'Ds', 'Rg', 'Cn',
+                                                                 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og',
+]
+
+# symbol -> atomic number
+atomic_numbers = {s: z for z, s in enumerate(symbols, start=1)}
+
+# atom label in a coordinate file: an element symbol (any case) or an atomic number,
+# optionally followed by a non-letter tag, e.g. "C", "cl", "O1", "H_a", "8"
+label = re.compile(r"^\s*(?:(\d+)|([A-Za-z]+))")
+
+
+def atomic_number(atom_label):
+    """
+    atomic number of an atom label: the exact element symbol (case-insensitive) or the atomic number itself
+    """
+    m = label.match(atom_label)
+    if m is None:
+        raise KeyError("not an element: {}".format(atom_label))
+    if m.group(1):
+        return int(m.group(1))
+    symbol = m.group(2).capitalize()
+    if symbol not in atomic_numbers:
+        raise KeyError("not an element: {}".format(atom_label))
+    return atomic_numbers[symbol]
+
+
+def count_electrons(atom_labels):
+    """
+    number of electrons of a neutral molecule with these atom labels;
+    each distinct label is looked up once
+    """
+    labels, counts = np.unique(np.asarray(atom_labels, dtype=str), return_counts=True)
+    z = np.array([atomic_number(l) for l in labels], dtype=np.int64)
+    return int(z @ counts)
+
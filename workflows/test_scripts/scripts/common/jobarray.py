@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Slurm job arrays for all prepared run directories:
+# * <basedir>/jobs_manifest.json - all run directories (molecule, software, model, subdir, run script),
+#   updated by every prepare_hpc.py call (one per molecule);
+# * <basedir>/jobs.txt           - one run directory per line (line i = array task i);
+# * <basedir>/run_array.sh       - the array script: task i goes to line i of jobs.txt and runs its run script;
+#   its resources are the #SBATCH lines of the run scripts (job name and output files excepted);
+#   run scripts with different resources get one array each (run_array.sh, run_array_2.sh, ...) over
+#   consecutive lines of jobs.txt; with no jobs, jobs.txt is empty and there is no array script
+
+import os
+import json
+from pathlib import Path
+
+from common.templates import output
+
+jobs_manifest_filename = 'jobs_manifest.json'
+jobs_list_filename = 'jobs.txt'
+array_script_filename = 'run_array.sh'
+array_script_glob = 'run_array*.sh'
+
+# directives of the run scripts that are set per array task instead
+per_task_directives = ('-J', '--job-name', '--output', '--error', '-o', '-e', '--array', '-a')
+
+
+def read_jobs(basedir):
+    try:
+        with open(Path(basedir).joinpath(jobs_manifest_filename), "r") as f:
+            return json.load(f)['jobs']
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def merge_jobs(old, new):
+    """
+    jobs of "old" (those whose run directory still exists) updated with "new" (by run directory),
+    sorted by run directory
+    """
+    jobs = {j['run_dir']: j for j in old if os.path.isdir(j['run_dir'])}
+    jobs.update({j['run_dir']: j for j in new})
+    return [jobs[k] for k in sorted(jobs)]
+
+
+def sbatch_directives(script):
+    """
+    #SBATCH lines of a run script, without the per-task ones (job name, output and error files)
+    """
+    lines = []
+    with open(script, "r") as f:
+        for line in f:
+            if not line.startswith('#SBATCH'):
+                continue
+            option = line.split()[1].split('=')[0] if len(line.split()) > 1 else ''
+            if option not in per_task_directives:
+                lines.append(line.rstrip() + '\n')
+    return lines
+
+
+def array_script(first, last, directives, name, max_concurrent=0, logdir='array_logs'):
+    """
+    text of the array script running lines "first" to "last" of the jobs list with the given #SBATCH "directives"
+    """
+    array = '{}-{}'.format(first, last) + ('%{}'.format(max_concurrent) if max_concurrent else '')
+    lines = ['#!/bin/bash -l\n',
+             '#SBATCH -J {}\n'.format(name),
+             '#SBATCH --array={}\n'.format(array)]
+    lines += directives
+    lines += ['#SBATCH --output="{}/%A_%a.out"\n'.format(logdir),
+              '#SBATCH --error="{}/%A_%a.err"\n'.format(logdir),
+              '\n',
+              '# generated by prepare_hpc.py: task i runs the run script of line i of {}\n'.format(jobs_list_filename),
+              'cd $SLURM_SUBMIT_DIR\n',
+              'run_dir=$(sed -n "${SLURM_ARRAY_TASK_ID}p" ' + jobs_list_filename + ' | cut -f1)\n',
+              'run_script=$(sed -n "${SLURM_ARRAY_TASK_ID}p" ' + jobs_list_filename + ' | cut -f2)\n',
+              '\n',
+              'cd "$run_dir"\n',
+              '# run scripts start with "cd $SLURM_SUBMIT_DIR" (absolute, whatever the jobs list holds)\n',
+              'export SLURM_SUBMIT_DIR=$PWD\n',
+              '# a login shell, as for a run script submitted by itself (module comes from the login profile);\n',
+              '# not with the local stand-ins (FAKE_STUB=1, see scripts/local/fake_sbatch.py), a login PATH would drop them\n',
+              'login=-l\n',
+              '[ -n "$FAKE_STUB" ] && login=\n',
+              'bash $login "$run_script" > output.out 2> error.err\n']
+    return ''.join(lines)
+
+
+def directive_groups(jobs):
+    """
+    [(#SBATCH directives, jobs)] of the jobs grouped by the directives of their run scripts,
+    in the order of the first job of every group
+    """
+    groups = {}
+    for j in jobs:
+        script = Path(j['run_dir']).joinpath(j['script'])
+        directives = tuple(sbatch_directives(script)) if os.path.exists(script) else ()
+        groups.setdefault(directives, []).append(j)
+    return [(list(directives), group) for directives, group in groups.items()]
+
+
+def array_script_name(k):
+    return array_script_filename if k == 0 else 'run_array_{}.sh'.format(k + 1)
+
+
+def array_outputs(basedir, jobs, max_concurrent=0, name='array'):
+    """
+    outputs (see templates.write_outputs) of the jobs manifest, the jobs list and one array script
+    per group of jobs with the same #SBATCH directives (the jobs of a group are consecutive lines of the list)
+    """
+    basedir = Path(basedir)
+    groups = directive_groups(jobs)
+    jobs = [j for directives, group in groups for j in group]
+    outs = [output(basedir.joinpath(jobs_manifest_filename), json.dumps({'jobs': jobs}, indent=1) + '\n'),
+            output(basedir.joinpath(jobs_list_filename), ''.join('{}\t{}\n'.format(j['run_dir'], j['script']) for j in jobs))]
+    first = 1
+    for k, (directives, group) in enumerate(groups):
+        last = first + len(group) - 1
+        script_name = name if k == 0 else '{}_{}'.format(name, k + 1)
+        outs.append(output(basedir.joinpath(array_script_name(k)),
+                           array_script(first, last, directives, script_name, max_concurrent), 0o755))
+        first = last + 1
+    return outs
+
+
+def stale_array_scripts(basedir, outputs):
+    """
+    array scripts in "basedir" that are not among "outputs" (left from an earlier call with more groups or jobs)
+    """
+    keep = {path for path, data, mode in outputs}
+    return sorted(p for p in Path(basedir).glob(array_script_glob) if p not in keep)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# manifest of all molecular geometries of an explorations tree:
+# every xyz file in a "coordinates" directory is parsed once into
+#   name, number of atoms, number of electrons (neutral molecule), charge and sha256 of its content,
+# and the result is kept in <root>/.coordinates_manifest.json;
+# on the next use, only directories and files whose mtime (or size) changed are listed or parsed again
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from common.elements import count_electrons
+from common.xyzio import parse_xyz
+
+manifest_filename = '.coordinates_manifest.json'
+manifest_version = 1
+
+# charge in the comment line of an xyz file, e.g. "charge=0; ..."
+charge_pattern = re.compile(r"charge\s*=\s*([-+]?\d+)", re.IGNORECASE)
+
+
+def manifest_path(root):
+    return Path(root).joinpath(manifest_filename)
+
+
+def parse_geometry(path):
+    """
+    one manifest entry of an xyz file, from a single read (of a trajectory: its first frame)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    labels, coords, comments = parse_xyz(data.decode(), path)
+    charge = charge_pattern.search(comments[0])
+    return {'name': Path(path).stem,
+            'natoms': len(labels),
+            'electrons': count_electrons(labels),
+            'charge': int(charge.group(1)) if charge else None,
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def read_manifest(root):
+    try:
+        with open(manifest_path(root), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != manifest_version:
+        return None
+    return manifest
+
+
+def write_manifest(root, manifest):
+    path = manifest_path(root)
+    tmp = str(path) + '.tmp'
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def scan(root, old=None, dirname='coordinates'):
+    """
+    walk "root" and index the xyz files in "dirname" directories;
+    listings of directories with an unchanged mtime and entries of files with unchanged size and mtime
+    are reused from the "old" manifest; returns the new manifest and the number of parsed files
+    """
+    old_dirs = old['dirs'] if old else {}
+    old_files = old['files'] if old else {}
+    dirs, files = {}, {}
+    parsed = 0
+
+    stack = ['.']
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(root, rel)
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = old_dirs.get(rel)
+        if cached is not None and cached['mtime_ns'] == mtime_ns:
+            subdirs, xyz = cached['subdirs'], cached['xyz']
+        else:
+            subdirs, xyz = [], []
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        subdirs.append(e.name)
+                    elif e.name.endswith('.xyz') and os.path.basename(rel) == dirname:
+                        xyz.append(e.name)
+            subdirs.sort()
+            xyz.sort()
+        dirs[rel] = {'mtime_ns': mtime_ns, 'subdirs': subdirs, 'xyz': xyz}
+
+        for name in xyz:
+            frel = os.path.normpath(os.path.join(rel, name))
+            st = os.stat(os.path.join(root, frel))
+            entry = old_files.get(frel)
+            if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                entry = parse_geometry(os.path.join(root, frel))
+                entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+                parsed += 1
+            files[frel] = entry
+        stack += [os.path.normpath(os.path.join(rel, d)) for d in reversed(subdirs)]
+
+    return {'version': manifest_version, 'dirname': dirname, 'dirs': dirs, 'files': files}, parsed
+
+
+def load_manifest(root, dirname='coordinates', save=True):
+    """
+    the up-to-date manifest of "root" (see scan); saved again only if something changed
+    """
+    old = read_manifest(root)
+    if old is not None and old.get('dirname') != dirname:
+        old = None
+    manifest, parsed = scan(root, old, dirname)
+    if save and (old is None or parsed or listings(manifest) != listings(old)):
+        # (a changed mtime alone, e.g. of "root" after writing the manifest, is not worth a write)
+        write_manifest(root, manifest)
+    return manifest
+
+
+def listings(manifest):
+    return {rel: (d['subdirs'], d['xyz']) for rel, d in manifest['dirs'].items()}
+
+
+def find_geometries(manifest, names, under=None, root=None):
+    """
+    entries (with their absolute "path" added) of the geometries called "names",
+    optionally only those below the directory "under"
+    """
+    root = Path(root) if root is not None else None
+    if under is not None:
+        under = os.path.relpath(Path(under).resolve(), root.resolve())
+    found = []
+    for rel, entry in manifest['files'].items():
+        if entry['name'] not in names:
+            continue
+        if under is not None and under != '.' and not (rel + os.sep).startswith(under + os.sep):
+            continue
+        found.append(dict(entry, path=str(root.joinpath(rel)) if root is not None else rel))
+    return found
+
+
+def find_geometry(manifest, name, under=None, root=None):
+    found = find_geometries(manifest, [name], under, root)
+    if not found:
+        sys.exit("no geometry of {} in the coordinates manifest of {}".format(name, root))
+    return found[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build or update the coordinate manifest of an explorations tree and print it")
+    parser.add_argument("root")
+    parser.add_argument("--dirname", default='coordinates')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.root, args.dirname)
+    for rel, e in sorted(manifest['files'].items()):
+        print("{0:<50} {1:>6} {2:>6} {3:>6} {4}".format(rel, e['natoms'], e['electrons'], str(e['charge']), e['sha256'][:12]))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# content-addressed cache of finished calculations:
+# * the key of a run directory is the sha256 of its model parameters (software, hamiltonian, functional,
+#   basis, charge), its rendered input and its geometry; prepare_hpc.py writes it to <run_dir>/.qc_key
+#   (and the parameters to .qc_key.json);
+# * a run script that ended successfully copies .qc_key to .qc_done, so a run directory is finished
+#   (for its current input) when both files hold the same key;
+# * <run_dir>/.qc_outputs declares the outputs written outside the run directory (one path per line,
+#   environment variables are expanded, e.g. the CHECKPOINT.h5 in $PLG_GROUPS_STORAGE/.../binfiles);
+# * the cache file (<basedir>/.result_cache.json, or any path shared by several projects) maps keys to
+#   the finished run directories, their output files (inputs excepted) and their declared outputs;
+#   "scan" walks a whole tree for .qc_done files, prepare_hpc.py only checks the run directories
+#   of the jobs manifest (see update)
+#
+# usage: python result_cache.py scan explorations [--cache FILE]
+#        python result_cache.py query [--cache FILE] [--where hamiltonian=dc basis=dyall.av3z] [--key KEY]
+#        python result_cache.py prune [--cache FILE] [--older_than DAYS]
+
+import os
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+from pathlib import Path
+
+cache_filename = '.result_cache.json'
+key_filename = '.qc_key'
+params_filename = '.qc_key.json'
+done_filename = '.qc_done'
+outputs_filename = '.qc_outputs'
+cache_version = 1
+
+# directories that never hold run directories
+skip_dirs = ('inputs', 'binfiles', 'plotfiles', 'coordinates', 'array_logs')
+
+# files of a run directory written by prepare_hpc.py, not by the calculation
+marker_files = (key_filename, params_filename, done_filename, outputs_filename)
+input_patterns = ('*.inp', '*.xyz', 'run_*.sh')
+
+
+def cache_path(basedir, path=None):
+    return Path(path) if path else Path(basedir).joinpath(cache_filename)
+
+
+def result_key(params, inputs, geometry):
+    """
+    key of a calculation: "params" (dict of str), "inputs" ({name: text or bytes}) and "geometry" (bytes)
+    """
+    def digest(data):
+        return hashlib.sha256(data.encode() if isinstance(data, str) else data).hexdigest()
+
+    content = {'params': {k: str(v) for k, v in params.items()},
+               'inputs': {name: digest(data) for name, data in inputs.items()},
+               'geometry': digest(geometry)}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def read_marker(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def finished_key(run_dir):
+    """
+    key of the finished calculation in "run_dir", or None if it did not finish for its current input
+    """
+    done = read_marker(Path(run_dir).joinpath(done_filename))
+    if done and done == read_marker(Path(run_dir).joinpath(key_filename)):
+        return done
+    return None
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {'version': cache_version, 'results': {}}
+    if cache.get('version') != cache_version:
+        return {'version': cache_version, 'results': {}}
+    return cache
+
+
+def save_cache(path, cache):
+    tmp = str(path) + '.tmp'
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def is_input(name):
+    return name in marker_files or any(fnmatch.fnmatch(name, p) for p in input_patterns)
+
+
+def run_dir_outputs(run_dir):
+    """
+    files written by the calculation (everything but the markers and the inputs), relative to "run_dir"
+    """
+    outputs = []
+    for dirpath, dirnames, filenames in os.walk(run_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != 'inputs')
+        for name in sorted(filenames):
+            if not is_input(name):
+                outputs.append(os.path.relpath(os.path.join(dirpath, name), run_dir))
+    return outputs
+
+
+def declared_outputs(run_dir):
+    """
+    absolute paths of the outputs declared in <run_dir>/.qc_outputs (environment variables expanded,
+    relative paths are relative to "run_dir"), in their order
+    """
+    try:
+        with open(Path(run_dir).joinpath(outputs_filename), "r") as f:
+            lines = [line.strip() for line in f]
+    except OSError:
+        return []
+    return [str(Path(run_dir).joinpath(os.path.expandvars(line)).absolute()) for line in lines if line]
+
+
+def add_result(cache, run_dir):
+    """
+    add "run_dir" to the cache if it holds a finished calculation that is not cached yet; a run directory without
+    outputs, or with a declared output missing, is not a finished calculation (whatever its markers say);
+    returns True if added
+    """
+    key = finished_key(run_dir)
+    if key is None:
+        return False
+    outputs = run_dir_outputs(run_dir)
+    declared = declared_outputs(run_dir)
+    if not outputs or not all(os.path.exists(path) for path in declared):
+        return False
+    run_dir = str(Path(run_dir).absolute())
+    entry = cache['results'].get(key)
+    if entry is not None and entry['run_dir'] == run_dir:
+        return False
+    if entry is not None and finished_key(entry['run_dir']) == key:
+        # the first finished copy stays the cached one
+        return False
+    params = {}
+    try:
+        with open(Path(run_dir).joinpath(params_filename), "r") as f:
+            params = json.load(f)
+    except (OSError, ValueError):
+        pass
+    cache['results'][key] = {'run_dir': run_dir,
+                             'params': params,
+                             'outputs': outputs,
+                             'declared': declared,
+                             'finished': os.stat(Path(run_dir).joinpath(done_filename)).st_mtime}
+    return True
+
+
+def scan(root, cache):
+    """
+    add the finished run directories below "root" to the cache (walks the whole tree);
+    returns the number of new entries
+    """
+    added = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in skip_dirs and not d.startswith('.'))
+        if done_filename in filenames:
+            added += add_result(cache, dirpath)
+    return added
+
+
+def update(cache, run_dirs):
+    """
+    add the finished ones of "run_dirs" (e.g. the jobs of the last prepare_hpc.py call) to the cache,
+    without walking any tree; returns the number of new entries
+    """
+    return sum(add_result(cache, run_dir) for run_dir in run_dirs if os.path.isdir(run_dir))
+
+
+def lookup(cache, key):
+    """
+    the cache entry of "key" if its run directory still holds the finished calculation, else None
+    """
+    entry = cache['results'].get(key)
+    if entry is not None and finished_key(entry['run_dir']) == key:
+        return entry
+    return None
+
+
+def link_result(entry, run_dir):
+    """
+    symlinks in "run_dir" to the outputs of the cached calculation, at the declared output paths of "run_dir"
+    to the declared outputs of the cached one (e.g. its checkpoint; matched by their order in .qc_outputs)
+    and to its .qc_done marker, so that "run_dir" counts as finished; existing files are kept;
+    returns the number of links made
+    """
+    targets = [(Path(run_dir).joinpath(rel), Path(entry['run_dir']).joinpath(rel)) for rel in entry['outputs']]
+    targets += [(Path(link), Path(source)) for link, source in zip(declared_outputs(run_dir), entry.get('declared', []))
+                if os.path.exists(source)]
+    targets.append((Path(run_dir).joinpath(done_filename), Path(entry['run_dir']).joinpath(done_filename)))
+    made = 0
+    for link, source in targets:
+        if link.exists() or link.is_symlink():
+            continue
+        link.parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(source, link)
+        made += 1
+    return made
+
+
+def prune(cache, older_than=None):
+    """
+    drop the entries whose run directory no longer holds the finished calculation
+    (and, with "older_than" days, the ones finished earlier than that); returns the number of dropped entries
+    """
+    now = time.time()
+    dropped = 0
+    for key in list(cache['results']):
+        entry = cache['results'][key]
+        stale = finished_key(entry['run_dir']) != key
+        old = older_than is not None and now - entry['finished'] > older_than * 86400
+        if stale or old:
+            del cache['results'][key]
+            dropped += 1
+    return dropped
+
+
+def query(cache, where=None, key=None):
+    where = where or {}
+    found = []
+    for k, entry in sorted(cache['results'].items(), key=lambda item: item[1]['run_dir']):
+        if key is not None and not k.startswith(key):
+            continue
+        if any(str(entry['params'].get(p)) != v for p, v in where.items()):
+            continue
+        found.append((k, entry))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scan, query or prune the cache of finished calculations")
+    parser.add_argument("command", choices=["scan", "query", "prune"])
+    parser.add_argument("root", nargs="?", default=".", help="explorations directory (scan; default location of the cache)")
+    parser.add_argument("--cache", default=os.environ.get('QC_RESULT_CACHE'), help="cache file (default: <root>/" + cache_filename + ")")
+    parser.add_argument("--where", nargs="*", default=[], help="parameter=value filters of query")
+    parser.add_argument("--key", help="key (prefix) of query")
+    parser.add_argument("--older_than", type=float, help="prune also the entries finished more than this many days ago")
+    args = parser.parse_args()
+
+    path = cache_path(args.root, args.cache)
+    cache = load_cache(path)
+    if args.command == 'scan':
+        print("{} new results".format(scan(args.root, cache)))
+        save_cache(path, cache)
+    elif args.command == 'prune':
+        print("{} entries dropped".format(prune(cache, args.older_than)))
+        save_cache(path, cache)
+    else:
+        where = dict(w.split('=', 1) for w in args.where)
+        for k, entry in query(cache, where, args.key):
+            params = ' '.join('{}={}'.format(p, v) for p, v in sorted(entry['params'].items()))
+            print("{} {} {} ({} outputs)  {}".format(k[:12], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['finished'])),
+                                                    entry['run_dir'], len(entry['outputs']), params))
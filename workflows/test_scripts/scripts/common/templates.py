@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# template engine for preparing many run directories at once:
+# * every template file is read and compiled once (split into literal text and pattern names),
+#   all patterns are substituted in a single pass (longest pattern first, no cascading replacements),
+#   lines containing "remove" after substitution are dropped (as in the old modify_lines);
+# * the rendered outputs of the whole model matrix are compared with what is on disk and only new or
+#   changed files are written (in parallel); unchanged files are not touched, so their mtime stays
+#   and rsync-based staging does not transfer them again
+
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+state_filename = '.rendered.json'
+
+
+class Template():
+    """
+    a template file compiled for a fixed set of pattern names ("keys")
+    """
+
+    def __init__(self, path, keys):
+        self.path = Path(path)
+        with open(self.path, "r") as f:
+            text = f.read()
+        self.mode = os.stat(self.path).st_mode & 0o777
+        keys = sorted(set(keys), key=len, reverse=True)
+        # even items are literal text, odd items are pattern names
+        if keys:
+            self.parts = re.split('(' + '|'.join(re.escape(k) for k in keys) + ')', text)
+        else:
+            self.parts = [text]
+
+    def render(self, values):
+        """
+        the template with every pattern replaced by its value (patterns with an empty/None value are kept)
+        """
+        out = []
+        for i, part in enumerate(self.parts):
+            if i % 2:
+                v = values.get(part)
+                out.append(v if v else part)
+            else:
+                out.append(part)
+        text = ''.join(out)
+        if 'remove' in text:
+            text = ''.join(l for l in text.splitlines(keepends=True) if 'remove' not in l)
+        return text
+
+
+class TemplateDir():
+    """
+    all files of a template directory, read once: files with "template" in their name are compiled
+    (see Template), the other ones are kept as they are
+    """
+
+    def __init__(self, root, keys, ignore=('inprep',)):
+        self.root = Path(root)
+        self.templates = {}
+        self.static = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in ignore]
+            for name in filenames:
+                if name in ignore:
+                    continue
+                path = Path(dirpath).joinpath(name)
+                rel = path.relative_to(self.root)
+                if 'template' in name:
+                    self.templates[rel] = Template(path, keys)
+                else:
+                    with open(path, "rb") as f:
+                        self.static[rel] = (f.read(), os.stat(path).st_mode & 0o777)
+
+    def find(self, prefix):
+        """
+        relative paths of the templates whose file name starts with "prefix"
+        """
+        return [rel for rel in self.templates if rel.name.startswith(prefix)]
+
+
+def output(path, data, mode=0o644):
+    """
+    one output file: destination, content (str or bytes) and permissions
+    """
+    return (Path(path), data.encode() if isinstance(data, str) else data, mode)
+
+
+def read_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def status_of(out, state):
+    """
+    "new", "changed" or "unchanged" (compared with the file on disk; a file whose size and mtime
+    match what was recorded when it was written is not read again)
+    """
+    path, data, mode = out
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return 'new', digest
+    recorded = state.get(str(path))
+    if recorded is not None and recorded == [st.st_size, st.st_mtime_ns, digest] and st.st_mode & 0o777 == mode:
+        return 'unchanged', digest
+    if st.st_size == len(data) and st.st_mode & 0o777 == mode:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return 'unchanged', digest
+    return 'changed', digest
+
+
+def write_outputs(outputs, state_file=None, nthreads=8, dry_run=False):
+    """
+    write the outputs [(path, bytes, mode)] that are new or changed, "nthreads" files at a time;
+    with "dry_run" nothing is written; returns [(path, status)]
+    """
+    state = read_state(state_file) if state_file else {}
+
+    def process(out):
+        path, data, mode = out
+        status, digest = status_of(out, state)
+        if status != 'unchanged' and not dry_run:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = str(path) + '.tmp'
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        if not dry_run:
+            st = os.stat(path)
+            state[str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        return path, status
+
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        statuses = list(pool.map(process, outputs))
+
+    if state_file and not dry_run:
+        tmp = str(state_file) + '.tmp'
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=0, sort_keys=True)
+        os.replace(tmp, state_file)
+    return statuses
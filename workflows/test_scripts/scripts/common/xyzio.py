@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# XYZ files (single geometries or multi-frame trajectories with a fixed number of atoms) as numpy arrays:
+# * read_xyz: atom labels (natoms,), coordinates (nframes, natoms, 3) and comment lines, parsed in bulk
+#   (all atom lines of all frames are split at once, not line by line);
+# * convert: vectorized unit conversion (angstrom, bohr);
+# * write_csv, write_npy, write_xyz (or write, chosen by the file suffix)
+#
+# usage: python xyzio.py traj.xyz traj.csv [--from_unit angstrom --to_unit bohr] [--frames 0:1000]
+
+import sys
+import argparse
+import operator
+import numpy as np
+from pathlib import Path
+
+# length of one unit in angstrom
+units = {'angstrom': 1.0,
+         'bohr': 0.529177249}
+
+# column headers of the coordinates in csv files
+unit_labels = {'angstrom': 'A',
+               'bohr': 'a.u.'}
+
+
+def parse_xyz(text, source="xyz"):
+    """
+    atom labels (natoms,), coordinates (nframes, natoms, 3) and comment lines (nframes) of the text of an xyz file;
+    all frames must have the same number of atoms (and atoms in the same order), columns after x, y, z are ignored
+    """
+    lines = text.splitlines()
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if not lines:
+        raise ValueError("{}: empty xyz file".format(source))
+    natoms = int(lines[0].split()[0])
+    block = natoms + 2
+    if len(lines) % block:
+        raise ValueError("{}: {} lines are not a whole number of frames of {} atoms".format(source, len(lines), natoms))
+    nframes = len(lines) // block
+    starts = np.arange(nframes) * block
+    if any(int(lines[i].split()[0]) != natoms for i in starts[1:]):
+        raise ValueError("{}: frames with different numbers of atoms".format(source))
+    comments = [lines[i + 1] for i in starts]
+    if natoms == 0:
+        return np.empty(0, dtype=str), np.empty((nframes, 0, 3)), comments
+
+    atom_lines = operator.itemgetter(*(starts[:, None] + 2 + np.arange(natoms)).ravel())(lines)
+    if natoms * nframes == 1:
+        atom_lines = (atom_lines,)
+    ncols = len(atom_lines[0].split())
+    tokens = np.array(' '.join(atom_lines).split())
+    if ncols < 4 or tokens.size != len(atom_lines) * ncols:
+        raise ValueError("{}: atom lines with different or too few columns (label x y z expected)".format(source))
+    tokens = tokens.reshape(nframes, natoms, ncols)
+    labels = tokens[0, :, 0]
+    if nframes > 1 and (tokens[1:, :, 0] != labels).any():
+        raise ValueError("{}: frames with different atoms".format(source))
+    return labels, tokens[:, :, 1:4].astype(np.float64), comments
+
+
+def read_xyz(path, frames=None):
+    """
+    labels, coordinates and comments (see parse_xyz) of an xyz file, optionally only the frames selected by
+    "frames" (a slice or array of frame indices)
+    """
+    with open(path, "r") as f:
+        labels, coords, comments = parse_xyz(f.read(), path)
+    if frames is not None:
+        coords = coords[frames]
+        comments = list(np.asarray(comments, dtype=object)[frames])
+    return labels, coords, comments
+
+
+def convert(coords, from_unit='angstrom', to_unit='angstrom'):
+    if from_unit == to_unit:
+        return coords
+    return coords * (units[from_unit] / units[to_unit])
+
+
+def as_frames(coords):
+    coords = np.asarray(coords, dtype=np.float64)
+    return coords[None] if coords.ndim == 2 else coords
+
+
+def write_csv(path, labels, coords, unit='angstrom', fmt='%.10f'):
+    """
+    one line per atom, "at,x,y,z [<unit>]"; trajectories get a first "frame" column
+    """
+    coords = as_frames(coords)
+    nframes, natoms = coords.shape[:2]
+    columns = [np.tile(np.asarray(labels, dtype=str), nframes)]
+    header = "at,x,y,z [{}]".format(unit_labels[unit])
+    if nframes > 1:
+        columns.insert(0, np.repeat(np.arange(nframes), natoms).astype(str))
+        header = "frame," + header
+    columns.append(np.char.mod(fmt, coords.reshape(-1, 3)))
+    table = np.column_stack(columns)
+    np.savetxt(path, table, fmt='%s', delimiter=',', header=header, comments='')
+
+
+def write_npy(path, coords):
+    """
+    coordinates only, as an array (nframes, natoms, 3)
+    """
+    np.save(path, as_frames(coords))
+
+
+def write_xyz(path, labels, coords, comments=None, fmt='%14.8f'):
+    coords = as_frames(coords)
+    nframes, natoms = coords.shape[:2]
+    comments = comments if comments is not None else [''] * nframes
+    atom_lines = np.char.add(np.char.ljust(np.tile(np.asarray(labels, dtype=str), nframes), 4),
+                             np.char.mod(fmt, coords.reshape(-1, 3)[:, 0]))
+    for k in (1, 2):
+        atom_lines = np.char.add(np.char.add(atom_lines, ' '), np.char.mod(fmt, coords.reshape(-1, 3)[:, k]))
+    atom_lines = atom_lines.reshape(nframes, natoms)
+    with open(path, "w") as f:
+        for i in range(nframes):
+            f.write("{}\n{}\n".format(natoms, comments[i]))
+            f.write('\n'.join(atom_lines[i]) + ('\n' if natoms else ''))
+
+
+def write(path, labels, coords, comments=None, unit='angstrom'):
+    """
+    write_csv, write_npy or write_xyz, by the suffix of "path"
+    """
+    suffix = Path(path).suffix
+    if suffix == '.csv':
+        write_csv(path, labels, coords, unit)
+    elif suffix == '.npy':
+        write_npy(path, coords)
+    elif suffix == '.xyz':
+        write_xyz(path, labels, coords, comments)
+    else:
+        raise ValueError("{}: unknown output format (csv, npy or xyz)".format(path))
+
+
+def frame_selection(spec):
+    """
+    "a:b[:c]" -> slice, "i,j,k" -> list of frame indices
+    """
+    if ':' in spec:
+        return slice(*[int(s) if s else None for s in spec.split(':')])
+    return [int(s) for s in spec.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert an xyz file (or trajectory) to csv, npy or xyz")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--from_unit", default="angstrom", choices=sorted(units))
+    parser.add_argument("--to_unit", default="angstrom", choices=sorted(units))
+    parser.add_argument("--frames", help="frames to keep, e.g. 0:1000:10 or 0,5,9")
+    args = parser.parse_args()
+
+    labels, coords, comments = read_xyz(args.input, frame_selection(args.frames) if args.frames else None)
+    write(args.output, labels, convert(coords, args.from_unit, args.to_unit), comments, args.to_unit)
+    print("{}: {} frames of {} atoms".format(args.output, coords.shape[0], coords.shape[1]), file=sys.stderr)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# local stand-in for sbatch, for testing the whole prepare/submit flow on a laptop:
+# * the job runs at once (synchronously) with bash, in the submission directory, with the SLURM_* variables
+#   a batch job (or every task of a job array, "--array=1-N%M") would see;
+# * "--output"/"--error" (%A, %a, %j, %x are expanded) are honoured, otherwise slurm-%j.out is written;
+# * "--parsable" prints only the job id, "--dependency=afterok:<id>[:<id>...]" skips the job
+#   when one of these jobs failed;
+# * job ids and states are kept in .fake_sbatch/jobs.json of the current directory (or $FAKE_SBATCH_DIR);
+# * "--stubs DIR" writes stand-ins for srun, module, pam and pam-dirac (they echo their arguments, sleep
+#   $FAKE_STUB_SLEEP seconds and exit with $FAKE_STUB_EXIT, 0 by default) to DIR;
+#   put DIR first in PATH to run the generated run scripts without the cluster software (jobs that find
+#   these pam stand-ins get FAKE_STUB=1, so that they are not marked as finished calculations);
+#   with "--stubs_mode cluster" only srun (runs its command directly) and module (does nothing) are written,
+#   so the run scripts call the real pam and pam-dirac of this machine
+#
+# usage: SBATCH="python scripts/local/fake_sbatch.py" ./runmany.sh
+#        python fake_sbatch.py [--parsable] [--dependency=afterok:1] [--array=1-4%2] run_array.sh
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+from pathlib import Path
+
+state_dirname = '.fake_sbatch'
+stub_commands = ('srun', 'module', 'pam', 'pam-dirac')
+
+# srun and module of a machine without Slurm and environment modules: srun drops its options
+# and runs the command, module does nothing (the software has to be in PATH already)
+cluster_stubs = {
+    'srun': '#!/bin/bash\n'
+            'while [ $# -gt 0 ]; do\n'
+            '    case "$1" in\n'
+            '        -[nNctpAJoe]|--ntasks|--nodes|--cpus-per-task|--time|--partition|--account|--job-name|--output|--error)\n'
+            '            shift 2 ;;\n'
+            '        -*) shift ;;\n'
+            '        *) break ;;\n'
+            '    esac\n'
+            'done\n'
+            'exec "$@"\n',
+    'module': '#!/bin/bash\necho "[module] $* (ignored)" >&2\n',
+}
+stub_modes = ('all', 'cluster')
+
+# file in a directory of echoing stand-ins (mode "all"), see stub_env
+stub_marker = '.fake_stubs'
+
+
+def state_dir():
+    return Path(os.environ.get('FAKE_SBATCH_DIR', Path.cwd().joinpath(state_dirname))).absolute()
+
+
+def read_state():
+    try:
+        with open(state_dir().joinpath('jobs.json'), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'last_id': 0, 'jobs': {}}
+
+
+def write_state(state):
+    path = state_dir().joinpath('jobs.json')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = str(path) + '.tmp'
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def make_stubs(stubdir, mode='all'):
+    """
+    stand-ins of the cluster commands:
+    * "all"     - srun, module, pam and pam-dirac print what they were called with and succeed
+                  (unless $FAKE_STUB_EXIT says otherwise), after $FAKE_STUB_SLEEP seconds;
+    * "cluster" - only srun and module, see cluster_stubs (pam and pam-dirac are the real ones)
+    """
+    if mode not in stub_modes:
+        raise ValueError("unknown stub mode: {}".format(mode))
+    stubdir = Path(stubdir)
+    stubdir.mkdir(parents=True, exist_ok=True)
+    if mode == 'cluster':
+        stubs = cluster_stubs
+    else:
+        stubs = {name: '#!/bin/bash\necho "[{}]" "$@"\nsleep ${{FAKE_STUB_SLEEP:-0}}\nexit ${{FAKE_STUB_EXIT:-0}}\n'.format(name)
+                 for name in stub_commands}
+    for name, text in stubs.items():
+        path = stubdir.joinpath(name)
+        with open(path, "w") as f:
+            f.write(text)
+        os.chmod(path, 0o755)
+    if mode == 'all':
+        stubdir.joinpath(stub_marker).touch()
+    return stubdir
+
+
+def stub_env(env):
+    """
+    "env" with FAKE_STUB=1 if the pam of its PATH is an echoing stand-in (the run scripts then do not
+    mark the calculation as finished)
+    """
+    pam = shutil.which('pam', path=env.get('PATH'))
+    if pam is not None and Path(pam).parent.joinpath(stub_marker).exists():
+        return dict(env, FAKE_STUB='1')
+    return env
+
+
+def script_directives(script):
+    """
+    options given in the #SBATCH lines of a batch script (before its first command)
+    """
+    options = []
+    with open(script, "r") as f:
+        for line in f:
+            if line.startswith('#SBATCH'):
+                options += line.split()[1:]
+            elif line.strip() and not line.startswith('#'):
+                break
+    return [o.replace('"', '') for o in options]
+
+
+def parse_options(argv):
+    parser = argparse.ArgumentParser(description="run a batch script locally, as sbatch would submit it")
+    parser.add_argument("-J", "--job-name", dest="name")
+    parser.add_argument("-a", "--array")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-e", "--error")
+    parser.add_argument("-d", "--dependency")
+    parser.add_argument("-n", "--ntasks", type=int)
+    parser.add_argument("--ntasks-per-node", dest="ntasks_per_node", type=int)
+    parser.add_argument("-N", "--nodes", type=int, default=1)
+    # accepted, without effect here
+    for opt in (("-A", "--account"), ("-p", "--partition"), ("-t", "--time"), ("-c", "--cpus-per-task"),
+                ("--mem",), ("--mem-per-cpu",), ("--qos",), ("--constraint",)):
+        parser.add_argument(*opt)
+    parser.add_argument("--parsable", action="store_true")
+    parser.add_argument("--stubs", help="write stand-ins of srun/module/pam/pam-dirac to this directory and exit")
+    parser.add_argument("--stubs_mode", default="all", choices=stub_modes,
+                        help="all: echoing stand-ins of all four; cluster: only srun (runs its command) and module (no-op)")
+    parser.add_argument("script", nargs="?")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args, unknown = parser.parse_known_args(argv)
+    return args
+
+
+def array_tasks(spec):
+    """
+    task ids of an --array specification ("1-10", "1,3,5", "1-10:2", each optionally with "%max");
+    tasks run one after the other, so the limit on running tasks holds trivially
+    """
+    ids = []
+    for part in spec.split('%')[0].split(','):
+        m = re.match(r"^(\d+)(?:-(\d+)(?::(\d+))?)?$", part)
+        if m is None:
+            sys.exit("fake_sbatch: invalid --array {}".format(spec))
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else first
+        ids += range(first, last + 1, int(m.group(3) or 1))
+    return ids
+
+
+def expand(pattern, job_id, array_job_id, task_id, name):
+    return (pattern.replace('%A', str(array_job_id)).replace('%a', str(task_id) if task_id is not None else '')
+            .replace('%j', str(job_id)).replace('%x', name))
+
+
+def dependencies_ok(dependency, state):
+    if not dependency:
+        return True
+    for cond in dependency.split(','):
+        kind, _, ids = cond.partition(':')
+        if kind != 'afterok':
+            sys.exit("fake_sbatch: only afterok dependencies are supported, not {}".format(cond))
+        for i in ids.split(':'):
+            if state['jobs'].get(i.split('_')[0], {}).get('state') != 'COMPLETED':
+                return False
+    return True
+
+
+def run_task(script, args, submit_dir, env, job_id, array_job_id, task_id, name):
+    env = dict(stub_env(env), SLURM_JOB_ID=str(job_id), SLURM_JOBID=str(job_id), SLURM_JOB_NAME=name)
+    if task_id is not None:
+        env.update(SLURM_ARRAY_JOB_ID=str(array_job_id), SLURM_ARRAY_TASK_ID=str(task_id))
+    default = 'slurm-%j.out' if task_id is None else 'slurm-%A_%a.out'
+    out = expand(args.output or default, job_id, array_job_id, task_id, name)
+    err = expand(args.error, job_id, array_job_id, task_id, name) if args.error else None
+    with open(submit_dir.joinpath(out), "w") as fout:
+        ferr = open(submit_dir.joinpath(err), "w") if err else subprocess.STDOUT
+        try:
+            p = subprocess.run(['bash', str(script)] + args.args, cwd=submit_dir, env=env, stdout=fout, stderr=ferr)
+        finally:
+            if err:
+                ferr.close()
+    return p.returncode
+
+
+def main(argv):
+    cmdline = parse_options(argv)
+    if cmdline.stubs:
+        print(make_stubs(cmdline.stubs, cmdline.stubs_mode))
+        return 0
+    if not cmdline.script:
+        sys.exit("fake_sbatch: no batch script given")
+    script = Path(cmdline.script).absolute()
+    # options on the command line override the #SBATCH lines
+    args = parse_options(script_directives(script) + argv)
+    name = args.name or script.name
+    submit_dir = Path.cwd()
+
+    state = read_state()
+    job_id = state['last_id'] + 1
+    tasks = array_tasks(args.array) if args.array else [None]
+    # (array tasks get job ids of their own, as in Slurm); saved before running, for jobs submitting jobs
+    state['last_id'] = job_id + len(tasks) - 1
+    state['jobs'][str(job_id)] = {'name': name, 'script': str(script), 'submit_dir': str(submit_dir),
+                                  'array': args.array, 'state': 'RUNNING', 'exit_codes': []}
+    write_state(state)
+
+    env = dict(os.environ, SLURM_SUBMIT_DIR=str(submit_dir), FAKE_SBATCH_DIR=str(state_dir()),
+               SLURM_NPROCS=str((args.ntasks or args.ntasks_per_node or 1) * (args.nodes if args.ntasks is None else 1)))
+    # the run scripts put their scratch and data directories there
+    local_root = str(state_dir().joinpath('storage'))
+    env.setdefault('SCRATCH', local_root)
+    env.setdefault('PLG_GROUPS_STORAGE', local_root)
+
+    print(job_id if args.parsable else "Submitted batch job {}".format(job_id))
+    sys.stdout.flush()
+
+    if not dependencies_ok(args.dependency, read_state()):
+        job_state, codes = 'CANCELLED', []
+    else:
+        codes = [run_task(script, args, submit_dir, env, job_id + k if args.array else job_id, job_id, task, name)
+                 for k, task in enumerate(tasks)]
+        job_state = 'COMPLETED' if not any(codes) else 'FAILED'
+
+    state = read_state()
+    state['jobs'][str(job_id)].update(state=job_state, exit_codes=codes)
+    write_state(state)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,4 +4,5 @@ here=`pwd`
 repo=$here
 scr=$repo/scripts_templates/local
 
+# data_ndim final_ndim [link mode: auto (default), hardlink, reflink, symlink or copy] [copy_data: mirror the plot data too]
 python3 $scr/prepare_local.py 128 128
@@ -2,16 +2,27 @@
 
 import os
 import sys
+import fcntl
 import shutil
 import subprocess
 from pathlib import Path, PurePath
 
+# shared workflow helpers (scripts/common)
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from common import xyzio
+
 
 # -------------------------------------------------------------------
 # THIS PART CAN BE MODIFIED
 # -------------------------------------------------------------------
 data_ndim = sys.argv[1]
 final_ndim = sys.argv[2]
+# how plot data and geometries are mirrored into the analysis tree (see mirror_file):
+# auto (hardlink, else reflink, else copy), hardlink, reflink, symlink or copy
+link_mode = sys.argv[3] if len(sys.argv) > 3 else 'auto'
+# mirror the plot data (data_dir) into the analysis tree as well; off by default, the plot data
+# is usually prepared separately (set to True, or pass "copy_data" as the fourth argument)
+copy_plot_data = len(sys.argv) > 4 and sys.argv[4] == 'copy_data'
 data_filename="plot.3d.scalar"
 options = {'data_ndim':data_ndim,'final_ndim':final_ndim,'prp_selection':{}, 'calc_selection':{}}
 
@@ -93,19 +104,75 @@ def make_mirror_dirs(root_old, root_new, bottom_dir):
         q=str(p).replace(root_old,root_new)
         Path(q).mkdir(parents=True,exist_ok=True)
 
-def copy_geom(from_dir, to_dirs):
+# ioctl of Linux cloning a file on copy-on-write filesystems (btrfs, xfs): shared blocks, no data copied
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+def is_mirrored(src, dst):
+    # dst already mirrors src: the same file (hardlink), a symlink to it, or a file of the same size and mtime
+    try:
+        if os.path.islink(dst):
+            return os.readlink(dst) == str(Path(src).absolute())
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return (s.st_ino, s.st_dev) == (d.st_ino, d.st_dev) or (s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns)
+
+def mirror_file(src, dst, mode='auto'):
+    # make dst a hardlink, reflink or symlink of src instead of a copy (auto: hardlink, else reflink, else copy);
+    # nothing is done if dst already mirrors src; returns the method used or 'unchanged'
+    if is_mirrored(src, dst):
+        return 'unchanged'
+    methods = ['hardlink', 'reflink', 'copy'] if mode == 'auto' else [mode, 'copy']
+    tmp = str(dst) + '.mirror_tmp'
+    for method in methods:
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if method == 'hardlink':
+                os.link(src, tmp)
+            elif method == 'reflink':
+                reflink(src, tmp)
+            elif method == 'symlink':
+                os.symlink(Path(src).absolute(), tmp)
+            else:
+                shutil.copy2(src, tmp)
+            os.replace(tmp, dst)
+            return method
+        except OSError:
+            # e.g. another filesystem (hardlink) or no copy-on-write support (reflink)
+            if method == 'copy':
+                raise
+    return 'copy'
+
+def mirror_tree(src_dir, dst_dir, mode='auto', counts=None):
+    counts = {} if counts is None else counts
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        target = Path(dst_dir).joinpath(os.path.relpath(dirpath, src_dir))
+        target.mkdir(parents=True, exist_ok=True)
+        for name in filenames:
+            method = mirror_file(Path(dirpath).joinpath(name), target.joinpath(name), mode)
+            counts[method] = counts.get(method, 0) + 1
+    return counts
+
+def copy_geom(from_dir, to_dirs, mode='auto'):
     for f in from_dir.iterdir():
         if f.is_file() and f.suffix == '.xyz':
             for d in to_dirs:
-                shutil.copy(f, Path.joinpath(d, 'geom.xyz'))
+                mirror_file(f, Path.joinpath(d, 'geom.xyz'), mode)
 
-def copy_data(root_old, root_new, structure):
+def copy_data(root_old, root_new, structure, mode='auto'):
+    counts = {}
     for p in structure:
         #if plot_dirname in str(p): 
         if "plotfiles" in str(p): 
             q=str(p).replace(root_old,root_new)
-            print("I WILL COPY ", p, " TO ", q)
-            shutil.copytree(p, q, dirs_exist_ok=True)
+            mirror_tree(p, q, mode, counts)
+    print("**** PLOT DATA MIRRORED: ", ', '.join('{} {}'.format(n, m) for m, n in sorted(counts.items())))
 
 def copy_templates(tpl_list,from_dir, to_dir):
     for f in from_dir.iterdir():
@@ -114,26 +181,12 @@ def copy_templates(tpl_list,from_dir, to_dir):
                 shutil.copy(f, Path.joinpath(d, f.name.replace('template_','')))
 
 def transform_xyz2csv(fxyz,fcsv=None,a2b=False,b2a=False):
+    # xyz files are typically in Angstrom; a2b: Angstrom to Bohr, b2a: Bohr to Angstrom (all frames of a trajectory)
     if fcsv is None:
         fcsv = Path.joinpath(Path(fxyz.parent).resolve(), fxyz.stem+".csv")
-    with open(fxyz, "r") as f:
-        with open(fcsv, "w") as g:
-            if a2b:
-                factor = 1.889725989 # from Angstrom to Bohr
-                g.write("at,x,y,z [a.u.]\n")
-            elif b2a:
-                factor = 0.529177249 # from Bohr to Angstrom
-                g.write("at,x,y,z [a.u.]\n")
-            else:
-                factor = 1.0 # xyz files are typically in Angstrom
-                g.write("at,x,y,z [A]\n") 
-            lines = f.readlines()
-            for i, line in enumerate(lines[2:]):
-                w = line.strip().split()
-                x = float(w[1])*factor
-                y = float(w[2])*factor
-                z = float(w[3])*factor
-                g.write("{0},{1},{2},{3}\n".format(w[0],x,y,z))
+    from_unit, to_unit = ('angstrom', 'bohr') if a2b else ('bohr', 'angstrom') if b2a else ('angstrom', 'angstrom')
+    labels, coords, comments = xyzio.read_xyz(fxyz)
+    xyzio.write_csv(fcsv, labels, xyzio.convert(coords, from_unit, to_unit), to_unit)
 
 def transform_geom(dirs):
     for d in dirs:
@@ -270,13 +323,14 @@ analysis_softwares, analysis_methods, analysis_subdirs, analysis_functions = [an
 # 5. copy data needed for analysis
 
 #   * copy coordinates and transform xyz to csv
-copy_geom(local_env.coords_dir, analysis_subdirs)
+copy_geom(local_env.coords_dir, analysis_subdirs, link_mode)
 transform_geom(analysis_subdirs)
 
-#   * plot data
-#DONE copy_data(local_env.data_dir.name, local_env.analysis_dir.name, data_functions)
+#   * plot data (linked, not copied; unchanged files are skipped), only with copy_plot_data
+if copy_plot_data:
+    copy_data(local_env.data_dir.name, local_env.analysis_dir.name, data_functions, link_mode)
 
-#   * templates
+#   * templates (copied: they are modified in place below)
 print("**** TEMPLATE DIR = ", local_env.templates_dir)
 single_templates = ['template_run_ttkqc_single.py', 'template_ttkqc_start_from_qchem_single.inp']
 allfun_templates = ['template_run_ttkqc_allfun.py', 'template_ttkqc_start_allfun.inp']
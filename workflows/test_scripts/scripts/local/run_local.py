@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# run the generated run directories (run_scf.sh & co.) on this machine instead of Slurm:
+# * the run directories are the ones with the run script below the given directories, or the lines of a
+#   jobs.txt written by prepare_hpc.py;
+# * every job takes the cores it asks for in its #SBATCH lines (-n, or --ntasks-per-node x -N; at most
+#   --cores) and jobs are started, largest first, as long as their cores are free;
+# * a job runs in its run directory with the SLURM_* variables of a batch job, its output goes to the
+#   --output/--error files of its #SBATCH lines (output.out, error.err); failed jobs are started again
+#   up to --retries times; the scripts run as they are, with --errexit a failing command fails the job (bash -e);
+# * --fake puts stand-ins for srun, module, pam and pam-dirac first in PATH, --fake_cluster only for srun
+#   (runs its command directly) and module (does nothing), so the real pam does the calculation;
+# * a status table is printed at the end and written to --status (tab-separated)
+#
+# usage: python run_local.py explorations/h2o [--cores 16] [--retries 1] [--fake | --fake_cluster] [--errexit]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, str(Path(__file__).parent.absolute()))
+from fake_sbatch import make_stubs, stub_env, parse_options, script_directives
+
+
+def find_jobs(roots, script, skip=('inputs', 'outputs', 'binfiles', 'plotfiles')):
+    """
+    [(run directory, run script)] of all directories below "roots" that contain "script"
+    """
+    jobs = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d not in skip and not d.startswith('.'))
+            if script in filenames:
+                jobs.append((Path(dirpath).absolute(), script))
+    return jobs
+
+
+def read_jobs_list(jobs_list):
+    """
+    [(run directory, run script)] of a jobs.txt (see common/jobarray.py)
+    """
+    jobs = []
+    with open(jobs_list, "r") as f:
+        for line in f:
+            if line.strip():
+                run_dir, script = line.rstrip('\n').split('\t')
+                jobs.append((Path(run_dir), script))
+    return jobs
+
+
+def requested_cores(script):
+    args = parse_options(script_directives(script))
+    if args.ntasks:
+        return args.ntasks
+    return (args.ntasks_per_node or 1) * args.nodes
+
+
+class Job():
+
+    def __init__(self, jobid, run_dir, script, cores):
+        self.jobid = jobid
+        self.run_dir = Path(run_dir)
+        self.script = script
+        self.requested = requested_cores(self.run_dir.joinpath(script))
+        self.ntasks = min(self.requested, cores)
+        options = parse_options(script_directives(self.run_dir.joinpath(script)))
+        self.output = options.output or 'output.out'
+        self.error = options.error or 'error.err'
+        self.attempts = 0
+        self.returncode = None
+        self.seconds = 0.0
+
+    def run(self, env, errexit=False):
+        env = dict(env, SLURM_SUBMIT_DIR=str(self.run_dir), SLURM_JOB_ID=str(self.jobid),
+                   SLURM_NPROCS=str(self.ntasks), SLURM_NTASKS=str(self.ntasks))
+        cmd = ['bash'] + (['-e'] if errexit else []) + [self.script]
+        start = time.time()
+        with open(self.run_dir.joinpath(self.output), "w") as fout, open(self.run_dir.joinpath(self.error), "w") as ferr:
+            returncode = subprocess.run(cmd, cwd=self.run_dir, env=env, stdout=fout, stderr=ferr).returncode
+        return returncode, time.time() - start
+
+
+def run_jobs(jobs, cores, retries, env, errexit=False, verbose=True):
+    """
+    run "jobs" with at most "cores" cores busy at a time; a failed job is started again (at the end of the
+    queue) up to "retries" times
+    """
+    pending = sorted(jobs, key=lambda j: -j.ntasks)
+    running = {}
+    free = cores
+    with ThreadPoolExecutor(max_workers=max(1, cores)) as pool:
+        while pending or running:
+            for job in list(pending):
+                if job.ntasks <= free:
+                    pending.remove(job)
+                    free -= job.ntasks
+                    job.attempts += 1
+                    running[pool.submit(job.run, env, errexit)] = job
+                    if verbose:
+                        print("started  {} ({} cores, attempt {})".format(job.run_dir, job.ntasks, job.attempts))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                free += job.ntasks
+                job.returncode, seconds = future.result()
+                job.seconds += seconds
+                if verbose:
+                    print("finished {} (exit code {}, {:.1f} s)".format(job.run_dir, job.returncode, seconds))
+                if job.returncode != 0 and job.attempts <= retries:
+                    pending.append(job)
+    return jobs
+
+
+def status_table(jobs):
+    lines = [('status', 'exit', 'attempts', 'cores', 'seconds', 'run_dir')]
+    for job in jobs:
+        status = 'done' if job.returncode == 0 else 'failed'
+        lines.append((status, str(job.returncode), str(job.attempts), str(job.ntasks), "{:.1f}".format(job.seconds), str(job.run_dir)))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run generated run directories locally, several at a time")
+    parser.add_argument("roots", nargs="*", help="directories searched for run directories")
+    parser.add_argument("--jobs", help="jobs.txt written by prepare_hpc.py (instead of searching)")
+    parser.add_argument("--script", default="run_scf.sh", help="run script of a run directory")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="number of cores to use")
+    parser.add_argument("--retries", type=int, default=0, help="number of times a failed job is started again")
+    parser.add_argument("--status", default="run_local_status.tsv", help="file with the final status table")
+    fake = parser.add_mutually_exclusive_group()
+    fake.add_argument("--fake", action="store_true", help="use stand-ins for srun, module, pam and pam-dirac")
+    fake.add_argument("--fake_cluster", action="store_true",
+                      help="use stand-ins only for srun (runs its command) and module (no-op), with the real pam")
+    parser.add_argument("--errexit", action="store_true", help="a failing command fails the job (bash -e)")
+    parser.add_argument("--dry_run", action="store_true", help="only list the jobs")
+    args = parser.parse_args()
+
+    if args.jobs:
+        found = read_jobs_list(args.jobs)
+    else:
+        found = find_jobs(args.roots or ['.'], args.script)
+    if not found:
+        sys.exit("no run directories found")
+    jobs = [Job(i, run_dir, script, args.cores) for i, (run_dir, script) in enumerate(found, start=1)]
+    for job in jobs:
+        if job.requested > job.ntasks:
+            print("warning: {} asks for {} cores, run on {}".format(job.run_dir, job.requested, job.ntasks))
+    if args.dry_run:
+        for job in jobs:
+            print(job.ntasks, job.run_dir.joinpath(job.script))
+        sys.exit()
+
+    env = dict(os.environ)
+    # the run scripts put their scratch and data directories there
+    storage = str(Path('.run_local', 'storage').absolute())
+    env.setdefault('SCRATCH', storage)
+    env.setdefault('PLG_GROUPS_STORAGE', storage)
+    if args.fake or args.fake_cluster:
+        stubs = make_stubs(tempfile.mkdtemp(prefix='run_local_stubs_'), 'all' if args.fake else 'cluster')
+        env['PATH'] = str(stubs) + os.pathsep + env['PATH']
+    env = stub_env(env)
+
+    run_jobs(jobs, args.cores, args.retries, env, args.errexit)
+
+    table = status_table(jobs)
+    with open(args.status, "w") as f:
+        f.writelines('\t'.join(line) + '\n' for line in table)
+    for line in table:
+        print("{0:<7} {1:>4} {2:>8} {3:>5} {4:>8}  {5}".format(*line))
+    failed = sum(job.returncode != 0 for job in jobs)
+    print("{} done, {} failed".format(len(jobs) - failed, failed))
+    sys.exit(1 if failed else 0)